@@ -23,7 +23,13 @@ DEFAULT_CONFIG = {
     "prev_iteration": "x",
     "input_data_type": "x",
     "simulation_type": "x",
-    "model": "x"
+    "model": "x",
+    "adjoint_source_options": {},
+    "misfit_type": None,
+    "tf_cache_max_gb": 0,
+    "plan_cache_max_mb": 256,
+    "window_selection_stats": False,
+    "window_cc_step_period": 0
 }
 
 CONFIG_FILE = os.path.join('./config.json')
@@ -53,6 +59,12 @@ class Config(object):
         self.input_data_type = None
         self.simulation_type = None
         self.model = None
+        self.adjoint_source_options = None
+        self.misfit_type = None
+        self.tf_cache_max_gb = None
+        self.plan_cache_max_mb = None
+        self.window_selection_stats = None
+        self.window_cc_step_period = None
 
     def initialize(self):
         """Populates the class from ./config.json.
@@ -101,6 +113,21 @@ class Config(object):
         """Directory within whcih adjoint sources are calculated."""
         return os.path.join(self.work_dir, 'ADJOINT_SOURCES')
 
+    @property
+    def misfit_dir(self):
+        """Directory within which misfits without adjoint sources are calculated."""
+        return os.path.join(self.work_dir, 'MISFITS')
+
+    @property
+    def tf_cache_dir(self):
+        """Directory holding the time frequency transforms of the data, shared by all iterations."""
+        return os.path.join(self.scratch_path, self.project_name, 'TF_CACHE')
+
+    @property
+    def first_arrival_table(self):
+        """Table of first arrival times used by the window selection, shared by all iterations."""
+        return os.path.join(self.scratch_path, self.project_name, 'first_arrivals_ak135.npz')
+
     @property
     def preprocessing_dir(self):
         return os.path.join(self.work_dir, 'DATA_PREPROCESSING')
@@ -12,58 +12,145 @@ Fichtner et al. (2008).
 """
 import numpy as np
 from scipy.interpolate import interp1d
-from scipy.interpolate import RectBivariateSpline
 import warnings
 
 import time_frequency
+import utils
 from . import LASIFAdjointSourceCalculationError
 
 eps = np.spacing(1)
 
 
 def adsrc_cc_time_shift(t, data, synthetic, min_period, max_period,
-                        axis=None, colorbar_axis=None):
+                        axis=None, colorbar_axis=None, truncation=None,
+                        band_tolerance=None, precision=None,
+                        threshold=None, offset=None, direct_cc=False,
+                        misfit_only=False, data_cache=None):
     """
+    :param truncation: Relative amplitude below which the Gaussian windows
+        of the time frequency transforms are truncated. Uses the full
+        windows if not given.
+    :param band_tolerance: If given, the time frequency representations only
+        hold the non-negative frequencies at which the spectral weighting is
+        above this value. Uses the full spectrum if not given.
+    :param precision: "double" (default) or "single". In single precision
+        the time frequency representations, the weighting and the inverse
+        transform are computed in float32/complex64.
+    :param threshold: Fraction of the maximum windowed signal energy below
+        which the time frequency transforms skip a time sample and leave it
+        zero. Transforms all time samples if not given.
+    :param offset: If given, data and synthetic only hold the samples of the
+        window, starting at this sample of the trace with the time axis t.
+        The transforms then only cover the window and a margin of a few
+        Gaussian widths, and the adjoint source is placed back into an array
+        of the length of t.
+    :param direct_cc: Evaluate the time frequency representation of the
+        correlation directly on the grid of the synthetic instead of
+        interpolating it from its own, twice as fine, grid.
+    :param misfit_only: Only compute the misfit and return None as the
+        adjoint source. Skips the inverse transform. Cannot be combined with
+        plotting.
+    :param data_cache: tf_cache.CachedSignal of the data. The time frequency
+        quantities of the data are then read from it or computed and stored
+        in it.
+
+    data and synthetic may also be stacks of shape (n_windows, len(t)) with
+    one window padded to the full trace per row. All windows are then
+    transformed at once, misfit_value holds the misfit of every window and
+    adjoint_source one row per window. The adjoint sources of windows with a
+    phase jump are zero.
+    Stacks can neither be plotted nor combined with offset.
+
     :rtype: dictionary
     :returns: Return a dictionary with three keys:
         * adjoint_source: The calculated adjoint source as a numpy array
         * misfit: The misfit value
         * messages: A list of strings giving additional hints to what happened
             in the calculation.
+        * phase_jump: Whether a phase jump was detected (per window for
+            stacks), in the details.
     """
-
     messages = []
 
+    if misfit_only and axis:
+        raise ValueError("Plotting requires the adjoint source, it can not "
+                         "be combined with misfit_only.")
+    if np.ndim(data) > 1 and (axis or offset is not None):
+        raise ValueError("Stacks of windows can neither be plotted nor be "
+                         "combined with offset.")
+
     # Compute time-frequency representations ----------------------------------
 
     # compute new time increments and Gaussian window width for the
     # time-frequency transforms
-    dt_new = float(int(min_period / 3.0))
-    width = 2.0 * min_period
-
-    # Compute time-frequency representation of the cross-correlation
-    tau_cc, nu_cc, tf_cc = time_frequency.time_frequency_cc_difference(
-        t, data, synthetic, dt_new, width)
-    # Compute the time-frequency representation of the synthetic
-    tau, nu, tf_synth = time_frequency.time_frequency_transform(t, synthetic,
-                                                                dt_new, width)
-
-    # 2D interpolation to bring the tf representation of the correlation on the
-    # same grid as the tf representation of the synthetics. Uses a two-step
-    # procedure for real and imaginary parts.
-    tf_cc_interp = RectBivariateSpline(tau_cc[0], nu_cc[:, 0], tf_cc.real,
-                                       kx=1, ky=1, s=0)(tau[0], nu[:, 0])
-    tf_cc_interp = np.require(tf_cc_interp, dtype="complex128")
-    tf_cc_interp.imag = RectBivariateSpline(tau_cc[0], nu_cc[:, 0], tf_cc.imag,
-                                            kx=1, ky=1, s=0)(tau[0], nu[:, 0])
-    tf_cc = tf_cc_interp
+    dt_new, width = time_frequency.transform_parameters(min_period)
+    real = time_frequency.precision_dtypes(precision)[0]
+
+    # Window local evaluation on a time axis starting at zero, the signals
+    # vanish outside of the window.
+    npts = len(t)
+    if offset is not None:
+        first, last = utils.window_segment(t, offset, len(data), width,
+                                            dt_new)
+        data = utils.pad_segment(data, offset - first, last - first)
+        synthetic = utils.pad_segment(synthetic, offset - first, last - first)
+        t = t[first:last] - t[first]
+
+    # Restrict the frequencies to the band where the weighting below is not
+    # negligible. The band of the correlation is one frequency sample of the
+    # synthetic wider on each side so it covers the grid it is interpolated
+    # to.
+    synth_band, cc_band = None, None
+    if band_tolerance:
+        nu_min, nu_max = utils.weighting_band(min_period, max_period,
+                                              band_tolerance)
+        dnu = 1.0 / (len(utils.matlab_range(t[0], t[-1], dt_new)) * dt_new)
+        synth_band = (nu_min, nu_max)
+        cc_band = (max(0.0, nu_min - dnu), nu_max + dnu)
+
+    # Compute the time-frequency representation of the synthetic. Without
+    # the adjoint source only its grid is needed.
+    if misfit_only and not direct_cc:
+        tau, nu = time_frequency.time_frequency_grid(
+            t, dt_new, width, truncation=truncation, nu_band=synth_band,
+            precision=precision)
+    else:
+        tau, nu, tf_synth = time_frequency.time_frequency_transform(
+            t, synthetic, dt_new, width, truncation=truncation,
+            nu_band=synth_band, precision=precision, threshold=threshold)
+
+    if direct_cc:
+        # The correlation on the grid of the synthetic follows from the
+        # time-frequency representation of the data.
+        tf_data = time_frequency.time_frequency_transform(
+            t, data, dt_new, width, truncation=truncation,
+            nu_band=synth_band, precision=precision, threshold=threshold,
+            cache=data_cache)[2]
+        tf_cc = time_frequency.cc_difference_on_grid(tau, nu, tf_data,
+                                                     tf_synth)
+        del tf_data
+    else:
+        # Compute time-frequency representation of the cross-correlation
+        tau_cc, nu_cc, tf_cc = time_frequency.time_frequency_cc_difference(
+            t, data, synthetic, dt_new, width, truncation=truncation,
+            nu_band=cc_band, precision=precision, threshold=threshold,
+            cache=data_cache)
+
+        # 2D interpolation to bring the tf representation of the correlation
+        # on the same grid as the tf representation of the synthetics. Uses a
+        # two-step procedure for real and imaginary parts.
+        tf_cc = time_frequency.interpolate_to_grid(tau_cc, nu_cc, tf_cc,
+                                                   tau, nu)
 
     # compute tf window and weighting function --------------------------------
 
+    # All maxima and sums are taken per window, over the last two axes.
+    tf_axes = (-2, -1)
+
     # noise taper: downweigh tf amplitudes that are very low
-    m = np.abs(tf_cc).max() / 10.0
+    m = np.abs(tf_cc).max(axis=tf_axes, keepdims=True) / 10.0
     weight = 1.0 - np.exp(-(np.abs(tf_cc) ** 2) / (m ** 2))
-    nu_t = nu.transpose()
+    nu_t = nu.transpose().astype(real, copy=False)
 
     # highpass filter (periods longer than max_period are suppressed
     # exponentially)
@@ -71,8 +158,8 @@ def adsrc_cc_time_shift(t, data, synthetic, min_period, max_period,
 
     # lowpass filter (periods shorter than min_period are suppressed
     # exponentially)
-    nu_t_large = np.zeros(nu_t.shape)
-    nu_t_small = np.zeros(nu_t.shape)
+    nu_t_large = np.zeros(nu_t.shape, dtype=real)
+    nu_t_small = np.zeros(nu_t.shape, dtype=real)
     thres = (nu_t <= 1.0 / min_period)
     nu_t_large[np.invert(thres)] = 1.0
     nu_t_small[thres] = 1.0
@@ -80,7 +167,7 @@ def adsrc_cc_time_shift(t, data, synthetic, min_period, max_period,
                nu_t_small)
 
     # normalisation
-    weight /= weight.max()
+    weight /= weight.max(axis=tf_axes, keepdims=True)
 
     # computation of phase difference, make quality checks and misfit ---------
 
@@ -90,14 +177,18 @@ def adsrc_cc_time_shift(t, data, synthetic, min_period, max_period,
 
     # Attempt to detect phase jumps by taking the derivatives in time and
     # frequency direction. 0.7 is an emperical value.
-    test_field = weight * DP / np.abs(weight * DP).max()
-    criterion_1 = np.sum([np.abs(np.diff(test_field, axis=0)) > 0.7])
-    criterion_2 = np.sum([np.abs(np.diff(test_field, axis=1)) > 0.7])
-    criterion = np.sum([criterion_1, criterion_2])
+    test_field = weight * DP / np.abs(weight * DP).max(axis=tf_axes,
+                                                      keepdims=True)
+    criterion_1 = np.sum(np.abs(np.diff(test_field, axis=-2)) > 0.7,
+                         axis=tf_axes)
+    criterion_2 = np.sum(np.abs(np.diff(test_field, axis=-1)) > 0.7,
+                         axis=tf_axes)
+    criterion = criterion_1 + criterion_2
     # criterion_1 = np.abs(np.diff(test_field, axis=0)).max()
     # criterion_2 = np.abs(np.diff(test_field, axis=1)).max()
     # criterion = max(criterion_1, criterion_2)
-    if criterion > 7.0:
+    phase_jump = criterion > 7.0
+    if np.any(phase_jump):
         warning = ("Possible phase jump detected. Misfit included. No "
                    "adjoint source computed.")
         warnings.warn(warning)
@@ -105,41 +196,52 @@ def adsrc_cc_time_shift(t, data, synthetic, min_period, max_period,
 
     # Compute the phase misfit
     dnu = nu[1, 0] - nu[0, 0]
-    phase_misfit = np.sqrt(np.sum(weight ** 2 * DP ** 2) * dt_new * dnu)
+    phase_misfit = np.sqrt(np.sum(weight ** 2 * DP ** 2, axis=tf_axes,
+                                  dtype=np.float64) * dt_new * dnu)
 
     # Sanity check. Should not occur.
-    if np.isnan(phase_misfit):
+    if np.any(np.isnan(phase_misfit)):
         msg = "The phase misfit is NaN."
         raise Exception(msg)
 
     # compute the adjoint source when no phase jump detected ------------------
 
-    if criterion <= 7.0:
+    if misfit_only:
+        ad_src = None
+
+    elif np.all(phase_jump):
+        # Criterion failed, no adjoint source calculated.
+        ad_src = np.zeros(np.shape(data)[:-1] + (len(t),))
+
+    else:
         # Make kernel for the inverse tf transform
         idp = weight * weight * DP * tf_synth / (m + np.abs(tf_synth) *
                                                  np.abs(tf_synth))
 
         # Invert tf transform and make adjoint source
-        ad_src, it, I = time_frequency.itfa(tau, nu, idp, width)
+        ad_src, it, I = time_frequency.itfa(tau, nu, idp, width,
+                                            in_place=True,
+                                            truncation=truncation)
 
         # Interpolate to original time axis
         current_time = tau[0, :]
         new_time = t[t <= current_time.max()]
         ad_src = interp1d(current_time, np.imag(ad_src), kind=2)(new_time)
         if len(t) > len(new_time):
-            ad_src = np.concatenate([ad_src, np.zeros(len(t) - len(new_time))])
+            ad_src = np.concatenate(
+                [ad_src, np.zeros(ad_src.shape[:-1] +
+                                  (len(t) - len(new_time),))], axis=-1)
 
         # Divide by the misfit.
-        ad_src /= (phase_misfit + eps)
-        ad_src = np.diff(ad_src) / (t[1] - t[0])
+        ad_src /= (phase_misfit[..., np.newaxis] + eps)
+        ad_src = np.diff(ad_src, axis=-1) / (t[1] - t[0])
 
         # Reverse time and add a leading zero so the adjoint source has the
         # same length as the input time series.
-        ad_src = ad_src[::-1]
-        ad_src = np.concatenate([[0.0], ad_src])
-
-    else:
-        ad_src = np.zeros(len(t))
+        ad_src = ad_src[..., ::-1]
+        ad_src = np.concatenate(
+            [np.zeros(ad_src.shape[:-1] + (1,)), ad_src], axis=-1)
+        ad_src[phase_jump] = 0.0
 
     # Plot if required. -------------------------------------------------------
 
@@ -198,10 +300,17 @@ def adsrc_cc_time_shift(t, data, synthetic, min_period, max_period,
                       verticalalignment="top",
                       horizontalalignment="right")
 
+    # The adjoint source is reversed in time, so the segment ends up mirrored
+    # in the full trace.
+    if offset is not None and ad_src is not None:
+        full = np.zeros(npts)
+        full[npts - last:npts - first] = ad_src
+        ad_src = full
+
     ret_dict = {
         "adjoint_source": ad_src,
         "misfit_value": phase_misfit,
-        "details": {"messages": messages}
+        "details": {"messages": messages, "phase_jump": phase_jump}
     }
 
     return ret_dict
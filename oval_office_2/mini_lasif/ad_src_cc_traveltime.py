@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Cross correlation traveltime misfit and adjoint source after Tromp et al.
+(2005).
+
+:license:
+    GNU General Public License, Version 3
+    (http://www.gnu.org/copyleft/gpl.html)
+"""
+import numpy as np
+import warnings
+
+from . import LASIFAdjointSourceCalculationError
+import utils
+
+
+def cc_time_shift(data, synthetic, dt):
+    """
+    Returns the time shift of the data with respect to the synthetic that
+    maximises their cross correlation. Positive if the data arrive later. The
+    peak of the FFT based correlation is refined to sub-sample precision by
+    fitting a parabola through it and its two neighbours. Works on the last
+    axis, so stacks of signals return one time shift per signal.
+
+    :param data: The data.
+    :param synthetic: The synthetic, same shape as data.
+    :param dt: The sampling interval.
+    """
+    cc = utils.fft_cross_correlation(data, synthetic)
+    n_cc = cc.shape[-1]
+    peak = cc.argmax(axis=-1)[..., np.newaxis]
+
+    # The correlation is stored with the non-negative lags first followed by
+    # the negative ones, so the neighbours of the peak wrap around.
+    def at(lag):
+        return np.take_along_axis(cc, lag % n_cc, axis=-1)[..., 0]
+    left, centre, right = at(peak - 1), at(peak), at(peak + 1)
+    curvature = left - 2.0 * centre + right
+    with np.errstate(divide="ignore", invalid="ignore"):
+        delta = np.where(curvature < 0.0,
+                         0.5 * (left - right) / curvature, 0.0)
+
+    peak = peak[..., 0]
+    lag = np.where(peak < (n_cc + 1) // 2, peak, peak - n_cc)
+    return (lag + delta) * dt
+
+
+def adsrc_cc_traveltime(t, data, synthetic, min_period, max_period,
+                        axis=None, colorbar_axis=None, offset=None,
+                        misfit_only=False, data_cache=None):
+    """
+    Cross correlation traveltime misfit 0.5 * T ** 2 of the time shift T of
+    the data with respect to the synthetic. Its adjoint source is
+    T * ds/dt / int (ds/dt) ** 2 dt, the derivative of the misfit with
+    respect to the synthetic s, reversed in time. Costs one FFT based
+    correlation per window.
+
+    Follows the calling convention of the misfits module. For stacks of
+    windows, only if all synthetics are zero the calculation fails, otherwise
+    the affected windows get a zero adjoint source.
+
+    :param min_period: Shifts of more than half of it are flagged as
+        possible cycle skips.
+    """
+    messages = []
+
+    if np.ndim(data) > 1 and (axis or offset is not None):
+        raise ValueError("Stacks of windows can neither be plotted nor be "
+                         "combined with offset.")
+
+    dt = t[1] - t[0]
+    npts = len(t)
+
+    time_shift = cc_time_shift(data, synthetic, dt)
+    misfit = 0.5 * time_shift ** 2
+
+    for shift in np.atleast_1d(time_shift):
+        if abs(shift) > 0.5 * min_period:
+            warning = ("Time shift of %.1f s exceeds half the minimum "
+                       "period. Possible cycle skip." % shift)
+            warnings.warn(warning)
+            messages.append(warning)
+
+    ad_src = None
+    if not misfit_only:
+        # The synthetic vanishes outside of the window.
+        pad = np.zeros(np.shape(synthetic)[:-1] + (1,))
+        velocity = np.gradient(np.concatenate([pad, synthetic, pad], axis=-1),
+                               dt, axis=-1)[..., 1:-1]
+        norm = np.sum(velocity ** 2, axis=-1, keepdims=True) * dt
+        if np.all(norm == 0.0):
+            raise LASIFAdjointSourceCalculationError(
+                "The synthetic is zero, no adjoint source calculated.")
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ad_src = np.where(norm > 0.0, np.asarray(time_shift)[
+                ..., np.newaxis] / norm * velocity, 0.0)[..., ::-1]
+
+        if offset is not None:
+            full = np.zeros(npts)
+            full[npts - offset - len(ad_src):npts - offset] = ad_src
+            ad_src = full
+
+    if axis:
+        if offset is None:
+            offset = 0
+        window_time = t[offset:offset + len(data)]
+        axis.plot(window_time, data, color="black", label="data")
+        axis.plot(window_time, synthetic, color="red", label="synthetic")
+        axis.set_xlabel("Seconds since event")
+        axis.set_xlim(window_time[0], window_time[-1])
+
+        text = "Time shift: %.2f s\nMisfit: %.4f" % (time_shift, misfit)
+        axis.text(x=0.99, y=0.02, s=text, transform=axis.transAxes,
+                  bbox=dict(facecolor='orange', alpha=0.8),
+                  verticalalignment="bottom",
+                  horizontalalignment="right")
+
+        if messages:
+            message = "\n".join(messages)
+            axis.text(x=0.99, y=0.98, s=message, transform=axis.transAxes,
+                      bbox=dict(facecolor='red', alpha=0.8),
+                      verticalalignment="top",
+                      horizontalalignment="right")
+
+    ret_dict = {
+        "adjoint_source": ad_src,
+        "misfit_value": misfit,
+        "details": {"messages": messages, "time_shift": time_shift}
+    }
+
+    return ret_dict
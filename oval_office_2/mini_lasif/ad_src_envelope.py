@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Envelope misfit and adjoint source after Bozdag et al. (2011).
+
+:license:
+    GNU General Public License, Version 3
+    (http://www.gnu.org/copyleft/gpl.html)
+"""
+import numpy as np
+from scipy.signal import hilbert
+
+from . import LASIFAdjointSourceCalculationError
+
+# Fraction of the maximum envelope of the synthetic added to it before
+# dividing by it, so the adjoint source stays finite where it vanishes.
+WATER_LEVEL = 1e-8
+
+
+def envelope(s):
+    """
+    Returns the envelope of a signal, the absolute value of its analytic
+    signal, along the last axis.
+    """
+    return np.abs(hilbert(s, axis=-1))
+
+
+def adsrc_envelope(t, data, synthetic, min_period, max_period, axis=None,
+                   colorbar_axis=None, offset=None, misfit_only=False,
+                   data_cache=None):
+    """
+    Envelope misfit 0.5 * int (E(s) - E(d)) ** 2 dt of the envelopes of the
+    synthetic s and the data d. It is less sensitive to cycle skips than the
+    phase misfits. With the envelope difference dE and the Hilbert transform
+    H, the adjoint source is dE * s / E(s) - H(dE * H(s) / E(s)), the
+    derivative of the misfit with respect to the synthetic, reversed in time.
+    Costs a few FFTs per window.
+
+    Follows the calling convention of the misfits module, including stacks
+    of windows.
+    """
+    messages = []
+
+    if np.ndim(data) > 1 and (axis or offset is not None):
+        raise ValueError("Stacks of windows can neither be plotted nor be "
+                         "combined with offset.")
+
+    dt = t[1] - t[0]
+    npts = len(t)
+
+    analytic = hilbert(np.asarray(synthetic, dtype=np.float64), axis=-1)
+    env_synth = np.abs(analytic)
+    env_data = envelope(np.asarray(data, dtype=np.float64))
+    env_diff = env_synth - env_data
+    misfit = 0.5 * np.sum(env_diff ** 2, axis=-1) * dt
+
+    ad_src = None
+    if not misfit_only:
+        env_max = env_synth.max(axis=-1)
+        if np.all(env_max == 0.0):
+            raise LASIFAdjointSourceCalculationError(
+                "The synthetic is zero, no adjoint source calculated.")
+        env_synth = env_synth + WATER_LEVEL * env_max[..., np.newaxis]
+        # Zero synthetics give a zero adjoint source.
+        env_synth[env_synth == 0.0] = 1.0
+        ad_src = (env_diff * analytic.real / env_synth -
+                  np.imag(hilbert(env_diff * analytic.imag / env_synth,
+                                  axis=-1)))[..., ::-1]
+
+        if offset is not None:
+            full = np.zeros(npts)
+            full[npts - offset - len(ad_src):npts - offset] = ad_src
+            ad_src = full
+
+    if axis:
+        if offset is None:
+            offset = 0
+        window_time = t[offset:offset + len(data)]
+        axis.plot(window_time, data, color="black", label="data")
+        axis.plot(window_time, synthetic, color="red", label="synthetic")
+        axis.plot(window_time, env_data, color="black", linestyle="--")
+        axis.plot(window_time, np.abs(analytic), color="red", linestyle="--")
+        axis.set_xlabel("Seconds since event")
+        axis.set_xlim(window_time[0], window_time[-1])
+
+        text = "Misfit: %.4g" % misfit
+        axis.text(x=0.99, y=0.02, s=text, transform=axis.transAxes,
+                  bbox=dict(facecolor='orange', alpha=0.8),
+                  verticalalignment="bottom",
+                  horizontalalignment="right")
+
+    ret_dict = {
+        "adjoint_source": ad_src,
+        "misfit_value": misfit,
+        "details": {"messages": messages}
+    }
+
+    return ret_dict
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+L2 waveform misfit and adjoint source.
+
+:license:
+    GNU General Public License, Version 3
+    (http://www.gnu.org/copyleft/gpl.html)
+"""
+import numpy as np
+
+
+def adsrc_l2(t, data, synthetic, min_period, max_period, axis=None,
+             colorbar_axis=None, offset=None, misfit_only=False,
+             data_cache=None):
+    """
+    L2 waveform misfit 0.5 * int (s - d) ** 2 dt of the synthetic s and the
+    data d. Its adjoint source is s - d, the derivative of the misfit with
+    respect to the synthetic, reversed in time. Costs O(N) per window, so it
+    suits long period or sanity iterations.
+
+    Follows the calling convention of the misfits module, including stacks
+    of windows.
+    """
+    messages = []
+
+    if np.ndim(data) > 1 and (axis or offset is not None):
+        raise ValueError("Stacks of windows can neither be plotted nor be "
+                         "combined with offset.")
+
+    dt = t[1] - t[0]
+    npts = len(t)
+
+    residual = np.asarray(synthetic, dtype=np.float64) - data
+    misfit = 0.5 * np.sum(residual ** 2, axis=-1) * dt
+
+    ad_src = None
+    if not misfit_only:
+        ad_src = residual[..., ::-1]
+
+        if offset is not None:
+            full = np.zeros(npts)
+            full[npts - offset - len(ad_src):npts - offset] = ad_src
+            ad_src = full
+
+    if axis:
+        if offset is None:
+            offset = 0
+        window_time = t[offset:offset + len(data)]
+        axis.plot(window_time, data, color="black", label="data")
+        axis.plot(window_time, synthetic, color="red", label="synthetic")
+        axis.set_xlabel("Seconds since event")
+        axis.set_xlim(window_time[0], window_time[-1])
+
+        text = "Misfit: %.4g" % misfit
+        axis.text(x=0.99, y=0.02, s=text, transform=axis.transAxes,
+                  bbox=dict(facecolor='orange', alpha=0.8),
+                  verticalalignment="bottom",
+                  horizontalalignment="right")
+
+    ret_dict = {
+        "adjoint_source": ad_src,
+        "misfit_value": misfit,
+        "details": {"messages": messages}
+    }
+
+    return ret_dict
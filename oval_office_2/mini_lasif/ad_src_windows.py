@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Misfits and adjoint sources of all windows of a station at once.
+
+:license:
+    GNU General Public License, Version 3
+    (http://www.gnu.org/copyleft/gpl.html)
+"""
+import time
+
+import numpy as np
+
+from . import LASIFAdjointSourceCalculationError
+from ad_src_cc_time_shift import adsrc_cc_time_shift
+from ad_src_cc_traveltime import adsrc_cc_traveltime
+from ad_src_envelope import adsrc_envelope
+from ad_src_l2 import adsrc_l2
+from ad_src_tf_phase_misfit import adsrc_tf_phase_misfit
+import time_frequency
+import utils
+
+# Adjoint source functions that accept stacks of windows padded to the full
+# trace and compute all of them with one call.
+STACKED_ADJOINT_SOURCES = (adsrc_tf_phase_misfit, adsrc_cc_time_shift,
+                           adsrc_cc_traveltime, adsrc_envelope, adsrc_l2)
+
+
+def adsrc_windows(adsrc_function, t, data, synthetic, windows, min_period,
+                  max_period, window_local=False, taper_percentage=0.1,
+                  data_cache=None, **adjoint_options):
+    """
+    Computes the misfit of every window of a data/synthetic pair and the sum
+    of their adjoint sources.
+
+    Each window of data and synthetic is cosine tapered like
+    Trace.taper(max_percentage=taper_percentage, type="cosine"). The windows
+    of functions in STACKED_ADJOINT_SOURCES are stacked so the time frequency
+    transforms, the weighting and the inverse transform of all windows are
+    computed with one call and one set of transform plans. All other
+    functions go through the windows one by one.
+
+    :param adsrc_function: The adjoint source function, e.g.
+        adsrc_tf_phase_misfit.
+    :param t: The time axis of the traces.
+    :param data: The data trace.
+    :param synthetic: The synthetic trace, same length as data.
+    :param windows: List of (first, last) sample indices, the window spans
+        the samples first to last - 1.
+    :param window_local: Only transform the windows and a margin around
+        them instead of the full trace. Stacked windows share the length of
+        the longest of these segments.
+    :param taper_percentage: Length of the taper on either side as a
+        fraction of the window length.
+    :param data_cache: tf_cache.CachedSignal of the data trace. The time
+        frequency quantities of the stacked data windows are read from it or
+        computed and stored in it. Unused by the other functions.
+    :param adjoint_options: Passed on to the adjoint source function.
+    :rtype: dictionary
+    :returns: Return a dictionary with four keys:
+        * adjoint_source: The summed adjoint source of all windows, None if
+            misfit_only is set
+        * misfit_values: The misfit of every window, None for windows whose
+            calculation failed
+        * messages: A list of strings giving additional hints to what
+            happened in the calculation.
+        * cost: Wall clock time in seconds spent in adsrc_function.
+    """
+    npts = len(t)
+    misfit_values = [None] * len(windows)
+    messages = []
+
+    # Windows are clipped to the trace. They may fall off its end as the
+    # length of the synthetics depends on the solver settings.
+    segments = []
+    for i, (first, last) in enumerate(windows):
+        first, last = max(first, 0), min(last, npts)
+        if last <= first:
+            messages.append("Window %d is outside of the trace." % i)
+            continue
+        # Tapered in the dtype of the traces, like Trace.taper.
+        taper = utils.window_taper(last - first, taper_percentage)
+        segments.append((i, first,
+                         (data[first:last] * taper).astype(data.dtype),
+                         (synthetic[first:last] *
+                          taper).astype(synthetic.dtype)))
+
+    cost = 0.0
+    adjoint_source = None
+    if not adjoint_options.get("misfit_only"):
+        adjoint_source = np.zeros(npts)
+
+    stacked = adsrc_function in STACKED_ADJOINT_SOURCES
+    if stacked and segments:
+        if window_local:
+            # The window local segments, extended by the margin of the
+            # transforms, all get the length of the longest one so they share
+            # the transform plans.
+            dt_new, width = time_frequency.transform_parameters(min_period)
+            bounds = [utils.window_segment(t, first, len(data_window), width,
+                                           dt_new)
+                      for _, first, data_window, _ in segments]
+            length = max(last - start for start, last in bounds)
+            starts = [start for start, _ in bounds]
+            t_stack = t[:length] - t[0]
+        else:
+            length = npts
+            starts = [0] * len(segments)
+            t_stack = t
+
+        data_stack = np.zeros((len(segments), length))
+        synthetic_stack = np.zeros((len(segments), length))
+        for row, ((_, first, data_window, synthetic_window), start) in \
+                enumerate(zip(segments, starts)):
+            data_stack[row, first - start:first - start + len(data_window)] = \
+                data_window
+            synthetic_stack[row, first - start:
+                            first - start + len(synthetic_window)] = \
+                synthetic_window
+        if data_cache is not None:
+            data_cache = data_cache.extend("windows", tuple(windows),
+                                           window_local, taper_percentage)
+        start_time = time.time()
+        try:
+            adj_dict = adsrc_function(t_stack, data_stack, synthetic_stack,
+                                      min_period, max_period,
+                                      data_cache=data_cache,
+                                      **adjoint_options)
+        except LASIFAdjointSourceCalculationError as e:
+            messages.append(str(e))
+        else:
+            messages.extend(adj_dict["details"]["messages"])
+            for (i, _, _, _), misfit in zip(segments,
+                                            adj_dict["misfit_value"]):
+                if not np.isnan(misfit):
+                    misfit_values[i] = misfit
+            if adjoint_source is not None:
+                # The adjoint sources are reversed in time, so the segments
+                # end up mirrored in the full trace.
+                for window_adjoint_source, start in \
+                        zip(adj_dict["adjoint_source"], starts):
+                    end = npts - start
+                    adjoint_source[max(end - length, 0):end] += \
+                        window_adjoint_source[max(length - end, 0):]
+        cost += time.time() - start_time
+    elif not stacked:
+        for i, first, data_window, synthetic_window in segments:
+            offset = first
+            if not window_local:
+                offset = None
+                data_window = utils.pad_segment(data_window, first, npts)
+                synthetic_window = utils.pad_segment(synthetic_window, first,
+                                                     npts)
+            start_time = time.time()
+            try:
+                adj_dict = adsrc_function(t, data_window, synthetic_window,
+                                          min_period, max_period,
+                                          offset=offset, **adjoint_options)
+            except LASIFAdjointSourceCalculationError as e:
+                messages.append(str(e))
+                continue
+            finally:
+                cost += time.time() - start_time
+            messages.extend(adj_dict["details"]["messages"])
+            misfit_values[i] = adj_dict["misfit_value"]
+            if adj_dict["adjoint_source"] is not None:
+                adjoint_source += adj_dict["adjoint_source"]
+
+    return {"adjoint_source": adjoint_source,
+            "misfit_values": misfit_values,
+            "messages": messages,
+            "cost": cost}
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Vectorised versions of the obspy geodetics functions used by the window
+selection, so the distances of all stations of an event are computed at
+once.
+
+:license:
+    GNU General Public License, Version 3
+    (http://www.gnu.org/copyleft/gpl.html)
+"""
+import numpy as np
+
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+
+
+def locations2degrees(lat1, long1, lat2, long2):
+    """
+    Great circle distance in degrees between points on a spherical Earth,
+    like obspy.geodetics.locations2degrees. All arguments may be arrays.
+    """
+    lat1, lat2 = np.radians(lat1), np.radians(lat2)
+    long_diff = np.radians(long2) - np.radians(long1)
+    return np.degrees(np.arctan2(
+        np.sqrt((np.cos(lat2) * np.sin(long_diff)) ** 2 +
+                (np.cos(lat1) * np.sin(lat2) - np.sin(lat1) *
+                 np.cos(lat2) * np.cos(long_diff)) ** 2),
+        np.sin(lat1) * np.sin(lat2) + np.cos(lat1) * np.cos(lat2) *
+        np.cos(long_diff)))
+
+
+def vincenty_distance(lat1, lon1, lat2, lon2, a=WGS84_A, f=WGS84_F):
+    """
+    Distance in m between points on the ellipsoid with Vincenty's inverse
+    formula, like the first value returned by
+    obspy.geodetics.calc_vincenty_inverse. All arguments may be arrays, the
+    iteration runs for all points at once until each of them has converged.
+
+    Nearly antipodal points for which the iteration does not converge get a
+    NaN distance instead of raising StopIteration.
+    """
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(
+        *[np.asarray(x, dtype=np.float64) for x in (lat1, lon1, lat2, lon2)])
+    if np.any(np.abs(lat1) > 90) or np.any(np.abs(lat2) > 90):
+        raise ValueError("Latitudes out of bounds! (-90 <= lat <= 90)")
+    lon1 = (lon1 + 180.0) % 360.0 - 180.0
+    lon2 = (lon2 + 180.0) % 360.0 - 180.0
+
+    b = a * (1 - f)
+    u_1 = np.arctan((1 - f) * np.tan(np.radians(lat1)))
+    u_2 = np.arctan((1 - f) * np.tan(np.radians(lat2)))
+    sin_u1, cos_u1 = np.sin(u_1), np.cos(u_1)
+    sin_u2, cos_u2 = np.sin(u_2), np.cos(u_2)
+    omega = np.radians(lon2) - np.radians(lon1)
+
+    dlon = omega.copy()
+    dist = np.zeros(dlon.shape)
+    # Coincident points have a distance of zero.
+    active = ~((np.abs(lat1 - lat2) < 1e-8) & (np.abs(lon1 - lon2) < 1e-8))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for _ in xrange(101):
+            if not np.any(active):
+                break
+            lam = dlon[active]
+            s_u1, c_u1 = sin_u1[active], cos_u1[active]
+            s_u2, c_u2 = sin_u2[active], cos_u2[active]
+
+            sqr_sin_sigma = (c_u2 * np.sin(lam)) ** 2 + \
+                (c_u1 * s_u2 - s_u1 * c_u2 * np.cos(lam)) ** 2
+            sin_sigma = np.sqrt(sqr_sin_sigma)
+            cos_sigma = s_u1 * s_u2 + c_u1 * c_u2 * np.cos(lam)
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = c_u1 * c_u2 * np.sin(lam) / np.sin(sigma)
+            cos_sqr_alpha = np.cos(np.arcsin(sin_alpha)) ** 2
+            cos2sigma_m = np.cos(sigma) - 2 * s_u1 * s_u2 / cos_sqr_alpha
+            c = (f / 16) * cos_sqr_alpha * (4 + f * (4 - 3 * cos_sqr_alpha))
+            new_dlon = omega[active] + (1 - c) * f * sin_alpha * \
+                (sigma + c * np.sin(sigma) *
+                 (cos2sigma_m + c * np.cos(sigma) *
+                  (-1 + 2 * cos2sigma_m ** 2)))
+
+            u2 = cos_sqr_alpha * (a * a - b * b) / (b * b)
+            _a = 1 + (u2 / 16384) * (4096 + u2 * (-768 + u2 *
+                                                  (320 - 175 * u2)))
+            _b = (u2 / 1024) * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+            delta_sigma = _b * sin_sigma * \
+                (cos2sigma_m + (_b / 4) *
+                 (cos_sigma * (-1 + 2 * cos2sigma_m ** 2) - (_b / 6) *
+                  cos2sigma_m * (-3 + 4 * sqr_sin_sigma) *
+                  (-3 + 4 * cos2sigma_m ** 2)))
+            dist[active] = b * _a * (sigma - delta_sigma)
+            dlon[active] = new_dlon
+
+            converged = (new_dlon == 0) | \
+                (np.abs((lam - new_dlon) / new_dlon) <= 1.0e-9)
+            indices = np.flatnonzero(active)
+            active[indices[converged]] = False
+            # Failed evaluations do not converge either.
+            dist[indices[~np.isfinite(new_dlon)]] = np.nan
+            active[indices[~np.isfinite(new_dlon)]] = False
+
+    # Iteration limit reached.
+    dist[active] = np.nan
+    return dist
+
+
+def event_station_distances(event_latitude, event_longitude,
+                            station_latitudes, station_longitudes):
+    """
+    Returns the epicentral distances in degree on the sphere and in km on
+    the WGS84 ellipsoid of all stations of an event, as computed per trace
+    by select_windows.
+
+    :param event_latitude: The event latitude.
+    :param event_longitude: The event longitude.
+    :param station_latitudes: Array of the station latitudes.
+    :param station_longitudes: Array of the station longitudes.
+    """
+    dist_in_deg = locations2degrees(station_latitudes, station_longitudes,
+                                    event_latitude, event_longitude)
+    dist_in_km = vincenty_distance(station_latitudes, station_longitudes,
+                                   event_latitude, event_longitude) / 1000.0
+    return dist_in_deg, dist_in_km
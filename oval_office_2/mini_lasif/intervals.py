@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Sets of half open sample intervals [start, stop), as used by the window
+selection for the candidate windows.
+
+A set of intervals is a tuple (starts, stops) of two sorted integer arrays
+of the same length. The intervals of a set are disjoint and do not touch,
+every function returns sets in that form.
+
+:license:
+    GNU General Public License, Version 3
+    (http://www.gnu.org/copyleft/gpl.html)
+"""
+import numpy as np
+
+
+def empty():
+    """
+    Returns an empty set of intervals.
+    """
+    return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+
+def from_bounds(starts, stops):
+    """
+    Returns the set of intervals covering the union of arbitrary, possibly
+    overlapping or empty, intervals.
+
+    >>> from_bounds([5, 0, 2, 9], [8, 3, 4, 9])
+    (array([0, 5]), array([4, 8]))
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    stops = np.asarray(stops, dtype=np.int64)
+    non_empty = starts < stops
+    starts, stops = starts[non_empty], stops[non_empty]
+    if not len(starts):
+        return empty()
+    order = np.argsort(starts, kind="mergesort")
+    starts, stops = starts[order], np.maximum.accumulate(stops[order])
+    # An interval starts a new one if it begins after the end of all
+    # previous ones.
+    first = np.concatenate([[True], starts[1:] > stops[:-1]])
+    last = np.concatenate([first[1:], [True]])
+    return starts[first], stops[last]
+
+
+def from_mask(mask):
+    """
+    Returns the intervals of the runs of True values of a boolean array.
+
+    >>> from_mask(np.array([1, 1, 0, 0, 1, 0, 1], dtype=bool))
+    (array([0, 4, 6]), array([2, 5, 7]))
+    """
+    edges = np.diff(np.concatenate([[0], np.asarray(mask, dtype=np.int8),
+                                    [0]]))
+    return (np.flatnonzero(edges == 1).astype(np.int64),
+            np.flatnonzero(edges == -1).astype(np.int64))
+
+
+def to_mask(intervals, npts):
+    """
+    Returns a boolean array of length npts which is True within the
+    intervals.
+    """
+    starts, stops = intervals
+    edges = np.zeros(npts + 1, dtype=np.int64)
+    np.add.at(edges, np.minimum(starts, npts), 1)
+    np.add.at(edges, np.minimum(stops, npts), -1)
+    return np.cumsum(edges[:-1]) > 0
+
+
+def lengths(intervals):
+    """
+    Returns the number of samples of every interval.
+    """
+    starts, stops = intervals
+    return stops - starts
+
+
+def min_length(intervals, length):
+    """
+    Returns the intervals with at least length samples.
+    """
+    starts, stops = intervals
+    keep = (stops - starts) >= length
+    return starts[keep], stops[keep]
+
+
+def _covered(intervals, points):
+    """
+    Whether every point lies within one of the intervals.
+    """
+    starts, stops = intervals
+    return np.searchsorted(starts, points, side="right") > \
+        np.searchsorted(stops, points, side="right")
+
+
+def _combine(a, b, operator):
+    """
+    Applies a pointwise boolean operator to two sets of intervals. It is
+    evaluated on the elementary segments between all interval bounds.
+    """
+    bounds = np.unique(np.concatenate([a[0], a[1], b[0], b[1]]))
+    if len(bounds) < 2:
+        return empty()
+    selected = operator(_covered(a, bounds[:-1]), _covered(b, bounds[:-1]))
+    return from_bounds(bounds[:-1][selected], bounds[1:][selected])
+
+
+def union(a, b):
+    """
+    Returns the samples within a or b.
+    """
+    return _combine(a, b, np.logical_or)
+
+
+def intersect(a, b):
+    """
+    Returns the samples within both a and b.
+
+    >>> intersect((np.array([0, 10]), np.array([5, 20])),
+    ...           (np.array([3]), np.array([12])))
+    (array([ 3, 10]), array([ 5, 12]))
+    """
+    return _combine(a, b, np.logical_and)
+
+
+def subtract(a, b):
+    """
+    Returns the samples within a but not within b.
+
+    >>> subtract((np.array([0, 10]), np.array([5, 20])),
+    ...          (np.array([3]), np.array([12])))
+    (array([ 0, 12]), array([ 3, 20]))
+    """
+    return _combine(a, b, lambda x, y: x & ~y)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Registry of the misfit functionals.
+
+All of them share the calling convention of the adjoint source functions:
+
+    function(t, data, synthetic, min_period, max_period, axis=None,
+             colorbar_axis=None, offset=None, misfit_only=False,
+             data_cache=None, **options)
+
+with the parameters
+
+* t: The time axis of the trace.
+* min_period, max_period: The period band of the data, unused by most
+  misfits.
+* axis, colorbar_axis: Matplotlib axes to plot the misfit into.
+* offset: If given, data and synthetic only hold the samples of the window,
+  starting at this sample of the trace. The adjoint source is placed back
+  into an array of the length of t. It is reversed in time, so the window
+  ends up mirrored in the full trace.
+* misfit_only: Only compute the misfit and return None as the adjoint
+  source.
+* data_cache: tf_cache.CachedSignal of the data, unused by most misfits.
+
+data and synthetic may also be stacks of shape (n_windows, len(t)) with one
+window padded to the full trace per row, see ad_src_windows.adsrc_windows.
+misfit_value then holds the misfit of every window and adjoint_source one
+row per window. Stacks can neither be plotted nor combined with offset.
+
+They return a dictionary with the adjoint_source, the misfit_value and the
+details, holding at least a list of messages.
+
+:license:
+    GNU General Public License, Version 3
+    (http://www.gnu.org/copyleft/gpl.html)
+"""
+from ad_src_cc_time_shift import adsrc_cc_time_shift
+from ad_src_cc_traveltime import adsrc_cc_traveltime
+from ad_src_envelope import adsrc_envelope
+from ad_src_l2 import adsrc_l2
+from ad_src_tf_phase_misfit import adsrc_tf_phase_misfit
+
+# Misfit functionals by name, roughly from the most to the least expensive.
+MISFIT_FUNCTIONS = {
+    "tf_phase_misfit": adsrc_tf_phase_misfit,
+    "cc_time_shift": adsrc_cc_time_shift,
+    "envelope": adsrc_envelope,
+    "cc_traveltime": adsrc_cc_traveltime,
+    "l2": adsrc_l2}
+
+# Misfit used if none is configured, by input data type.
+DEFAULT_MISFIT_TYPES = {
+    "noise": "cc_time_shift",
+    "earthquake": "tf_phase_misfit"}
+
+
+def register_misfit(name, function):
+    """
+    Adds a misfit functional to the registry.
+
+    :param name: The name to select it with, e.g. in the misfit_type config.
+    :param function: The adjoint source function, following the calling
+        convention of this module.
+    """
+    MISFIT_FUNCTIONS[name] = function
+
+
+def get_misfit_function(misfit_type=None, data_type=None):
+    """
+    Returns the misfit functional of a name.
+
+    :param misfit_type: The name of the misfit. If not given, the default of
+        the data type is used.
+    :param data_type: The input data type, "noise" or "earthquake".
+    """
+    if not misfit_type:
+        misfit_type = DEFAULT_MISFIT_TYPES[data_type]
+    try:
+        return MISFIT_FUNCTIONS[misfit_type]
+    except KeyError:
+        raise ValueError("Unknown misfit type '%s'. Available: %s" % (
+            misfit_type, ", ".join(sorted(MISFIT_FUNCTIONS))))
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Per stage statistics of the window selection.
+
+Passing a SelectionStats instance as stats to select_windows() or
+select_windows_stream() records, for every trace and elimination stage, the
+wall time of the stage and the samples and windows still left after it.
+Without it nothing is recorded.
+
+:license:
+    GNU General Public License, Version 3
+    (http://www.gnu.org/copyleft/gpl.html)
+"""
+import cPickle
+import os
+import time
+
+import intervals
+
+# The stages in the order they are applied. "global" covers the
+# distances, the first arrival, the global rejection criteria and the
+# envelopes, "no_energy" includes the sliding cross correlation.
+STAGES = ("global", "traveltime", "envelope_similarity", "no_energy",
+          "correlation_threshold", "time_shift_threshold", "time_shift_jumps",
+          "min_length_1", "peak_trough_marching", "peak_trough_count",
+          "min_length_2", "little_energy")
+
+# Name of the per event statistics file next to windows.p, and of the
+# summary of all events of an iteration.
+EVENT_STATS_FILE = "window_selection_stats.p"
+ITERATION_STATS_FILE = "window_selection_stats.txt"
+
+
+class SelectionStats(object):
+    """
+    Collects the statistics of the traces of one or more window selection
+    runs in traces, a list with one dictionary per trace:
+
+        {"id": trace id, "npts": samples of the trace,
+         "rejected": None or the global rejection criterion,
+         "stages": [(stage, seconds, samples left, windows left), ...]}
+    """
+
+    def __init__(self):
+        self.traces = []
+        self._last = None
+
+    def begin(self, trace_id, npts):
+        """
+        Starts the record of a trace.
+        """
+        self.traces.append({"id": trace_id, "npts": npts, "rejected": None,
+                            "stages": []})
+        self._last = time.time()
+
+    def stage(self, name, candidates, seconds=None):
+        """
+        Records the end of a stage of the current trace.
+
+        :param name: The stage, one of STAGES.
+        :param candidates: The remaining candidate windows as a set of
+            intervals, see the intervals module.
+        :param seconds: The wall time of the stage, by default the time
+            since the previous stage.
+        """
+        now = time.time()
+        if seconds is None:
+            seconds = now - self._last
+        lengths = intervals.lengths(candidates)
+        self.traces[-1]["stages"].append(
+            (name, seconds, int(lengths.sum()), len(lengths)))
+        # The bookkeeping is not counted for the next stage.
+        self._last = time.time()
+
+    def reject(self, criterion):
+        """
+        Marks the current trace as rejected by a global criterion, e.g.
+        "correlation" or "noise".
+        """
+        self.traces[-1]["rejected"] = criterion
+
+
+def summarize(traces):
+    """
+    Aggregates the records of SelectionStats.traces.
+
+    Returns a dictionary with the number of traces, the number of traces
+    rejected by every global criterion and, for every stage, the number of
+    traces reaching it, the total wall time and the samples it removed, and
+    the windows left after it.
+
+    :param traces: The trace records, e.g. of all events of an iteration.
+    """
+    summary = {"traces": len(traces), "rejected": {},
+               "stages": dict((name, {"traces": 0, "seconds": 0.0,
+                                      "samples_removed": 0, "windows": 0})
+                              for name in STAGES)}
+    for trace in traces:
+        if trace["rejected"]:
+            summary["rejected"][trace["rejected"]] = \
+                summary["rejected"].get(trace["rejected"], 0) + 1
+        samples = trace["npts"]
+        for name, seconds, remaining, windows in trace["stages"]:
+            entry = summary["stages"].setdefault(
+                name, {"traces": 0, "seconds": 0.0, "samples_removed": 0,
+                       "windows": 0})
+            entry["traces"] += 1
+            entry["seconds"] += seconds
+            entry["samples_removed"] += samples - remaining
+            entry["windows"] += windows
+            samples = remaining
+    return summary
+
+
+def slowest_traces(traces, n=10):
+    """
+    Returns the ids and total wall times of the n slowest traces.
+    """
+    totals = [(sum(stage[1] for stage in trace["stages"]), trace["id"])
+              for trace in traces]
+    return [(trace_id, seconds)
+            for seconds, trace_id in sorted(totals, reverse=True)[:n]]
+
+
+def format_summary(summary):
+    """
+    Returns a summary of summarize() as a table.
+    """
+    lines = ["%i traces, rejected: %s" % (
+        summary["traces"], ", ".join(
+            "%s %i" % item for item in sorted(summary["rejected"].items()))
+        or "none"),
+        "%-22s %8s %10s %16s %10s" % ("stage", "traces", "seconds",
+                                      "samples removed", "windows")]
+    for name in STAGES:
+        entry = summary["stages"][name]
+        lines.append("%-22s %8i %10.3f %16i %10i" % (
+            name, entry["traces"], entry["seconds"],
+            entry["samples_removed"], entry["windows"]))
+    return "\n".join(lines)
+
+
+def write_event_stats(directory, stats):
+    """
+    Writes the records and the summary of the traces of an event to
+    EVENT_STATS_FILE in the event directory, next to its windows.p.
+    """
+    with open(os.path.join(directory, EVENT_STATS_FILE), "wb") as fh:
+        cPickle.dump({"traces": stats.traces,
+                      "summary": summarize(stats.traces)}, fh)
+
+
+def write_iteration_stats(directories, filename=ITERATION_STATS_FILE):
+    """
+    Summarizes the statistics of all events of an iteration, written by
+    write_event_stats(), in a text file. Events without statistics are
+    skipped. Returns the text.
+
+    :param directories: The event directories.
+    :param filename: The text file.
+    """
+    traces = []
+    for directory in directories:
+        path = os.path.join(directory, EVENT_STATS_FILE)
+        if not os.path.exists(path):
+            continue
+        with open(path, "rb") as fh:
+            traces.extend(cPickle.load(fh)["traces"])
+    text = format_summary(summarize(traces)) + "\nSlowest traces:\n" + \
+        "\n".join("%-22s %10.3f" % item for item in slowest_traces(traces))
+    with open(filename, "w") as fh:
+        fh.write(text + "\n")
+    return text
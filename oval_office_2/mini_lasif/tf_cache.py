@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of the time frequency quantities of the observed data.
+
+The observed data and the windows stay the same over the iterations, so the
+data side of the time frequency misfits only needs to be computed once. The
+entries are stored as .npz files in a directory on scratch, which is shared
+by the processes of a run and bounded in size by evicting the least recently
+used entries.
+
+:license:
+    GNU General Public License, Version 3
+    (http://www.gnu.org/copyleft/gpl.html)
+"""
+import errno
+import hashlib
+import os
+import tempfile
+import time
+
+import numpy as np
+
+# Log of the hits and misses of every run, one line per event.
+STATS_FILE = "cache_stats.log"
+
+# Temporary files older than this many seconds are left over by crashed
+# writers and are removed.
+STALE_TMP_AGE = 3600.0
+
+
+def content_hash(*arrays):
+    """
+    Returns the SHA1 hex digest of the dtype, shape and contents of the
+    arrays.
+    """
+    digest = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update("%s%s" % (array.dtype.str, array.shape))
+        digest.update(array.data)
+    return digest.hexdigest()
+
+
+class TFCache(object):
+    """
+    Directory of cached arrays, bounded to max_size bytes. Reading an entry
+    updates its modification time, and the entries with the oldest
+    modification time are evicted first.
+
+    Entries are written to a temporary file and renamed, so several processes
+    can share the directory.
+
+    Every instance lists the directory once and then keeps a running total
+    of the entry sizes. The directory is only listed again, and the entries
+    evicted, when the total exceeds max_size. Entries written by other
+    processes in the meantime are only counted at the next listing.
+
+    :param directory: The cache directory, created if necessary.
+    :param max_size: Maximum total size of the entries in bytes.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = self.misses = self.evictions = 0
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.size = sum(entry[1] for entry in self._scan())
+
+    def _path(self, key):
+        return os.path.join(self.directory,
+                            hashlib.sha1(repr(key)).hexdigest() + ".npz")
+
+    def get(self, key):
+        """
+        Returns the dictionary of arrays stored for key, or None.
+
+        :param key: Tuple of strings and numbers identifying the entry.
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as npz:
+                arrays = dict(npz.items())
+        except (IOError, ValueError):
+            self.misses += 1
+            return None
+        # Mark the entry as recently used. It might have just been evicted by
+        # another process.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return arrays
+
+    def put(self, key, arrays):
+        """
+        Stores a dictionary of arrays for key and evicts the least recently
+        used entries beyond max_size.
+
+        :param key: Tuple of strings and numbers identifying the entry.
+        :param arrays: Dictionary of numpy arrays.
+        """
+        path = self._path(key)
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        with os.fdopen(fd, "wb") as fh:
+            np.savez(fh, **arrays)
+        self.size += os.path.getsize(tmp_path)
+        # An existing entry of the same key is replaced.
+        try:
+            self.size -= os.path.getsize(path)
+        except OSError:
+            pass
+        os.rename(tmp_path, path)
+        if self.size > self.max_size:
+            self._evict()
+
+    def _scan(self):
+        """
+        Returns a list of (modification time, size, path) tuples of the
+        entries and removes the stale temporary files.
+        """
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if name.endswith(".npz"):
+                entries.append((stat.st_mtime, stat.st_size, path))
+            elif name.endswith(".tmp") and \
+                    now - stat.st_mtime > STALE_TMP_AGE:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        return entries
+
+    def _evict(self):
+        entries = self._scan()
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except OSError:
+                pass
+            size -= entry_size
+        self.size = size
+
+    def signal(self, key, scale=1.0):
+        """
+        Returns a CachedSignal of the entries of a signal.
+
+        :param key: Tuple identifying the signal, e.g. its trace id and
+            content_hash.
+        :param scale: Factor the signal was scaled with after hashing.
+        """
+        return CachedSignal(self, tuple(key), scale)
+
+    def info(self):
+        """
+        Returns a dictionary with the hits, misses, evictions and hit rate of
+        this instance.
+        """
+        lookups = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": float(self.hits) / lookups if lookups else 0.0}
+
+    def log_info(self, iteration, label):
+        """
+        Appends the hits, misses and evictions so far to the STATS_FILE of
+        the cache directory.
+
+        :param iteration: Name of the iteration.
+        :param label: Name of the logged unit of work, e.g. the event.
+        """
+        with open(os.path.join(self.directory, STATS_FILE), "a") as fh:
+            fh.write("%s %s %d %d %d\n" % (iteration, label, self.hits,
+                                           self.misses, self.evictions))
+
+
+class CachedSignal(object):
+    """
+    Entries of quantities that depend linearly on a signal, e.g. its
+    spectra. They are stored for the signal divided by scale so they remain
+    valid if the signal is rescaled, as the observed data are scaled to the
+    synthetics of every iteration.
+
+    :param cache: The TFCache.
+    :param key: Tuple identifying the signal.
+    :param scale: Factor the signal was scaled with after hashing.
+    """
+
+    def __init__(self, cache, key, scale=1.0):
+        self.cache = cache
+        self.key = key
+        self.scale = scale
+
+    def extend(self, *key):
+        """
+        Returns a CachedSignal of a part of the signal, e.g. a window,
+        identified by the additional key items.
+        """
+        return CachedSignal(self.cache, self.key + key, self.scale)
+
+    def get(self, key):
+        """
+        Returns the dictionary of arrays stored for key, scaled to the
+        signal, or None.
+        """
+        arrays = self.cache.get(self.key + tuple(key))
+        if arrays is None:
+            return None
+        return dict((name, value * value.dtype.type(self.scale))
+                    for name, value in arrays.iteritems())
+
+    def put(self, key, arrays):
+        """
+        Stores a dictionary of arrays computed from the scaled signal.
+        """
+        self.cache.put(self.key + tuple(key),
+                       dict((name, value / value.dtype.type(self.scale))
+                            for name, value in arrays.iteritems()))
+
+
+def read_cache_log(directory):
+    """
+    Returns the number of hits and misses and the hit rate of every iteration
+    logged in the STATS_FILE of a cache directory as a dictionary.
+
+    :param directory: The cache directory.
+    """
+    report = {}
+    try:
+        with open(os.path.join(directory, STATS_FILE)) as fh:
+            lines = fh.readlines()
+    except IOError:
+        return report
+
+    for line in lines:
+        iteration, _, hits, misses, _ = line.split()
+        entry = report.setdefault(iteration, {"hits": 0, "misses": 0})
+        entry["hits"] += int(hits)
+        entry["misses"] += int(misses)
+    for entry in report.itervalues():
+        lookups = entry["hits"] + entry["misses"]
+        entry["hit_rate"] = \
+            float(entry["hits"]) / lookups if lookups else 0.0
+    return report
@@ -9,68 +9,534 @@ Time frequency functions.
     GNU General Public License, Version 3
     (http://www.gnu.org/copyleft/gpl.html)
 """
+from collections import OrderedDict
+
 import numpy as np
 from scipy.interpolate import interp1d
+from scipy.interpolate import RectBivariateSpline
 
 import utils
 
-def time_frequency_transform(t, s, dt_new, width):
+# Upper bound on the number of elements of the windowed signal matrices that
+# are held in memory at once. The batched transforms work on chunks of rows
+# so the memory requirements stay bounded for long recordings.
+MAX_CHUNK_ELEMENTS = 2 ** 22
+
+# Real and complex dtypes of the supported precision modes. Single precision
+# halves the memory traffic of the transforms at the cost of accuracy.
+PRECISIONS = {"double": (np.float64, np.complex128),
+              "single": (np.float32, np.complex64)}
+
+
+def _chunks(n_rows, n_cols, chunk_size=None):
+    """
+    Generator yielding slices over the rows of a (n_rows x n_cols) matrix so
+    that each chunk has at most MAX_CHUNK_ELEMENTS elements.
+
+    :param n_rows: The number of rows.
+    :param n_cols: The number of columns.
+    :param chunk_size: Number of rows per chunk. Derived from
+        MAX_CHUNK_ELEMENTS if not given.
+    """
+    if chunk_size is None:
+        chunk_size = max(1, MAX_CHUNK_ELEMENTS // max(1, n_cols))
+    for start in xrange(0, n_rows, chunk_size):
+        yield slice(start, min(start + chunk_size, n_rows))
+
+
+def precision_dtypes(precision=None):
+    """
+    Returns the real and complex dtype of a precision mode.
+
+    :param precision: "double" or "single". Defaults to "double".
+    """
+    if precision is None:
+        precision = "double"
+    try:
+        return PRECISIONS[precision]
+    except KeyError:
+        raise ValueError("Unknown precision '%s'. Must be one of: %s" % (
+            precision, ", ".join(sorted(PRECISIONS))))
+
+
+def transform_parameters(min_period):
+    """
+    Returns the time increment and the width of the Gaussian window of the
+    time frequency transforms of the adjoint sources.
+
+    :param min_period: The minimum period of the data.
+    """
+    return float(int(min_period / 3.0)), 2.0 * min_period
+
+
+def truncation_support(tolerance):
+    """
+    Returns the half width of the truncated support of the Gaussian window in
+    units of the window width. Beyond it the window falls below tolerance
+    times its maximum.
+
+    :param tolerance: Relative amplitude below which the window is treated
+        as zero.
+    """
+    return np.sqrt(2.0 * np.log(1.0 / tolerance))
+
+
+class TransformPlan(object):
+    """
+    Everything a time frequency transform needs apart from the signal itself:
+    the tau and nu axes, the bank of Gaussian windows (one row per tau) and
+    the phase ramp exp(sign * 2 pi i t_min nu).
+
+    These only depend on the number of samples, the time increment,
+    the window width and the start time which are the same for all traces
+    of an iteration. All arrays are read-only as they are shared between
+    calls.
+
+    If support is given, the windows are truncated to the samples within
+    support times the width of the respective tau and only those are
+    stored as a banded kernel. This requires t and tau to share the start
+    time and sampling. It makes the multiplication with the windows and the
+    time integration of itfa O(N * W) instead of O(N^2). The windowed
+    signals are still zero padded to the full length and the cost of their
+    FFTs is unchanged.
+
+    If nu_band is given, only the non-negative frequencies within the band
+    are kept. The transforms then only compute the one-sided spectrum of the
+    real signals and return the columns in self.columns.
+
+    :param t: The (resampled) time axis of the signal.
+    :param tau: The time axis of the time frequency representation.
+    :param nu: The full frequency axis of the FFT.
+    :param width: Width of the Gaussian window.
+    :param sign: Sign of the exponent of the phase ramp.
+    :param support: Half width of the truncated windows in units of width.
+    :param nu_band: Tuple with the minimum and maximum frequency to keep.
+    :param dtype: Real dtype of the windows. The phase ramp has the complex
+        dtype of the same precision.
+    """
+
+    def __init__(self, t, tau, nu, width, sign, support=None, nu_band=None,
+                 dtype=np.float64):
+        self.n_fft = len(nu)
+        self.onesided = nu_band is not None
+        if self.onesided:
+            idx = np.where((nu >= nu_band[0]) & (nu <= nu_band[1]))[0]
+            idx = idx[idx <= self.n_fft // 2]
+            self.columns = slice(idx[0], idx[-1] + 1)
+        else:
+            self.columns = slice(0, self.n_fft)
+        nu = nu[self.columns]
+
+        self.t = t
+        self.tau = tau
+        self.nu = nu
+        self.phase_ramp = np.exp(sign * 2.0 * np.pi * 1j * tau[0] * nu)
+        self.phase_ramp = self.phase_ramp.astype(
+            np.result_type(dtype, np.complex64))
+
+        self.windows = None
+        self.offsets = None
+        self.kernel = None
+        if support is None:
+            self.windows = utils.gaussian_window(
+                t[np.newaxis, :] - tau[:, np.newaxis], width).astype(dtype)
+        else:
+            dt = t[1] - t[0]
+            n_half = int(support * width / dt)
+            self.offsets = np.arange(-n_half, n_half + 1)
+            self.kernel = utils.gaussian_window(
+                self.offsets * dt, width).astype(dtype)
+
+        for value in self.__dict__.values():
+            if isinstance(value, np.ndarray):
+                value.flags.writeable = False
+
+    @property
+    def nbytes(self):
+        """
+        Total size of the arrays of the plan in bytes.
+        """
+        return sum(value.nbytes for value in self.__dict__.values()
+                   if isinstance(value, np.ndarray))
+
+    def meshgrid(self):
+        """
+        Returns the tau and nu meshgrids of the transforms. They are not
+        stored in the plan as they are cheap to rebuild.
+        """
+        return np.meshgrid(self.tau, self.nu)
+
+    def window(self, rows, s):
+        """
+        Returns the windowed signals for a slice of tau values.
+
+        :param rows: Slice or array of tau indices.
+        :param s: The signal, sampled at t. May hold a stack of signals
+            along leading axes.
+        """
+        if self.windows is not None:
+            return self.windows[rows] * s[..., np.newaxis, :]
+
+        n = s.shape[-1]
+        k, j, valid = self._band(rows, n)
+        windowed = np.zeros(s.shape[:-1] + (len(k), n), dtype=s.dtype)
+        windowed[..., np.nonzero(valid)[0], j[valid]] = \
+            (self.kernel * s[..., np.clip(j, 0, n - 1)])[..., valid]
+        return windowed
+
+    def window_pairs(self, rows, s):
+        """
+        Returns the windowed signals for pairs of tau values and signals, the
+        window of rows[i] applied to s[i].
+
+        :param rows: Array of tau indices.
+        :param s: The signals, sampled at t, one per tau index.
+        """
+        if self.windows is not None:
+            return self.windows[rows] * s
+
+        n = s.shape[-1]
+        k, j, valid = self._band(rows, n)
+        windowed = np.zeros((len(k), n), dtype=s.dtype)
+        signals = np.arange(len(k))[:, np.newaxis]
+        windowed[np.nonzero(valid)[0], j[valid]] = \
+            (self.kernel * s[signals, np.clip(j, 0, n - 1)])[valid]
+        return windowed
+
+    def spectra(self, windowed):
+        """
+        Returns the kept frequencies of the FFT of windowed signals along the
+        last axis.
+
+        :param windowed: The windowed signals.
+        """
+        if self.onesided:
+            return utils.rfft(windowed)[..., self.columns]
+        return utils.fft(windowed)
+
+    def half_spectra(self, windowed):
+        """
+        Returns the kept non-negative frequencies of the n_fft point FFT of
+        windowed real signals along the last axis, all n_fft // 2 + 1 of them
+        without nu_band.
+
+        :param windowed: The windowed signals.
+        """
+        half = utils.rfft(windowed, self.n_fft)
+        return half[..., self.columns] if self.onesided else half
+
+    def cross_spectra(self, f, g):
+        """
+        Returns the kept frequencies of the spectra of the cross correlations
+        of two sets of windowed signals, given their half_spectra.
+
+        :param f: half_spectra of the windowed signals 1.
+        :param g: half_spectra of the windowed signals 2.
+        """
+        half = f * np.conj(g)
+        if self.onesided:
+            return half
+        return utils.hermitian_spectrum(half, self.n_fft)
+
+    def energy(self, s, chunk_size=None):
+        """
+        Returns the energy of the windowed signal for every tau value.
+
+        :param s: The signal, sampled at t. May hold a stack of signals
+            along leading axes.
+        :param chunk_size: Number of tau values windowed at once.
+        """
+        energy = np.empty(s.shape[:-1] + (len(self.tau),))
+        for rows in _chunks(len(self.tau), s.size, chunk_size):
+            energy[..., rows] = np.sum(self.window(rows, s) ** 2, axis=-1)
+        return energy
+
+    def integrate(self, I):
+        """
+        Gaussian weighted time integration of the inverse transform,
+        sum_j w(tau[k] - tau[j]) * I[j, k] for every k.
+
+        :param I: Inverse Fourier transform of the rows of a time frequency
+            representation. May hold a stack of them along leading axes.
+        """
+        if self.windows is not None:
+            return np.einsum("kj,...jk->...k", self.windows, I)
+
+        n = I.shape[-2]
+        k, j, valid = self._band(slice(0, I.shape[-1]), n)
+        values = I[..., np.clip(j, 0, n - 1), k[:, np.newaxis]]
+        return np.sum(np.where(valid, self.kernel * values, 0.0), axis=-1)
+
+    def _band(self, rows, n):
+        """
+        Indices of the samples within the truncated support of the windows of
+        the given rows.
+        """
+        if isinstance(rows, slice):
+            k = np.arange(rows.start, rows.stop)
+        else:
+            k = np.asarray(rows)
+        j = k[:, np.newaxis] + self.offsets
+        valid = (j >= 0) & (j < n)
+        return k, j, valid
+
+
+# Cache of transform plans, least recently used first. It is bounded by the
+# total size of the plans in bytes as the window bank of a single plan of
+# the cross correlations already holds (2N - 1) x N values.
+PLAN_CACHE_MAX_BYTES = 256 * 1024 ** 2
+PLAN_CACHE = OrderedDict()
+PLAN_CACHE_STATS = {"hits": 0, "misses": 0, "bytes": 0,
+                    "max_bytes": PLAN_CACHE_MAX_BYTES}
+
+
+def _evict_plans():
+    """
+    Drops the least recently used plans until the cache fits its budget.
+    """
+    while PLAN_CACHE and \
+            PLAN_CACHE_STATS["bytes"] > PLAN_CACHE_STATS["max_bytes"]:
+        _, plan = PLAN_CACHE.popitem(last=False)
+        PLAN_CACHE_STATS["bytes"] -= plan.nbytes
+
+
+def _get_plan(key, build):
+    """
+    Returns the plan for the given key from the cache, building it with
+    build() if necessary. A plan larger than the whole budget is returned
+    but not kept.
+
+    :param key: Tuple of the kind of transform and all parameters the plan
+        depends on.
+    :param build: Function returning a new TransformPlan.
+    """
+    plan = PLAN_CACHE.pop(key, None)
+    if plan is None:
+        PLAN_CACHE_STATS["misses"] += 1
+        plan = build()
+        PLAN_CACHE_STATS["bytes"] += plan.nbytes
+    else:
+        PLAN_CACHE_STATS["hits"] += 1
+    PLAN_CACHE[key] = plan
+    _evict_plans()
+    return plan
+
+
+def set_plan_cache_max_bytes(max_bytes):
+    """
+    Sets the budget of the transform plan cache in bytes and evicts the
+    plans beyond it. Applies to the current process and the worker
+    processes it forks afterwards.
+
+    :param max_bytes: The maximum total size of the cached plans.
+    """
+    PLAN_CACHE_STATS["max_bytes"] = max_bytes
+    _evict_plans()
+
+
+def plan_cache_info():
+    """
+    Returns a dictionary with the hits, misses, number of plans, their total
+    size and the budget in bytes of the transform plan cache.
+    """
+    info = dict(PLAN_CACHE_STATS)
+    info["size"] = len(PLAN_CACHE)
+    return info
+
+
+def clear_plan_cache():
+    """
+    Empties the transform plan cache and resets its counters.
+    """
+    PLAN_CACHE.clear()
+    PLAN_CACHE_STATS["hits"] = PLAN_CACHE_STATS["misses"] = 0
+    PLAN_CACHE_STATS["bytes"] = 0
+
+
+# Number of tau rows processed and skipped by the energy threshold of the
+# forward transforms.
+THRESHOLD_STATS = {"rows": 0, "skipped": 0}
+
+
+def active_rows(energy, threshold):
+    """
+    Returns the tau values whose windowed signal energy is at least threshold
+    times the maximum energy of the signal and updates THRESHOLD_STATS.
+
+    :param energy: The windowed signal energy for every tau value, with the
+        signals of a stack along leading axes.
+    :param threshold: Fraction of the maximum energy.
+    :returns: The indices of the signals within the flattened stack and the
+        indices of their tau values.
+    """
+    energy = energy.reshape(-1, energy.shape[-1])
+    signals, rows = np.nonzero(
+        energy >= threshold * energy.max(axis=-1)[:, np.newaxis])
+    THRESHOLD_STATS["rows"] += energy.size
+    THRESHOLD_STATS["skipped"] += energy.size - len(rows)
+    return signals, rows
+
+
+def threshold_info():
+    """
+    Returns a dictionary with the number of tau rows seen and skipped by the
+    energy threshold of the forward transforms.
+    """
+    return dict(THRESHOLD_STATS)
+
+
+def clear_threshold_info():
+    """
+    Resets the energy threshold counters.
     """
+    THRESHOLD_STATS["rows"] = THRESHOLD_STATS["skipped"] = 0
+
+
+def _transform_plan(t, dt_new, width, truncation, nu_band, real):
+    """
+    Returns the plan of time_frequency_transform for the resampled time
+    axis t.
+    """
+    N = len(t)
+    support = truncation_support(truncation) if truncation else None
+
+    def build():
+        nu = np.linspace(0, float(N - 1) / (N * dt_new), len(t))
+        return TransformPlan(t, t, nu, width, -1.0, support, nu_band, real)
+
+    return _get_plan(("transform", N, float(dt_new), float(width),
+                      float(t[0]), support, nu_band, np.dtype(real).name),
+                     build)
+
+
+def time_frequency_grid(t, dt_new, width, truncation=None, nu_band=None,
+                        precision=None):
+    """
+    Returns the tau and nu meshgrids of time_frequency_transform without
+    transforming a signal. Takes the same parameters.
+
     :param t: discrete time
-    :param s: discrete signal
     :param dt_new: time increment in the tf domain
     :param width: width of the Gaussian window
-    :param threshold: fraction of the absolute signal below which the Fourier
-        transform is set to zero in order to reduce computation time
+    """
+    ti = utils.matlab_range(t[0], t[-1], dt_new)
+    plan = _transform_plan(ti, dt_new, width, truncation, nu_band,
+                           precision_dtypes(precision)[0])
+    return plan.meshgrid()
+
+
+def time_frequency_transform(t, s, dt_new, width, chunk_size=None,
+                             truncation=None, nu_band=None, precision=None,
+                             threshold=None, cache=None):
+    """
+    :param t: discrete time
+    :param s: discrete signal, or a stack of signals along leading axes which
+        are transformed at once
+    :param dt_new: time increment in the tf domain
+    :param width: width of the Gaussian window
+    :param threshold: fraction of the maximum windowed signal energy below
+        which the Fourier transform of a tau value is set to zero in order to
+        reduce computation time
+    :param chunk_size: number of tau values transformed per FFT call. By
+        default chosen so that a chunk holds at most MAX_CHUNK_ELEMENTS
+        values.
+    :param truncation: if given, the Gaussian windows are truncated where
+        they drop below this fraction of their maximum. Only the windowing
+        gets cheaper, the FFTs still cover the full signal length.
+    :param nu_band: tuple (nu_min, nu_max). If given, only the non-negative
+        frequencies within the band are computed and returned.
+    :param precision: "double" (default) or "single". In single precision
+        the transform is computed and returned as complex64.
+    :param cache: tf_cache.CachedSignal of s. If given, the transform is
+        read from the cache or computed and stored in it.
     """
     # New time axis
     ti = utils.matlab_range(t[0], t[-1], dt_new)
+    real, complex_ = precision_dtypes(precision)
+    plan = _transform_plan(ti, dt_new, width, truncation, nu_band, real)
+
+    if cache is not None:
+        cache_key = ("transform", len(ti), float(dt_new), float(width),
+                     float(t[0]), truncation, nu_band, np.dtype(real).name,
+                     threshold)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            TAU, NU = plan.meshgrid()
+            return TAU, NU, cached["tfs"]
+
     # Interpolate both signals to the new time axis
-    si = interp1d(t, s, kind=1)(ti)
+    si = interp1d(t, s, kind=1)(ti).astype(real, copy=False)
 
     # Rename some variables
     t = ti
     s = si
-    t_min = t[0]
 
     # Initialize the meshgrid
     N = len(t)
 
-    nu = np.linspace(0, float(N - 1) / (N * dt_new), len(t))
-    tau = t
-    TAU, NU = np.meshgrid(tau, nu)
+    tau = plan.tau
+    phase_ramp = plan.phase_ramp
 
-    # Compute the time frequency representation
-    tfs = np.zeros(NU.shape, dtype="complex128")
+    # Compute the time frequency representation. All Gaussian windows of a
+    # chunk of tau values are applied at once and the windowed signals are
+    # transformed with a single FFT call along the last axis.
+    tfs = np.zeros(s.shape[:-1] + (len(tau), len(plan.nu)), dtype=complex_)
+    if threshold:
+        # Only the tau values above the threshold of their signal are
+        # transformed.
+        signals, rows = active_rows(plan.energy(s, chunk_size), threshold)
+        s_flat = s.reshape(-1, N)
+        tfs_flat = tfs.reshape(-1, len(tau), len(plan.nu))
+        for pairs in _chunks(len(rows), N, chunk_size):
+            tfs_flat[signals[pairs], rows[pairs]] = plan.spectra(
+                plan.window_pairs(rows[pairs], s_flat[signals[pairs]]))
+    else:
+        for rows in _chunks(len(tau), s.size, chunk_size):
+            # Window the signals
+            tfs[..., rows, :] = plan.spectra(plan.window(rows, s))
 
-    for k in xrange(len(tau)):
-        # Window the signals
-        w = utils.gaussian_window(t - tau[k], width)
-        f = w * s
+    tfs *= phase_ramp * (dt_new / np.sqrt(2.0 * np.pi))
 
-        tfs[k, :] = np.fft.fft(f) / np.sqrt(2.0 * np.pi) * dt_new
-        tfs[k, :] = tfs[k, :] * np.exp(-2.0 * np.pi * 1j * t_min * nu)
+    if cache is not None:
+        cache.put(cache_key, {"tfs": tfs})
 
+    TAU, NU = plan.meshgrid()
     return TAU, NU, tfs
 
 
-def time_frequency_cc_difference(t, s1, s2, dt_new, width):
+def time_frequency_cc_difference(t, s1, s2, dt_new, width, chunk_size=None,
+                                 truncation=None, nu_band=None,
+                                 precision=None, threshold=None, cache=None):
     """
     Straight port of tfa_cc_new.m
 
     :param t: discrete time
-    :param s1: discrete signal 1
-    :param s2: discrete signal 2
+    :param s1: discrete signal 1, or a stack of signals along leading axes
+    :param s2: discrete signal 2, same shape as s1
     :param dt_new: time increment in the tf domain
     :param width: width of the Gaussian window
-    :param threshold: fraction of the absolute signal below which the Fourier
-        transform is set to zero in order to reduce computation time
+    :param threshold: fraction of the maximum windowed signal energy below
+        which the Fourier transform of a tau value is set to zero in order to
+        reduce computation time
+    :param chunk_size: number of tau values transformed per FFT call. By
+        default chosen so that a chunk holds at most MAX_CHUNK_ELEMENTS
+        values.
+    :param truncation: if given, the Gaussian windows are truncated where
+        they drop below this fraction of their maximum. Only the windowing
+        gets cheaper, the FFTs still cover the full signal length.
+    :param nu_band: tuple (nu_min, nu_max). If given, only the non-negative
+        frequencies within the band are computed and returned.
+    :param precision: "double" (default) or "single". In single precision
+        the transform is computed and returned as complex64.
+    :param cache: tf_cache.CachedSignal of s1. If given, the spectra of the
+        windowed s1 are read from the cache or computed and stored in it.
     """
     # New time axis
     ti = utils.matlab_range(t[0], t[-1], dt_new)
+    real, complex_ = precision_dtypes(precision)
     # Interpolate both signals to the new time axis
-    si1 = interp1d(t, s1, kind=1)(ti)
-    si2 = interp1d(t, s2, kind=1)(ti)
+    si1 = interp1d(t, s1, kind=1)(ti).astype(real, copy=False)
+    si2 = interp1d(t, s2, kind=1)(ti).astype(real, copy=False)
 
     # Extend the time axis, required for the correlation
     N = len(ti)
@@ -82,30 +548,152 @@ def time_frequency_cc_difference(t, s1, s2, dt_new, width):
     t_min = t_cc[0]
 
     # Initialize the meshgrid
-    N = len(t_cc)
-    dnu = 1.0 / (N * dt_new)
+    n_cc = len(t_cc)
+
+    support = truncation_support(truncation) if truncation else None
+
+    def build():
+        dnu = 1.0 / (n_cc * dt_new)
+        nu = np.linspace(0, (n_cc - 1) * dnu, n_cc)
+        return TransformPlan(ti, t_cc, nu, width, -1.0, support, nu_band,
+                             real)
 
-    nu = np.linspace(0, (N - 1) * dnu, N)
-    tau = t_cc
-    TAU, NU = np.meshgrid(tau, nu)
+    plan_key = ("cc_difference", N, float(dt_new), float(width),
+                float(t_min), support, nu_band, np.dtype(real).name)
+    plan = _get_plan(plan_key, build)
+    tau = plan.tau
+    phase_ramp = plan.phase_ramp
 
-    # Compute the time frequency representation
-    tfs = np.zeros(NU.shape, dtype="complex128")
+    # The real FFTs of the windowed s1 of all tau values. Only computed
+    # up front if they are cached, otherwise chunk by chunk below.
+    spectra1 = None
+    if cache is not None:
+        cached = cache.get(plan_key)
+        if cached is not None:
+            spectra1 = cached["spectra"]
+        else:
+            n_half = len(plan.nu) if plan.onesided else n_cc // 2 + 1
+            spectra1 = np.empty(s1.shape[:-1] + (len(tau), n_half),
+                                dtype=complex_)
+            for rows in _chunks(len(tau), s1.size, chunk_size):
+                spectra1[..., rows, :] = plan.half_spectra(
+                    plan.window(rows, s1))
+            cache.put(plan_key, {"spectra": spectra1})
 
-    for k in xrange(len(tau)):
-        # Window the signals
-        w = utils.gaussian_window(ti - tau[k], width)
-        f1 = w * s1
-        f2 = w * s2
+    # Compute the time frequency representation. The Fourier transform of
+    # the cross correlation of each windowed pair is the cross spectrum of
+    # the zero padded signals so it is computed directly from their real
+    # FFTs for a whole chunk of tau values at once.
+    tfs = np.zeros(s1.shape[:-1] + (len(tau), len(plan.nu)), dtype=complex_)
+    if threshold:
+        # The correlation of a pair is negligible if either windowed signal
+        # is, so the geometric mean of both energies is thresholded.
+        signals, rows = active_rows(np.sqrt(plan.energy(s1, chunk_size) *
+                                            plan.energy(s2, chunk_size)),
+                                    threshold)
+        s1_flat, s2_flat = s1.reshape(-1, N), s2.reshape(-1, N)
+        tfs_flat = tfs.reshape(-1, len(tau), len(plan.nu))
+        for pairs in _chunks(len(rows), N, chunk_size):
+            signal, row = signals[pairs], rows[pairs]
+            if spectra1 is None:
+                half1 = plan.half_spectra(plan.window_pairs(row,
+                                                            s1_flat[signal]))
+            else:
+                half1 = spectra1.reshape((-1,) + spectra1.shape[-2:])[
+                    signal, row]
+            tfs_flat[signal, row] = plan.cross_spectra(
+                plan.half_spectra(plan.window_pairs(row, s2_flat[signal])),
+                half1)
+    else:
+        for rows in _chunks(len(tau), s1.size, chunk_size):
+            # Window the signals
+            if spectra1 is None:
+                half1 = plan.half_spectra(plan.window(rows, s1))
+            else:
+                half1 = spectra1[..., rows, :]
+            tfs[..., rows, :] = plan.cross_spectra(
+                plan.half_spectra(plan.window(rows, s2)), half1)
 
-        cc = utils.cross_correlation(f2, f1)
-        tfs[k, :] = np.fft.fft(cc) / np.sqrt(2.0 * np.pi) * dt_new
-        tfs[k, :] = tfs[k, :] * np.exp(-2.0 * np.pi * 1j * t_min * nu)
+    tfs *= phase_ramp * (dt_new / np.sqrt(2.0 * np.pi))
 
+    TAU, NU = plan.meshgrid()
     return TAU, NU, tfs
 
 
-def itfa(TAU, NU, tfs, width):
+def cc_difference_on_grid(TAU, NU, tfs1, tfs2):
+    """
+    The time frequency representation of the cross correlation of two
+    signals as computed by time_frequency_cc_difference, but evaluated on the
+    tau/nu grid of their own time frequency transforms.
+
+    At the frequencies of the N point transforms the spectrum of the
+    correlation of two windowed signals is the product of their spectra, so
+    no transform of the 2N - 1 point correlation and no interpolation is
+    needed.
+
+    :param TAU: tau meshgrid of the transforms of both signals
+    :param NU: nu meshgrid of the transforms of both signals
+    :param tfs1: time frequency transform of signal 1
+    :param tfs2: time frequency transform of signal 2
+    """
+    tau = TAU[0, :]
+    nu = NU[:, 0]
+    dt = tau[1] - tau[0]
+    # The phase ramps of both transforms cancel, the correlation has its
+    # own one.
+    factor = np.sqrt(2.0 * np.pi) / dt * \
+        np.exp(-2.0 * np.pi * 1j * tau[0] * nu)
+    tfs = np.conj(tfs1)
+    tfs *= tfs2
+    tfs *= factor.astype(tfs.dtype)
+    return tfs
+
+
+def interpolate_to_grid(TAU_in, NU_in, tfs, TAU, NU):
+    """
+    Bilinear interpolation of a time frequency representation to another
+    tau/nu grid, separately for the real and the imaginary part.
+
+    :param TAU_in: tau meshgrid of tfs
+    :param NU_in: nu meshgrid of tfs
+    :param tfs: the time frequency representation, or a stack of them along
+        leading axes
+    :param TAU: tau meshgrid to interpolate to
+    :param NU: nu meshgrid to interpolate to
+    """
+    tau_in, nu_in = TAU_in[0], NU_in[:, 0]
+    tau, nu = TAU[0], NU[:, 0]
+    out = np.empty(tfs.shape[:-2] + (len(tau), len(nu)), dtype=tfs.dtype)
+    for i in np.ndindex(tfs.shape[:-2]):
+        out[i].real = RectBivariateSpline(tau_in, nu_in, tfs[i].real, kx=1,
+                                          ky=1, s=0)(tau, nu)
+        out[i].imag = RectBivariateSpline(tau_in, nu_in, tfs[i].imag, kx=1,
+                                          ky=1, s=0)(tau, nu)
+    return out
+
+
+def itfa(TAU, NU, tfs, width, in_place=False, truncation=None):
+    """
+    Inverse time frequency transform.
+
+    :param TAU: tau meshgrid as returned by the forward transforms
+    :param NU: nu meshgrid as returned by the forward transforms
+    :param tfs: the time frequency representation, or a stack of them along
+        leading axes
+    :param width: width of the Gaussian window
+    :param in_place: apply the phase ramp directly to tfs instead of a copy.
+        Saves one array of the size of tfs but modifies the input.
+    :param truncation: if given, the Gaussian windows of the time
+        integration are truncated where they drop below this fraction of
+        their maximum.
+
+    If tfs only holds a band of non-negative frequencies, as returned by the
+    forward transforms with nu_band, the remaining frequencies are taken to
+    be zero.
+
+    The inverse transform is computed in the precision of tfs, i.e. in
+    single precision for complex64 input.
+    """
     # initialisation
     tau = TAU[0, :]
     nu = NU[:, 0]
@@ -117,23 +705,76 @@ def itfa(TAU, NU, tfs, width):
     # Frequenzachse: tfs(:,1)
     t_min = tau[0]
 
-    for k in xrange(len(tau)):
-        tfs[k, :] = tfs[k, :] * np.exp(2.0 * np.pi * 1j * nu.transpose() *
-                                       t_min)
+    support = truncation_support(truncation) if truncation else None
+    real = np.finfo(tfs.dtype).dtype
+    plan = _get_plan(("inverse", N, float(dt), float(width), float(t_min),
+                      support, len(nu), float(nu[0]), real.name),
+                     lambda: TransformPlan(tau, tau, nu, width, 1.0, support,
+                                           dtype=real))
 
-    # inverse fft
-    I = np.zeros((N, N), dtype="complex128")
+    if in_place:
+        tfs *= plan.phase_ramp
+    else:
+        tfs = tfs * plan.phase_ramp
 
-    for k in xrange(N):
-        I[k, :] = 2.0 * np.pi * np.fft.ifft(tfs[k, :]) / dt
+    # Zero fill the frequencies outside of the band.
+    if len(nu) != N:
+        first = int(round(nu[0] * N * dt))
+        full = np.zeros(tfs.shape[:-1] + (N,), dtype=tfs.dtype)
+        full[..., first:first + len(nu)] = tfs
+        tfs = full
 
-    # time integration
-    s = np.zeros(N, dtype="complex128")
+    # inverse fft of all rows at once
+    I = utils.ifft(tfs)
+    I *= 2.0 * np.pi / dt
 
-    for k in xrange(N):
-        f = utils.gaussian_window(tau[k] - tau, width) * I[:, k].transpose()
-        s[k] = np.sum(f) * dt
+    # time integration: s[k] = sum_j w(tau[k] - tau[j]) * I[j, k] * dt
+    s = plan.integrate(I) * dt
 
     s /= np.sqrt(2.0 * np.pi)
 
     return s, tau, I
+
+
+def truncation_accuracy_report(t, s1, s2, dt_new, width,
+                               tolerances=(1E-2, 1E-4, 1E-6, 1E-8)):
+    """
+    Compares the truncated transforms to the full computation for a number
+    of truncation tolerances. Meant to choose the truncation for production
+    runs on representative traces. The truncation only speeds up the
+    windowing and the inverse transform, not the FFTs of the forward
+    transforms.
+
+    Returns a list of dictionaries, one per tolerance, with the support in
+    units of the window width and the maximum errors of the forward, cross
+    correlation and inverse transforms relative to the maximum absolute
+    value of the full result.
+
+    :param t: discrete time
+    :param s1: discrete signal 1, e.g. the data
+    :param s2: discrete signal 2, e.g. the synthetic
+    :param dt_new: time increment in the tf domain
+    :param width: width of the Gaussian window
+    :param tolerances: the truncation tolerances to test
+    """
+    def rel_error(approx, exact):
+        return np.abs(approx - exact).max() / np.abs(exact).max()
+
+    TAU, NU, tf_ref = time_frequency_transform(t, s2, dt_new, width)
+    _, _, cc_ref = time_frequency_cc_difference(t, s1, s2, dt_new, width)
+    inv_ref = itfa(TAU, NU, tf_ref, width)[0]
+
+    report = []
+    for tolerance in tolerances:
+        tf = time_frequency_transform(t, s2, dt_new, width,
+                                      truncation=tolerance)[2]
+        cc = time_frequency_cc_difference(t, s1, s2, dt_new, width,
+                                          truncation=tolerance)[2]
+        inv = itfa(TAU, NU, tf_ref, width, truncation=tolerance)[0]
+        report.append({
+            "tolerance": tolerance,
+            "support": truncation_support(tolerance),
+            "transform_error": rel_error(tf, tf_ref),
+            "cc_difference_error": rel_error(cc, cc_ref),
+            "itfa_error": rel_error(inv, inv_ref)})
+    return report
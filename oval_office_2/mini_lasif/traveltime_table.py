@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Precomputed table of first arrival P traveltimes.
+
+The window selection needs the first arrival of every trace. Instead of
+calling TauPy per trace, the traveltimes are computed once per project on a
+grid of source depths and epicentral distances, stored as a small .npz file
+and bilinearly interpolated.
+
+:license:
+    GNU General Public License, Version 3
+    (http://www.gnu.org/copyleft/gpl.html)
+"""
+import os
+import tempfile
+
+import numpy as np
+
+# Default grid of the table. Depths in km, distances in degree.
+DEFAULT_DEPTHS = np.arange(0.0, 701.0, 10.0)
+DEFAULT_DISTANCES = np.arange(0.0, 180.01, 0.5)
+
+# Tables loaded by this process, by filename.
+FIRST_ARRIVAL_TABLES = {}
+
+# TauPyModels created by this process, by name.
+TAUPY_MODELS = {}
+
+
+def _taupy_model(model):
+    if model not in TAUPY_MODELS:
+        from obspy.taup import TauPyModel  # NOQA
+        TAUPY_MODELS[model] = TauPyModel(model)
+    return TAUPY_MODELS[model]
+
+
+def first_arrival(depth_in_km, distance_in_degree, model="AK135"):
+    """
+    Returns the time of the first P arrival ("ttp" phases) computed with
+    TauPy, NaN if there is none.
+
+    :param depth_in_km: The source depth in km.
+    :param distance_in_degree: The epicentral distance in degree.
+    :param model: Name of the TauPy model.
+    """
+    arrivals = _taupy_model(model).get_travel_times(
+        source_depth_in_km=depth_in_km,
+        distance_in_degree=distance_in_degree, phase_list=["ttp"])
+    if not arrivals:
+        return np.nan
+    return min(arrival.time for arrival in arrivals)
+
+
+def first_arrival_row((depth_in_km, distances, model)):
+    """
+    Returns the first arrivals of one source depth at all distances. Takes a
+    single tuple so it can be mapped over the depths of a table, e.g. on
+    ipyparallel engines.
+    """
+    return [first_arrival(depth_in_km, distance, model)
+            for distance in distances]
+
+
+class FirstArrivalTable(object):
+    """
+    Bilinear interpolation of first arrival times on a regular grid of
+    source depths and epicentral distances.
+
+    :param depths: Regularly spaced source depths in km.
+    :param distances: Regularly spaced epicentral distances in degree.
+    :param times: First arrival times in seconds, shape (len(depths),
+        len(distances)).
+    :param model: Name of the TauPy model the times were computed with.
+    """
+
+    def __init__(self, depths, distances, times, model="AK135"):
+        self.depths = np.asarray(depths, dtype=np.float64)
+        self.distances = np.asarray(distances, dtype=np.float64)
+        self.times = np.asarray(times, dtype=np.float64)
+        self.model = str(model)
+
+    @classmethod
+    def from_file(cls, filename):
+        """
+        Reads a table written by save().
+        """
+        with np.load(filename) as npz:
+            return cls(npz["depths"], npz["distances"], npz["times"],
+                       npz["model"][()])
+
+    def save(self, filename):
+        """
+        Writes the table to a .npz file. Written to a temporary file and
+        renamed, so processes reading it never see a partial file.
+        """
+        fd, tmp_path = tempfile.mkstemp(
+            suffix=".tmp", dir=os.path.dirname(os.path.abspath(filename)))
+        with os.fdopen(fd, "wb") as fh:
+            np.savez(fh, depths=self.depths, distances=self.distances,
+                     times=self.times, model=np.array(self.model))
+        os.rename(tmp_path, filename)
+
+    def contains(self, depth_in_km, distance_in_degree):
+        """
+        Returns True where the depth and distance are within the table. Both
+        arguments may also be arrays of the same shape.
+        """
+        depth_in_km = np.asarray(depth_in_km, dtype=np.float64)
+        distance_in_degree = np.asarray(distance_in_degree, dtype=np.float64)
+        return ((depth_in_km >= self.depths[0]) &
+                (depth_in_km <= self.depths[-1]) &
+                (distance_in_degree >= self.distances[0]) &
+                (distance_in_degree <= self.distances[-1]))
+
+    @staticmethod
+    def _cell(axis, values, name):
+        values = np.asarray(values, dtype=np.float64)
+        if np.any((values < axis[0]) | (values > axis[-1])):
+            raise ValueError("%s outside of the table range %g to %g." % (
+                name, axis[0], axis[-1]))
+        step = axis[1] - axis[0]
+        index = np.clip(((values - axis[0]) // step).astype(np.int64), 0,
+                        len(axis) - 2)
+        return index, (values - axis[index]) / step
+
+    def __call__(self, depth_in_km, distance_in_degree):
+        """
+        Returns the interpolated first arrival time. Both arguments may also
+        be arrays of the same shape.
+
+        :param depth_in_km: The source depth in km.
+        :param distance_in_degree: The epicentral distance in degree.
+        """
+        i, u = self._cell(self.depths, depth_in_km, "Depth")
+        j, v = self._cell(self.distances, distance_in_degree, "Distance")
+        times = self.times
+        return ((1.0 - u) * ((1.0 - v) * times[i, j] + v * times[i, j + 1]) +
+                u * ((1.0 - v) * times[i + 1, j] + v * times[i + 1, j + 1]))
+
+
+def build_first_arrival_table(filename, depths=DEFAULT_DEPTHS,
+                              distances=DEFAULT_DISTANCES, model="AK135",
+                              map_function=map):
+    """
+    Computes the first arrivals on a grid with TauPy, writes the table to
+    filename and returns it.
+
+    :param filename: The .npz file to write.
+    :param depths: Regularly spaced source depths in km.
+    :param distances: Regularly spaced epicentral distances in degree.
+    :param model: Name of the TauPy model.
+    :param map_function: Function used to map first_arrival_row over the
+        depths, e.g. the map_sync of an ipyparallel view.
+    """
+    rows = map_function(first_arrival_row,
+                        [(depth, list(distances), model) for depth in depths])
+    table = FirstArrivalTable(depths, distances, rows, model)
+    table.save(filename)
+    return table
+
+
+def load_first_arrival_table(filename):
+    """
+    Returns the table stored in filename. Every process only reads it once.
+    """
+    if filename not in FIRST_ARRIVAL_TABLES:
+        FIRST_ARRIVAL_TABLES[filename] = FirstArrivalTable.from_file(filename)
+    return FIRST_ARRIVAL_TABLES[filename]
+
+
+def validate_first_arrival_table(table, n_points=1000, seed=12345):
+    """
+    Compares the interpolated first arrivals at random depths and distances
+    within the table with TauPy.
+
+    Returns a dictionary with the maximum and mean absolute error in seconds
+    and the depth and distance of the maximum error.
+
+    :param table: The FirstArrivalTable.
+    :param n_points: Number of random points.
+    :param seed: Seed of the random points.
+    """
+    rng = np.random.RandomState(seed)
+    depths = rng.uniform(table.depths[0], table.depths[-1], n_points)
+    distances = rng.uniform(table.distances[0], table.distances[-1],
+                            n_points)
+    reference = np.array([first_arrival(depth, distance, table.model)
+                          for depth, distance in zip(depths, distances)])
+    errors = np.abs(table(depths, distances) - reference)
+    # Points without an arrival in either are not compared.
+    errors = np.where(np.isnan(errors), 0.0, errors)
+    worst = errors.argmax()
+    return {"max_error": errors[worst],
+            "mean_error": errors.mean(),
+            "depth_in_km": depths[worst],
+            "distance_in_degree": distances[worst]}
@@ -10,6 +10,8 @@ Some functionality useful for calculating the adjoint sources.
     (http://www.gnu.org/copyleft/gpl.html)
 """
 import numpy as np
+import scipy.fftpack
+from obspy.signal.invsim import cosine_taper
 
 
 def matlab_range(start, stop, step):
@@ -98,6 +100,151 @@ def cross_correlation(f, g):
     return cc_new
 
 
+def next_power_of_two(n):
+    """
+    Returns the smallest power of two that is larger or equal to n.
+    """
+    return 1 << int(np.ceil(np.log2(max(n, 1))))
+
+
+def fft(x, n=None):
+    """
+    FFT along the last axis. Single precision input is transformed in single
+    precision with scipy.fftpack as numpy always computes in double
+    precision.
+
+    :param x: The signals.
+    :param n: Length of the transform. Defaults to the length of x.
+    """
+    if x.dtype in (np.float32, np.complex64):
+        return scipy.fftpack.fft(x, n, axis=-1)
+    return np.fft.fft(x, n, axis=-1)
+
+
+def rfft(x, n=None):
+    """
+    The n // 2 + 1 non-negative frequencies of the FFT of real signals along
+    the last axis, like np.fft.rfft. Single precision input stays in single
+    precision.
+
+    :param x: The signals.
+    :param n: Length of the transform. Defaults to the length of x.
+    """
+    if x.dtype == np.float32:
+        n = x.shape[-1] if n is None else n
+        return scipy.fftpack.fft(x, n, axis=-1)[..., :n // 2 + 1]
+    return np.fft.rfft(x, n, axis=-1)
+
+
+def ifft(x):
+    """
+    Inverse FFT along the last axis. Single precision input stays in single
+    precision.
+
+    :param x: The spectra.
+    """
+    if x.dtype == np.complex64:
+        return scipy.fftpack.ifft(x, axis=-1)
+    return np.fft.ifft(x, axis=-1)
+
+
+def fft_cross_correlation(f, g):
+    """
+    FFT based version of cross_correlation(). Works on the last axis so a
+    whole stack of signal pairs can be correlated at once.
+
+    Both signals are zero padded to a power of two length of at least
+    2 * N - 1 so the circular correlation of the real FFTs equals the
+    linear one. The result is arranged in the same shifted layout as
+    returned by cross_correlation(): non-negative lags first, followed by the
+    negative lags.
+
+    :type f: numpy array
+    :param f: function 1, shape (..., N)
+    :type g: numpy array
+    :param g: function 2, same shape as f
+    """
+    N = f.shape[-1]
+    n_fft = next_power_of_two(2 * N - 1)
+    cc = np.fft.irfft(np.fft.rfft(f, n_fft, axis=-1) *
+                      np.conj(np.fft.rfft(g, n_fft, axis=-1)),
+                      n_fft, axis=-1)
+    return np.concatenate([cc[..., :N], cc[..., n_fft - N + 1:]], axis=-1)
+
+
+def hermitian_spectrum(half, n):
+    """
+    Returns the full n point spectrum of a real signal from its n // 2 + 1
+    non-negative frequencies. Works on the last axis.
+
+    :param half: The non-negative frequencies of the spectrum.
+    :param n: The length of the spectrum.
+    """
+    n_neg = n - half.shape[-1]
+    return np.concatenate(
+        [half, np.conj(half[..., n_neg:0:-1])], axis=-1)
+
+
+# Margin around a window, in units of the width of the Gaussian window, that
+# is included in window local time frequency transforms.
+WINDOW_MARGIN = 6.0
+
+
+def window_segment(t, offset, length, width, dt_new):
+    """
+    Returns the first and one past the last sample of a window extended by
+    WINDOW_MARGIN Gaussian window widths on both sides, clipped to the time
+    axis.
+
+    The segment starts at the sample closest to a point of the resampled
+    time axis matlab_range(t[0], t[-1], dt_new) of the full trace, so the
+    segment is resampled at (nearly) the same times as the full trace.
+
+    :param t: The time axis of the full trace.
+    :param offset: Index of the first sample of the window.
+    :param length: Number of samples of the window.
+    :param width: Width of the Gaussian window.
+    :param dt_new: Time increment of the time frequency transforms.
+    """
+    dt = t[1] - t[0]
+    margin = int(np.ceil(WINDOW_MARGIN * width / dt))
+    start = np.floor((t[max(0, offset - margin)] - t[0]) / dt_new) * dt_new
+    first = int(round(start / dt))
+    return first, min(len(t), offset + length + margin)
+
+
+def pad_segment(x, offset, length):
+    """
+    Returns x zero padded to the given length with its first sample at
+    offset.
+
+    :param x: The samples.
+    :param offset: Index of the first sample of x in the padded array.
+    :param length: Length of the padded array.
+    """
+    padded = np.zeros(length, dtype=x.dtype)
+    padded[offset:offset + len(x)] = x
+    return padded
+
+
+def window_taper(npts, max_percentage):
+    """
+    Returns the cosine taper of a window of npts samples, the same as applied
+    by obspy's Trace.taper(max_percentage, type="cosine").
+
+    :param npts: Number of samples of the window.
+    :param max_percentage: Length of the taper on either side as a fraction
+        of npts.
+    """
+    wlen = min(int(max_percentage * npts), int(npts / 2))
+    if 2 * wlen == npts:
+        sides = cosine_taper(2 * wlen, p=1.0)
+    else:
+        sides = cosine_taper(2 * wlen + 1, p=1.0)
+    return np.hstack((sides[:wlen], np.ones(npts - 2 * wlen),
+                      sides[len(sides) - wlen:]))
+
+
 def gaussian_window(y, width):
     """
     Returns a simple gaussian window along a given axis.
@@ -109,3 +256,20 @@ def gaussian_window(y, width):
     """
     return 1.0 / (np.pi * width ** 2) ** (0.25) * \
         np.exp(-0.5 * y ** 2 / width ** 2)
+
+
+def weighting_band(min_period, max_period, tolerance):
+    """
+    Returns the frequency band outside of which the spectral weighting of the
+    time frequency phase misfit drops below tolerance, i.e. where
+    1 - exp(-(nu * max_period) ** 2) < tolerance at the low end and
+    exp(-10 * (nu * min_period - 1)) < tolerance at the high end.
+
+    :param min_period: The minimum period of the data.
+    :param max_period: The maximum period of the data.
+    :param tolerance: The relative weight below which frequencies are
+        dropped.
+    """
+    nu_min = np.sqrt(-np.log(1.0 - tolerance)) / max_period
+    nu_max = (1.0 + np.log(1.0 / tolerance) / 10.0) / min_period
+    return nu_min, nu_max
@@ -18,26 +18,36 @@ is applied, progressively excluding more and more time steps.
     GNU General Public License, Version 3
     (http://www.gnu.org/copyleft/gpl.html)
 """
-import itertools
 import math
+import time
 
 import numpy as np
-import obspy.signal.filter
+from numpy.lib.stride_tricks import as_strided
 from obspy.core.util import geodetics
+import scipy.fftpack
 from scipy.signal import argrelextrema
 
-
-def flatnotmasked_contiguous(time_windows):
-    """
-    Helper function enabling to loop over empty time windows.
-    """
-    fc = np.ma.flatnotmasked_contiguous(time_windows)
-    # If nothing could be found, set the mask to true (which should already
-    # be the case).
-    if fc is None:
-        return []
-    else:
-        return fc
+import intervals
+import traveltime_table
+from geodesy import event_station_distances
+
+# Maximum number of samples of the tapered windows of data and synthetics
+# held at once by the sliding window cross correlation.
+MAX_SLIDING_CHUNK_ELEMENTS = 2 ** 21
+
+# The thresholds of the window selection with the defaults of
+# select_windows(), see select_windows_sweep().
+SELECTION_PARAMETERS = {
+    "min_cc": 0.10,
+    "max_noise": 0.10,
+    "max_noise_window": 0.4,
+    "min_velocity": 2.4,
+    "threshold_shift": 0.30,
+    "threshold_correlation": 0.75,
+    "min_length_period": 1.5,
+    "min_peaks_troughs": 2,
+    "max_energy_ratio": 10.0,
+    "min_envelope_similarity": 0.2}
 
 
 def find_local_extrema(data):
@@ -50,88 +60,73 @@ def find_local_extrema(data):
     """
     length = len(data) - 1
     diff = np.diff(data)
-    flats = np.argwhere(diff == 0)
-
-    # Discard neighbouring flat points.
-    new_flats = list(flats[0:1])
-    for i, j in zip(flats[:-1], flats[1:]):
-        if j - i == 1:
-            continue
-        new_flats.append(j)
-    flats = new_flats
-
-    maxima = []
-    minima = []
-
-    # Go over each flats position and check if its a maxima/minima.
-    for idx in flats:
-        l_type = "left"
-        r_type = "right"
-        for i in itertools.count():
-            this_idx = idx - i - 1
-            if diff[this_idx] < 0:
-                l_type = "minima"
-                break
-            elif diff[this_idx] > 0:
-                l_type = "maxima"
-                break
-        for i in itertools.count():
-            this_idx = idx + i + 1
-            if this_idx >= len(diff):
-                break
-            if diff[this_idx] < 0:
-                r_type = "maxima"
-                break
-            elif diff[this_idx] > 0:
-                r_type = "minima"
-                break
-        if r_type != l_type:
-            continue
-        if r_type == "maxima":
-            maxima.append(int(idx))
-        else:
-            minima.append(int(idx))
-
-    maxs = set(list(argrelextrema(data, np.greater)[0]))
-    mins = set(list(argrelextrema(data, np.less)[0]))
+    sign = np.sign(diff)
+
+    # First index of every plateau, i.e. of every run of zero differences.
+    flat = sign == 0
+    flats = np.flatnonzero(flat & ~np.concatenate([[False], flat[:-1]]))
+
+    # A plateau is an extremum if the differences next to it have opposite
+    # signs. Left of a plateau at the start of the data the last non-zero
+    # difference of the data is used, plateaus at the end are no extrema.
+    slopes = np.flatnonzero(~flat)
+    if len(slopes):
+        right = np.searchsorted(slopes, flats)
+        at_end = right == len(slopes)
+        right_sign = sign[slopes[np.minimum(right, len(slopes) - 1)]]
+        right_sign[at_end] = 0
+        left_sign = sign[np.where(flats > 0, flats - 1, slopes[-1])]
+        maxima = flats[(left_sign > 0) & (right_sign < 0)]
+        minima = flats[(left_sign < 0) & (right_sign > 0)]
+    else:
+        maxima = minima = flats[:0]
 
-    peaks, troughs = (
-        sorted(list(maxs.union(set(maxima)))),
-        sorted(list(mins.union(set(minima)))))
+    peaks = np.union1d(argrelextrema(data, np.greater)[0], maxima)
+    troughs = np.union1d(argrelextrema(data, np.less)[0], minima)
+    peaks, troughs = peaks.astype(np.int32), troughs.astype(np.int32)
 
     # Special case handling for missing one or the other.
-    if not peaks and not troughs:
-        return np.array([], dtype=np.int32), np.array([], dtype=np.int32)
-    elif not peaks:
-        if 0 not in troughs:
-            peaks.insert(0, 0)
-        if length not in troughs:
-            peaks.append(length)
-        return (np.array(peaks, dtype=np.int32),
-                np.array(troughs, dtype=np.int32))
-    elif not troughs:
-        if 0 not in peaks:
-            troughs.insert(0, 0)
-        if length not in peaks:
-            troughs.append(length)
-        return (np.array(peaks, dtype=np.int32),
-                np.array(troughs, dtype=np.int32))
+    if not len(peaks) and not len(troughs):
+        return peaks, troughs
+    elif not len(peaks):
+        peaks = np.array([0] * int(troughs[0] != 0) +
+                         [length] * int(troughs[-1] != length),
+                         dtype=np.int32)
+        return peaks, troughs
+    elif not len(troughs):
+        troughs = np.array([0] * int(peaks[0] != 0) +
+                           [length] * int(peaks[-1] != length),
+                           dtype=np.int32)
+        return peaks, troughs
 
     # Mark the first and last values as well to facilitate the peak and
     # trough marching algorithm
-    if 0 not in peaks and 0 not in troughs:
+    first = np.array([0], dtype=np.int32)
+    last = np.array([length], dtype=np.int32)
+    if peaks[0] != 0 and troughs[0] != 0:
         if peaks[0] < troughs[0]:
-            troughs.insert(0, 0)
+            troughs = np.concatenate([first, troughs])
         else:
-            peaks.insert(0, 0)
-    if length not in peaks and length not in troughs:
+            peaks = np.concatenate([first, peaks])
+    if peaks[-1] != length and troughs[-1] != length:
         if peaks[-1] < troughs[-1]:
-            peaks.append(length)
+            peaks = np.concatenate([peaks, last])
         else:
-            troughs.append(length)
+            troughs = np.concatenate([troughs, last])
+
+    return peaks, troughs
 
-    return (np.array(peaks, dtype=np.int32),
-            np.array(troughs, dtype=np.int32))
+
+def _window_extrema(x, start, stop, cache=None, key=None):
+    """
+    Returns find_local_extrema(x[start:stop]). If cache is a dictionary, the
+    results are memoized in it under (key, start, stop).
+    """
+    if cache is None:
+        return find_local_extrema(x[start:stop])
+    if (key, start, stop) not in cache:
+        cache[key, start, stop] = find_local_extrema(x[start:stop])
+    return cache[key, start, stop]
 
 
 def find_closest(ref_array, target):
@@ -168,8 +163,10 @@ def _plot_mask(new_mask, old_mask, name=None):
     Useful to figure out which stage is responsible for a certain window
     being picked/rejected.
 
-    :param new_mask: The mask after the elimination stage.
-    :param old_mask: The mask before the elimination stage.
+    :param new_mask: Boolean array, True where no windows can be picked
+        after the elimination stage.
+    :param old_mask: Boolean array, True where no windows can be picked
+        before the elimination stage.
     :param name: The name of the elimination stage.
     :return:
     """
@@ -177,18 +174,14 @@ def _plot_mask(new_mask, old_mask, name=None):
     import matplotlib.pylab as plt  # NOQA
     import matplotlib.patheffects as PathEffects  # NOQA
 
-    old_mask = old_mask.copy()
-    new_mask = new_mask.copy()
-
-    new_mask.mask = np.bitwise_xor(old_mask.mask, new_mask.mask)
-    old_mask.mask = np.invert(old_mask.mask)
-    for i in flatnotmasked_contiguous(old_mask):
-        plt.fill_between((i.start, i.stop), (-1.0, -1.0), (2.0, 2.0),
+    starts, stops = intervals.from_mask(old_mask)
+    for start, stop in zip(starts, stops):
+        plt.fill_between((start, stop), (-1.0, -1.0), (2.0, 2.0),
                          color="gray", alpha=0.3, lw=0)
 
-    new_mask.mask = np.invert(new_mask.mask)
-    for i in flatnotmasked_contiguous(new_mask):
-        plt.fill_between((i.start, i.stop), (-1.0, -1.0), (2.0, 2.0),
+    starts, stops = intervals.from_mask(old_mask ^ new_mask)
+    for start, stop in zip(starts, stops):
+        plt.fill_between((start, stop), (-1.0, -1.0), (2.0, 2.0),
                          color="#fb9a99", lw=0)
 
     if name:
@@ -203,21 +196,161 @@ def _plot_mask(new_mask, old_mask, name=None):
     plt.gca().xaxis.set_ticklabels([])
 
 
-def _window_generator(data_length, window_width):
+def _sliding_windows(x, taper, starts, step=1):
     """
-    Simple generator yielding start and stop indices for sliding windows.
+    Returns the tapered windows of x starting at the given samples as a
+    (len(starts), len(taper)) array.
+
+    :param x: The time series.
+    :param taper: The taper, its length is the window length.
+    :param starts: Sorted start indices of the windows, spaced by step
+        samples.
+    :param step: The spacing of the start indices.
+    """
+    x = np.ascontiguousarray(x)
+    windows = as_strided(x[starts[0]:], shape=(len(starts), len(taper)),
+                         strides=(x.strides[0] * step, x.strides[0]))
+    return windows * taper
+
+
+def sliding_cross_correlation(data, synth, taper, midpoints,
+                              chunk_size=None, step=1):
+    """
+    Cross correlates the tapered windows of data and synthetics centred on
+    every midpoint, like np.correlate(data_window, synthetic_window,
+    mode="full") for one window at a time.
+
+    The windows of a chunk of midpoints are correlated with a single FFT
+    call. Where the maximum of an FFT based correlation is not unique within
+    its rounding error, it is located with np.correlate instead, and the
+    value of the maximum is recomputed as a dot product, so the results
+    agree with the direct correlation to the rounding of the dot products.
+
+    Returns a tuple of three arrays with one value per midpoint: the peak to
+    peak amplitude of the tapered synthetic window, the time shift of the
+    synthetics relative to the data in samples and the maximum normalised
+    correlation coefficient. The latter two are not computed for windows
+    with a peak to peak amplitude below 0.001 of the one of synth and are set
+    to zero and NaN, respectively.
+
+    :param data: The data.
+    :param synth: The synthetics, same length as data.
+    :param taper: The taper, its length is the odd window length.
+    :param midpoints: Midpoint indices of the windows, spaced by step
+        samples. All windows must lie within the traces.
+    :param chunk_size: Number of windows correlated at once. By default
+        chosen so that a chunk holds at most MAX_SLIDING_CHUNK_ELEMENTS
+        samples.
+    :param step: The spacing of the midpoints, consecutive by default.
+    """
+    window_length = len(taper)
+    n_fft = scipy.fftpack.next_fast_len(2 * window_length - 1)
+    if chunk_size is None:
+        chunk_size = max(1, MAX_SLIDING_CHUNK_ELEMENTS // n_fft)
+    min_ptp = synth.ptp() * 0.001
+
+    synth_ptp = np.zeros(len(midpoints))
+    time_shift = np.zeros(len(midpoints), dtype=np.int64)
+    max_cc_value = np.empty(len(midpoints))
+    max_cc_value.fill(np.nan)
+
+    starts = np.asarray(midpoints) - window_length // 2
+    for first in xrange(0, len(starts), chunk_size):
+        rows = slice(first, first + chunk_size)
+        synthetic_windows = _sliding_windows(synth, taper, starts[rows],
+                                             step)
+        synth_ptp[rows] = synthetic_windows.ptp(axis=1)
+        active = np.nonzero(synth_ptp[rows] >= min_ptp)[0]
+        if not len(active):
+            continue
+        synthetic_windows = synthetic_windows[active]
+        data_windows = _sliding_windows(data, taper, starts[rows],
+                                        step)[active]
+
+        # Correlation in the layout of np.correlate(..., mode="full"): lags
+        # from -(window_length - 1) to window_length - 1.
+        cc = np.fft.irfft(
+            np.fft.rfft(data_windows, n_fft, axis=1) *
+            np.conj(np.fft.rfft(synthetic_windows, n_fft, axis=1)),
+            n_fft, axis=1)
+        cc = np.concatenate([cc[:, n_fft - window_length + 1:],
+                             cc[:, :window_length]], axis=1)
+
+        norm = np.sqrt((synthetic_windows ** 2).sum(axis=1) *
+                       (data_windows ** 2).sum(axis=1))
+        peak = cc.argmax(axis=1)
+        cc_max = cc[np.arange(len(peak)), peak]
+
+        # Maxima which are not unique within the rounding error of the FFT.
+        tolerance = 1E-10 * norm
+        ambiguous = np.nonzero(
+            (cc >= (cc_max - tolerance)[:, np.newaxis]).sum(axis=1) > 1)[0]
+        for i in ambiguous:
+            peak[i] = np.correlate(data_windows[i], synthetic_windows[i],
+                                   mode="full").argmax()
+        lag = peak - window_length + 1
+
+        # The maxima are recomputed as the dot products np.correlate
+        # evaluates, which are more accurate than the FFT based values.
+        for i, l in enumerate(lag):
+            if l >= 0:
+                cc_max[i] = np.dot(data_windows[i, l:],
+                                   synthetic_windows[i, :window_length - l])
+            else:
+                cc_max[i] = np.dot(data_windows[i, :window_length + l],
+                                   synthetic_windows[i, -l:])
+
+        indices = first + active
+        time_shift[indices] = lag
+        with np.errstate(divide="ignore", invalid="ignore"):
+            max_cc_value[indices] = cc_max / norm
 
-    :param data_length: The complete length of the data series over which to
-        slide the window.
-    :param window_width: The desired window width.
+    return synth_ptp, time_shift, max_cc_value
+
+
+def approximate_sliding_cross_correlation(data, synth, taper, midpoints,
+                                          step):
+    """
+    Approximation of sliding_cross_correlation() which only correlates the
+    windows of every step-th midpoint and of the last one.
+
+    The peak to peak amplitudes and correlation coefficients in between are
+    linearly interpolated. The time shifts are the ones of the closest
+    correlated window, so that jumps of the time shift stay jumps. Windows
+    next to a correlated window without energy count as having no energy as
+    well, as no coefficient can be interpolated for them.
+
+    :param data: The data.
+    :param synth: The synthetics, same length as data.
+    :param taper: The taper, its length is the odd window length.
+    :param midpoints: Consecutive midpoint indices of the windows.
+    :param step: Spacing of the correlated windows in samples.
+    """
+    midpoints = np.asarray(midpoints)
+    if step <= 1 or len(midpoints) <= 2:
+        return sliding_cross_correlation(data, synth, taper, midpoints)
+    coarse = midpoints[::step]
+    values = sliding_cross_correlation(data, synth, taper, coarse, step=step)
+    if coarse[-1] != midpoints[-1]:
+        coarse = np.concatenate([coarse, midpoints[-1:]])
+        values = [np.concatenate(pair) for pair in zip(
+            values, sliding_cross_correlation(data, synth, taper,
+                                              midpoints[-1:]))]
+    coarse_ptp, coarse_shift, coarse_cc = values
+
+    synth_ptp = np.interp(midpoints, coarse, coarse_ptp)
+    max_cc_value = np.interp(midpoints, coarse, coarse_cc)
+    time_shift = coarse_shift[find_closest(coarse, midpoints)]
+    synth_ptp[np.isnan(max_cc_value)] = 0.0
+    return synth_ptp, time_shift, max_cc_value
+
+
+def _cc_step(cc_step_period, minimum_period, dt):
     """
-    window_start = 0
-    while True:
-        window_end = window_start + window_width
-        if window_end > data_length:
-            break
-        yield (window_start, window_end, window_start + window_width // 2)
-        window_start += 1
+    The spacing in samples of the correlated windows for a spacing of
+    cc_step_period times the minimum period.
+    """
+    return max(1, int(round(cc_step_period * minimum_period / dt)))
 
 
 def _log_window_selection(tr_id, msg):
@@ -229,126 +362,45 @@ def _log_window_selection(tr_id, msg):
     """
     print "[Window selection for %s] %s" % (tr_id, msg)
 
-# Dictionary to cache the TauPyModel so there is no need to reinitialize it
-# each time which is a fairly expensive operation.
-TAUPY_MODEL_CACHE = {}
-
 
-def select_windows(data_trace, synthetic_trace, event_latitude,
-                   event_longitude, event_depth_in_km,
-                   station_latitude, station_longitude, minimum_period,
-                   maximum_period,
-                   min_cc=0.10, max_noise=0.10, max_noise_window=0.4,
-                   min_velocity=2.4, threshold_shift=0.30,
-                   threshold_correlation=0.75, min_length_period=1.5,
-                   min_peaks_troughs=2, max_energy_ratio=10.0,
-                   min_envelope_similarity=0.2,
-                   verbose=False, plot=False):
+def envelope(data):
     """
-    Window selection algorithm for picking windows suitable for misfit
-    calculation based on phase differences.
-
-    Returns a list of windows which might be empty due to various reasons.
-
-    This function is really long and a lot of things. For a more detailed
-    description, please see the LASIF paper.
-
-    :param data_trace: The data trace.
-    :type data_trace: :class:`~obspy.core.trace.Trace`
-    :param synthetic_trace: The synthetic trace.
-    :type synthetic_trace: :class:`~obspy.core.trace.Trace`
-    :param event_latitude: The event latitude.
-    :type event_latitude: float
-    :param event_longitude: The event longitude.
-    :type event_longitude: float
-    :param event_depth_in_km: The event depth in km.
-    :type event_depth_in_km: float
-    :param station_latitude: The station latitude.
-    :type station_latitude: float
-    :param station_longitude: The station longitude.
-    :type station_longitude: float
-    :param minimum_period: The minimum period of the data in seconds.
-    :type minimum_period: float
-    :param maximum_period: The maximum period of the data in seconds.
-    :type maximum_period: float
-    :param min_cc: Minimum normalised correlation coefficient of the
-        complete traces.
-    :type min_cc: float
-    :param max_noise: Maximum relative noise level for the whole trace.
-        Measured from maximum amplitudes before and after the first arrival.
-    :type max_noise: float
-    :param max_noise_window: Maximum relative noise level for individual
-        windows.
-    :type max_noise_window: float
-    :param min_velocity: All arrivals later than those corresponding to the
-        threshold velocity [km/s] will be excluded.
-    :type min_velocity: float
-    :param threshold_shift: Maximum allowable time shift within a window,
-        as a fraction of the minimum period.
-    :type threshold_shift: float
-    :param threshold_correlation: Minimum normalised correlation coeeficient
-        within a window.
-    :type threshold_correlation: float
-    :param min_length_period: Minimum length of the time windows relative to
-        the minimum period.
-    :type min_length_period: float
-    :param min_peaks_troughs: Minimum number of extrema in an individual
-        time window (excluding the edges).
-    :type min_peaks_troughs: float
-    :param max_energy_ratio: Maximum energy ratio between data and
-        synthetics within a time window. Don't make this too small!
-    :type max_energy_ratio: float
-    :param min_envelope_similarity: The minimum similarity of the envelopes of
-        both data and synthetics. This essentially assures that the
-        amplitudes of data and synthetics can not diverge too much within a
-        window. It is a bit like the inverse of the ratio of both envelopes
-        so a value of 0.2 makes sure neither amplitude can be more then 5
-        times larger than the other.
-    :type min_envelope_similarity: float
-    :param verbose: No output by default.
-    :type verbose: bool
-    :param plot: Create a plot of the algortihm while it does its work.
-    :type plot: bool
+    Envelope of one or more signals along the last axis, the square root of
+    the summed squares of the signal and its Hilbert transform, like
+    obspy.signal.filter.envelope(). A 2D array of traces is transformed with
+    a single FFT call.
     """
-    # Shortcuts to frequently accessed variables.
-    data_starttime = data_trace.stats.starttime
-    data_delta = data_trace.stats.delta
-    dt = data_trace.stats.delta
-    npts = data_trace.stats.npts
-    synth = synthetic_trace.data
-    data = data_trace.data
-    times = data_trace.times()
+    npts = data.shape[-1]
+    spectrum = np.fft.rfft(data, axis=-1)
+    # The Hilbert transform has no mean and, for even lengths, no Nyquist
+    # component.
+    spectrum[..., 0] = 0.0
+    if not npts % 2:
+        spectrum[..., -1] = 0.0
+    hilb = np.fft.irfft(spectrum * -1j, npts, axis=-1)
+    return (data ** 2 + hilb ** 2) ** 0.5
+
+
+def _first_arrival(event_depth_in_km, dist_in_deg, first_arrival_table=None):
+    """
+    Time of the first P arrival, from first_arrival_table if given and the
+    depth and distance are within it, otherwise computed with TauPy by
+    traveltime_table.first_arrival(). NaN if there is none.
+    """
+    if first_arrival_table is not None and \
+            first_arrival_table.contains(event_depth_in_km, dist_in_deg):
+        return float(first_arrival_table(event_depth_in_km, dist_in_deg))
 
-    # Fill cache if necessary.
-    if not TAUPY_MODEL_CACHE:
-        from obspy.taup import TauPyModel  # NOQA
-        TAUPY_MODEL_CACHE["model"] = TauPyModel("AK135")
-    model = TAUPY_MODEL_CACHE["model"]
+    # The same computation the table is built with.
+    return traveltime_table.first_arrival(event_depth_in_km, dist_in_deg,
+                                          "AK135")
 
-    # -------------------------------------------------------------------------
-    # Geographical calculations and the time of the first arrival.
-    # -------------------------------------------------------------------------
-    dist_in_deg = geodetics.locations2degrees(station_latitude,
-                                              station_longitude,
-                                              event_latitude, event_longitude)
-    dist_in_km = geodetics.calcVincentyInverse(
-        station_latitude, station_longitude, event_latitude,
-        event_longitude)[0] / 1000.0
-
-    # Get only a couple of P phases which should be the first arrival
-    # for every epicentral distance. Its quite a bit faster than calculating
-    # the arrival times for every phase.
-    # Assumes the first sample is the centroid time of the event.
-    tts = model.get_travel_times(source_depth_in_km=event_depth_in_km,
-                                 distance_in_degree=dist_in_deg,
-                                 phase_list=["ttp"])
-    # Sort just as a safety measure.
-    tts = sorted(tts, key=lambda x: x.time)
-    first_tt_arrival = tts[0].time
 
-    # -------------------------------------------------------------------------
-    # Window settings
-    # -------------------------------------------------------------------------
+def _window_taper(minimum_period, dt):
+    """
+    Returns the taper of the sliding windows, its length is the window
+    length.
+    """
     # Number of samples in the sliding window. Currently, the length of the
     # window is set to a multiple of the dominant period of the synthetics.
     # Make sure it is an uneven number; just to have a trivial midpoint
@@ -359,269 +411,215 @@ def select_windows(data_trace, synthetic_trace, event_latitude,
 
     # Use a Hanning window. No particular reason for it but its a well-behaved
     # window and has nice spectral properties.
-    taper = np.hanning(window_length)
-
-    # =========================================================================
-    # check if whole seismograms are sufficiently correlated and estimate
-    # noise level
-    # =========================================================================
-
-    # Overall Correlation coefficient.
-    norm = np.sqrt(np.sum(data ** 2)) * np.sqrt(np.sum(synth ** 2))
-    cc = np.sum(data * synth) / norm
-    if verbose:
-        _log_window_selection(data_trace.id,
-                              "Correlation Coefficient: %.4f" % cc)
-
-    # Estimate noise level from waveforms prior to the first arrival.
-    idx_end = int(np.ceil((first_tt_arrival - 0.5 * minimum_period) / dt))
-    idx_end = max(10, idx_end)
-    idx_start = int(np.ceil((first_tt_arrival - 2.5 * minimum_period) / dt))
-    idx_start = max(10, idx_start)
+    return np.hanning(window_length)
 
-    if idx_start >= idx_end:
-        idx_start = max(0, idx_end - 10)
 
-    abs_data = np.abs(data)
-    noise_absolute = abs_data[idx_start:idx_end].max()
-    noise_relative = noise_absolute / abs_data.max()
+def _traveltime_bounds(first_tt_arrival, dist_in_km, min_velocity,
+                       minimum_period, dt):
+    """
+    Returns the last sample before and the first sample after the samples
+    passing the traveltime elimination.
+    """
+    min_idx = int((first_tt_arrival - (minimum_period / 2.0)) / dt)
+    max_idx = int(math.ceil((
+        dist_in_km / min_velocity + minimum_period / 2.0) / dt))
+    return min_idx, max_idx
 
-    if verbose:
-        _log_window_selection(data_trace.id,
-                              "Absolute Noise Level: %e" % noise_absolute)
-        _log_window_selection(data_trace.id,
-                              "Relative Noise Level: %e" % noise_relative)
 
-    # Basic global rejection criteria.
-    accept_traces = True
-    if (cc < min_cc) and (noise_relative > max_noise / 3.0):
-        msg = "Correlation %.4f is below threshold of %.4f" % (cc, min_cc)
-        if verbose:
-            _log_window_selection(data_trace.id, msg)
-        accept_traces = msg
+def _noise_indices(first_tt_arrival, minimum_period, dt):
+    """
+    Start and end index of the noise estimation window before the first
+    arrival. first_tt_arrival may also be an array.
+    """
+    idx_end = np.ceil((first_tt_arrival - 0.5 * minimum_period) / dt)
+    idx_end = np.maximum(10, idx_end.astype(np.int64))
+    idx_start = np.ceil((first_tt_arrival - 2.5 * minimum_period) / dt)
+    idx_start = np.maximum(10, idx_start.astype(np.int64))
+    idx_start = np.where(idx_start >= idx_end, np.maximum(0, idx_end - 10),
+                         idx_start)
+    return idx_start, idx_end
+
+
+def _select_index_windows(data, synth, dt, first_tt_arrival, dist_in_km,
+                          noise_absolute, data_env, synth_env, taper,
+                          minimum_period, maximum_period, max_noise_window,
+                          min_velocity, threshold_shift,
+                          threshold_correlation, min_length_period,
+                          min_peaks_troughs, max_energy_ratio,
+                          min_envelope_similarity, tr_id, verbose=False,
+                          plot=False, stats=None, sliding=None,
+                          extrema=None, cc_step=1):
+    """
+    The elimination stages of the window selection for a trace that passed
+    the global rejection criteria, see select_windows(). Returns a list of
+    (start, stop) sample index tuples.
+
+    If plot is True, the stages are drawn into the current figure set up by
+    select_windows(). If stats is a SelectionStats, the end of every stage
+    is recorded in it.
+
+    sliding and extrema hold intermediates shared by several calls for the
+    same trace, see select_windows_sweep(). sliding are the three arrays
+    returned by sliding_cross_correlation(), of length npts and computed for
+    all midpoints any call can reach. extrema is a dictionary memoizing the
+    extrema of the candidate windows.
+
+    With a cc_step above one, the sliding cross correlations are only
+    computed every cc_step samples, see
+    approximate_sliding_cross_correlation().
+    """
+    npts = len(data)
+    window_length = len(taper)
+    if plot:
+        import matplotlib.pylab as plt  # NOQA
+        import matplotlib.patheffects as PathEffects  # NOQA
+        grid = (31, 1)
+        times = np.arange(npts) * dt
+        xlim = (times[0], times[-1])
 
-    if noise_relative > max_noise:
-        msg = "Noise level %.3f is above threshold of %.3f" % (
-            noise_relative, max_noise)
-        if verbose:
-            _log_window_selection(
-                data_trace.id, msg)
-        accept_traces = msg
+    # The pointwise elimination stages set time_windows to True where no
+    # windows are chosen. The later stages work on the candidate windows as
+    # sets of intervals.
+    time_windows = np.zeros(npts, dtype=bool)
+    if plot:
+        old_time_windows = time_windows.copy()
 
-    # Calculate the envelope of both data and synthetics. This is to make sure
-    # that the amplitude of both is not too different over time and is
-    # used as another selector. Only calculated if the trace is generally
-    # accepted as it is fairly slow.
-    if accept_traces is True:
-        data_env = obspy.signal.filter.envelope(data)
-        synth_env = obspy.signal.filter.envelope(synth)
+    # Elimination Stage 1: Eliminate everything half a period before or
+    # after the minimum and maximum travel times, respectively.
+    # theoretical arrival as positive.
+    min_idx, max_idx = _traveltime_bounds(first_tt_arrival, dist_in_km,
+                                          min_velocity, minimum_period, dt)
+    time_windows[:min_idx + 1] = True
+    time_windows[max_idx:] = True
+    if plot:
+        plt.subplot2grid(grid, (8, 0), rowspan=1)
+        _plot_mask(time_windows, old_time_windows,
+                   name="TRAVELTIME ELIMINATION")
+        old_time_windows = time_windows.copy()
+    if stats is not None:
+        stats.stage("traveltime", intervals.from_mask(~time_windows))
+
+    # Elimination Stage 6, applied before the expensive cross correlations as
+    # it is cheap: Make sure the amplitudes of both don't vary too much.
+    # Only evaluated for the samples that passed the traveltime elimination,
+    # the clipping still uses the maxima of the complete envelopes.
+    admissible = np.flatnonzero(~time_windows)
+    if plot:
+        span = slice(0, npts)
+    elif len(admissible):
+        span = slice(admissible[0], admissible[-1] + 1)
+    else:
+        span = slice(0, 0)
+    synth_env_max, data_env_max = synth_env.max(), data_env.max()
+    # Clip both to avoid large numbers by division.
+    synth_clipped = np.clip(synth_env[span],
+                            synth_env_max * min_envelope_similarity * 0.5,
+                            synth_env_max)
+    data_clipped = np.clip(data_env[span],
+                           data_env_max * min_envelope_similarity * 0.5,
+                           data_env_max)
+    # Ratio.
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = np.minimum(synth_clipped, data_clipped) / \
+            np.maximum(synth_clipped, data_clipped)
+    time_windows[span][ratio < min_envelope_similarity] = True
+    if plot:
+        plt.subplot2grid(grid, (25, 0), rowspan=1)
+        _plot_mask(time_windows, old_time_windows,
+                   name="ENVELOPE AMPLITUDE SIMILARITY ELIMINATION")
+        old_time_windows = time_windows.copy()
+    if stats is not None:
+        stats.stage("envelope_similarity", intervals.from_mask(~time_windows))
 
     # -------------------------------------------------------------------------
-    # Initial Plot setup.
+    # Compute sliding time shifts and correlation coefficients for time
+    # frames that passed the traveltime and envelope elimination stages.
     # -------------------------------------------------------------------------
-    # All the plot calls are interleaved. I realize this is really ugly but
-    # the alternative would be to either have two functions (one with plots,
-    # one without) or split the plotting function in various subfunctions,
-    # neither of which are acceptable in my opinion. The impact on
-    # performance is minimal if plotting is turned off: all imports are lazy
-    # and a couple of conditionals are cheap.
+    # Allocate arrays to collect the time dependent values, they are only
+    # valid where computed is True.
+    sliding_time_shift = np.zeros(npts, dtype="float32")
+    max_cc_coeff = np.zeros(npts, dtype="float32")
+    computed = np.zeros(npts, dtype=bool)
+
+    # The time shift jump elimination (Stage 5) masks sample_buffer samples
+    # to each side of a jump between two samples, so the correlations are
+    # needed for all samples within that reach of the remaining ones. All
+    # others are masked anyway and are skipped.
+    sample_buffer = int(np.ceil(minimum_period / dt * 0.1))
     if plot:
-        import matplotlib.pylab as plt  # NOQA
-        import matplotlib.patheffects as PathEffects  # NOQA
-
-        if accept_traces is True:
-            plt.figure(figsize=(18, 12))
-            plt.subplots_adjust(left=0.05, bottom=0.05, right=0.98, top=0.95,
-                                wspace=None, hspace=0.0)
-            grid = (31, 1)
-
-            # Axes showing the data.
-            data_plot = plt.subplot2grid(grid, (0, 0), rowspan=8)
+        needed = np.ones(npts, dtype=bool)
+    else:
+        remaining = np.concatenate([[0], np.cumsum(~time_windows)])
+        positions = np.arange(npts)
+        needed = remaining[np.minimum(positions + sample_buffer, npts)] > \
+            remaining[np.maximum(positions - sample_buffer - 1, 0)]
+
+    # Midpoints of all windows within the traces that passed the traveltime
+    # elimination and are needed.
+    half_length = window_length // 2
+    midpoints = np.arange(max(min_idx + 1, half_length),
+                          min(max_idx, npts - window_length + half_length + 1))
+    midpoints = midpoints[needed[midpoints]]
+
+    if len(midpoints):
+        if sliding is None:
+            # The sliding correlation works on runs of consecutive midpoints.
+            runs = np.split(midpoints,
+                            np.flatnonzero(np.diff(midpoints) > 1) + 1)
+            synth_ptp, time_shift, max_cc_value = [
+                np.concatenate(values) for values in zip(*[
+                    approximate_sliding_cross_correlation(
+                        data, synth, taper, run, cc_step)
+                    for run in runs])]
         else:
-            # Only show one axes it the traces are not accepted.
-            plt.figure(figsize=(18, 3))
+            synth_ptp, time_shift, max_cc_value = [
+                values[midpoints] for values in sliding]
 
-        # Plot envelopes if needed.
-        if accept_traces is True:
-            plt.plot(times, data_env, color="black", alpha=0.5, lw=0.4,
-                     label="data envelope")
-            plt.plot(synthetic_trace.times(), synth_env, color="#e41a1c",
-                     alpha=0.4, lw=0.5, label="synthetics envelope")
+        # Elimination Stage 2: Skip windows that have essentially no energy
+        # to avoid instabilities. No windows can be picked in these.
+        no_energy = synth_ptp < synth.ptp() * 0.001
+        time_windows[midpoints[no_energy]] = True
+        midpoints = midpoints[~no_energy]
+
+        # The time shift is defined as the shift of the synthetics relative
+        # to the data. So a value of 2, for instance, means that the
+        # synthetics are 2 timesteps later then the data. Express it in
+        # fraction of the minimum period.
+        sliding_time_shift[midpoints] = \
+            (time_shift[~no_energy] * dt) / minimum_period
+        max_cc_coeff[midpoints] = max_cc_value[~no_energy]
+        computed[midpoints] = True
+    if stats is not None:
+        stats.stage("no_energy", intervals.from_mask(~time_windows))
 
-        plt.plot(times, data, color="black", label="data", lw=1.5)
-        plt.plot(synthetic_trace.times(), synth, color="#e41a1c",
-                 label="synthetics",  lw=1.5)
-
-        # Symmetric around y axis.
-        middle = data.mean()
-        d_max, d_min = data.max(), data.min()
-        r = max(d_max - middle, middle - d_min) * 1.1
-        ylim = (middle - r, middle + r)
-        xlim = (times[0], times[-1])
-        plt.ylim(*ylim)
-        plt.xlim(*xlim)
-
-        offset = (xlim[1] - xlim[0]) * 0.005
-        plt.vlines(first_tt_arrival, ylim[0], ylim[1], colors="#ff7f00", lw=2)
-        plt.text(first_tt_arrival + offset,
-                 ylim[1] - (ylim[1] - ylim[0]) * 0.02,
-                 "first arrival", verticalalignment="top",
-                 horizontalalignment="left", color="#ee6e00",
-                 path_effects=[
-                     PathEffects.withStroke(linewidth=3, foreground="white")])
-
-        plt.vlines(first_tt_arrival - minimum_period / 2.0, ylim[0], ylim[1],
-                   colors="#ff7f00", lw=2)
-        plt.text(first_tt_arrival - minimum_period / 2.0 - offset,
-                 ylim[0] + (ylim[1] - ylim[0]) * 0.02,
-                 "first arrival - min period / 2", verticalalignment="bottom",
-                 horizontalalignment="right", color="#ee6e00",
-                 path_effects=[
-                     PathEffects.withStroke(linewidth=3, foreground="white")])
-
-        for velocity in [6, 5, 4, 3, min_velocity]:
-            tt = dist_in_km / velocity
-            plt.vlines(tt, ylim[0], ylim[1], colors="gray", lw=2)
-            if velocity == min_velocity:
-                hal = "right"
-                o_s = -1.0 * offset
-            else:
-                hal = "left"
-                o_s = offset
-            plt.text(tt + o_s, ylim[0] + (ylim[1] - ylim[0]) * 0.02,
-                     str(velocity) + " km/s", verticalalignment="bottom",
-                     horizontalalignment=hal, color="0.15")
-        plt.vlines(dist_in_km / min_velocity + minimum_period / 2.0,
-                   ylim[0], ylim[1], colors="gray", lw=2)
-        plt.text(dist_in_km / min_velocity + minimum_period / 2.0 - offset,
-                 ylim[1] - (ylim[1] - ylim[0]) * 0.02,
-                 "min surface velocity + min period / 2",
-                 verticalalignment="top",
-                 horizontalalignment="right", color="0.15", path_effects=[
-                     PathEffects.withStroke(linewidth=3, foreground="white")])
-
-        plt.hlines(noise_absolute, xlim[0], xlim[1], linestyle="--",
-                   color="gray")
-        plt.hlines(-noise_absolute, xlim[0], xlim[1], linestyle="--",
-                   color="gray")
-        plt.text(offset, noise_absolute + (ylim[1] - ylim[0]) * 0.01,
-                 "noise level", verticalalignment="bottom",
-                 horizontalalignment="left", color="0.15",
-                 path_effects=[
-                     PathEffects.withStroke(linewidth=3, foreground="white")])
-        plt.legend(loc="lower right", fancybox=True, framealpha=0.5,
-                   fontsize="small")
-        plt.gca().xaxis.set_ticklabels([])
-
-        # Plot the basic global information.
-        ax = plt.gca()
-        txt = (
-            "Total CC Coeff: %.4f\nAbsolute Noise: %e\nRelative Noise: %.3f"
-            % (cc, noise_absolute, noise_relative))
-        ax.text(0.01, 0.95, txt, transform=ax.transAxes,
-                fontdict=dict(fontsize="small", ha='left', va='top'),
-                bbox=dict(boxstyle="round", fc="w", alpha=0.8))
-        plt.suptitle("Channel %s" % data_trace.id, fontsize="larger")
-
-    # Show plot and return if not accepted.
-        if accept_traces is not True:
-            txt = "Rejected: %s" % (accept_traces)
-            ax.text(0.99, 0.95, txt, transform=ax.transAxes,
-                    fontdict=dict(fontsize="small", ha='right', va='top'),
-                    bbox=dict(boxstyle="round", fc="red", alpha=1.0))
-            plt.show()
-    if accept_traces is not True:
-        return []
-
-    # Initialise masked arrays. The mask will be set to True where no
-    # windows are chosen.
-    time_windows = np.ma.ones(npts)
-    time_windows.mask = False
-    if plot:
-        old_time_windows = time_windows.copy()
-
-    # Elimination Stage 1: Eliminate everything half a period before or
-    # after the minimum and maximum travel times, respectively.
-    # theoretical arrival as positive.
-    min_idx = int((first_tt_arrival - (minimum_period / 2.0)) / dt)
-    max_idx = int(math.ceil((
-        dist_in_km / min_velocity + minimum_period / 2.0) / dt))
-    time_windows.mask[:min_idx + 1] = True
-    time_windows.mask[max_idx:] = True
-    if plot:
-        plt.subplot2grid(grid, (8, 0), rowspan=1)
-        _plot_mask(time_windows, old_time_windows,
-                   name="TRAVELTIME ELIMINATION")
-        old_time_windows = time_windows.copy()
-
-    # -------------------------------------------------------------------------
-    # Compute sliding time shifts and correlation coefficients for time
-    # frames that passed the traveltime elimination stage.
-    # -------------------------------------------------------------------------
-    # Allocate arrays to collect the time dependent values.
-    sliding_time_shift = np.ma.zeros(npts, dtype="float32")
-    sliding_time_shift.mask = True
-    max_cc_coeff = np.ma.zeros(npts, dtype="float32")
-    max_cc_coeff.mask = True
-
-    for start_idx, end_idx, midpoint_idx in _window_generator(npts,
-                                                              window_length):
-        if not min_idx < midpoint_idx < max_idx:
-            continue
-
-        # Slice windows. Create a copy to be able to taper without affecting
-        # the original time series.
-        data_window = data[start_idx: end_idx].copy() * taper
-        synthetic_window = \
-            synth[start_idx: end_idx].copy() * taper
-
-        # Elimination Stage 2: Skip windows that have essentially no energy
-        # to avoid instabilities. No windows can be picked in these.
-        if synthetic_window.ptp() < synth.ptp() * 0.001:
-            time_windows.mask[midpoint_idx] = True
-            continue
-
-        # Calculate the time shift. Here this is defined as the shift of the
-        # synthetics relative to the data. So a value of 2, for instance, means
-        # that the synthetics are 2 timesteps later then the data.
-        cc = np.correlate(data_window, synthetic_window, mode="full")
-
-        time_shift = cc.argmax() - window_length + 1
-        # Express the time shift in fraction of the minimum period.
-        sliding_time_shift[midpoint_idx] = (time_shift * dt) / minimum_period
-
-        # Normalized cross correlation.
-        max_cc_value = cc.max() / np.sqrt((synthetic_window ** 2).sum() *
-                                          (data_window ** 2).sum())
-        max_cc_coeff[midpoint_idx] = max_cc_value
-
-    if plot:
-        plt.subplot2grid(grid, (9, 0), rowspan=1)
-        _plot_mask(time_windows, old_time_windows,
-                   name="NO ENERGY IN CC WINDOW")
-        # Axes with the CC coeffs
-        plt.subplot2grid(grid, (15, 0), rowspan=4)
-        plt.hlines(0, xlim[0], xlim[1], color="lightgray")
-        plt.hlines(-threshold_shift, xlim[0], xlim[1], color="gray",
-                   linestyle="--")
-        plt.hlines(threshold_shift, xlim[0], xlim[1], color="gray",
-                   linestyle="--")
-        plt.text(5, -threshold_shift - (2) * 0.03,
-                 "threshold", verticalalignment="top",
-                 horizontalalignment="left", color="0.15",
-                 path_effects=[
-                     PathEffects.withStroke(linewidth=3, foreground="white")])
-        plt.plot(times, sliding_time_shift, color="#377eb8",
-                 label="Time shift in fraction of minimum period", lw=1.5)
-        ylim = plt.ylim()
-        plt.yticks([-0.75, 0, 0.75])
-        plt.xticks([300, 600, 900, 1200, 1500, 1800])
-        plt.ylim(ylim[0], ylim[1] + ylim[1] - ylim[0])
-        plt.ylim(-1.0, 1.0)
-        plt.xlim(xlim)
-        plt.gca().xaxis.set_ticklabels([])
-        plt.legend(loc="lower right", fancybox=True, framealpha=0.5,
-                   fontsize="small")
+    if plot:
+        plt.subplot2grid(grid, (9, 0), rowspan=1)
+        _plot_mask(time_windows, old_time_windows,
+                   name="NO ENERGY IN CC WINDOW")
+        # Axes with the CC coeffs
+        plt.subplot2grid(grid, (15, 0), rowspan=4)
+        plt.hlines(0, xlim[0], xlim[1], color="lightgray")
+        plt.hlines(-threshold_shift, xlim[0], xlim[1], color="gray",
+                   linestyle="--")
+        plt.hlines(threshold_shift, xlim[0], xlim[1], color="gray",
+                   linestyle="--")
+        plt.text(5, -threshold_shift - (2) * 0.03,
+                 "threshold", verticalalignment="top",
+                 horizontalalignment="left", color="0.15",
+                 path_effects=[
+                     PathEffects.withStroke(linewidth=3, foreground="white")])
+        plt.plot(times, np.where(computed, sliding_time_shift, np.nan),
+                 color="#377eb8",
+                 label="Time shift in fraction of minimum period", lw=1.5)
+        ylim = plt.ylim()
+        plt.yticks([-0.75, 0, 0.75])
+        plt.xticks([300, 600, 900, 1200, 1500, 1800])
+        plt.ylim(ylim[0], ylim[1] + ylim[1] - ylim[0])
+        plt.ylim(-1.0, 1.0)
+        plt.xlim(xlim)
+        plt.gca().xaxis.set_ticklabels([])
+        plt.legend(loc="lower right", fancybox=True, framealpha=0.5,
+                   fontsize="small")
 
         plt.subplot2grid(grid, (10, 0), rowspan=4)
         plt.hlines(threshold_correlation, xlim[0], xlim[1], color="0.15",
@@ -633,7 +631,8 @@ def select_windows(data_trace, synthetic_trace, event_latitude,
                  horizontalalignment="left", color="0.15",
                  path_effects=[
                      PathEffects.withStroke(linewidth=3, foreground="white")])
-        plt.plot(times, max_cc_coeff, color="#4daf4a",
+        plt.plot(times, np.where(computed, max_cc_coeff, np.nan),
+                 color="#4daf4a",
                  label="Maximum CC coefficient", lw=1.5)
         plt.ylim(-0.2, 1.2)
         plt.yticks([0, 0.5, 1])
@@ -647,22 +646,29 @@ def select_windows(data_trace, synthetic_trace, event_latitude,
     # correlation coefficient is under threshold_correlation as negative
     if plot:
         old_time_windows = time_windows.copy()
-    time_windows.mask[max_cc_coeff < threshold_correlation] = True
+    time_windows[computed & (max_cc_coeff < threshold_correlation)] = True
     if plot:
         plt.subplot2grid(grid, (14, 0), rowspan=1)
         _plot_mask(time_windows, old_time_windows,
                    name="CORRELATION COEFF THRESHOLD ELIMINATION")
+    if stats is not None:
+        stats.stage("correlation_threshold",
+                    intervals.from_mask(~time_windows))
 
     # Elimination Stage 4: Mark everything with an absolute travel time
     # shift of more than # threshold_shift times the dominant period as
     # negative
     if plot:
         old_time_windows = time_windows.copy()
-    time_windows.mask[np.ma.abs(sliding_time_shift) > threshold_shift] = True
+    time_windows[computed & (np.abs(sliding_time_shift) > threshold_shift)] = \
+        True
     if plot:
         plt.subplot2grid(grid, (19, 0), rowspan=1)
         _plot_mask(time_windows, old_time_windows,
                    name="TIME SHIFT THRESHOLD ELIMINATION")
+    if stats is not None:
+        stats.stage("time_shift_threshold",
+                    intervals.from_mask(~time_windows))
 
     # Elimination Stage 5: Mark the area around every "travel time shift
     # jump" (based on the traveltime time difference) negative. The width of
@@ -670,33 +676,24 @@ def select_windows(data_trace, synthetic_trace, event_latitude,
     # each side.
     if plot:
         old_time_windows = time_windows.copy()
-    sample_buffer = int(np.ceil(minimum_period / dt * 0.1))
-    indices = np.ma.where(np.ma.abs(np.ma.diff(sliding_time_shift)) > 0.1)[0]
-    for index in indices:
-        time_windows.mask[index - sample_buffer: index + sample_buffer] = True
+    indices = np.flatnonzero(
+        computed[:-1] & computed[1:] &
+        (np.abs(np.diff(sliding_time_shift)) > 0.1))
+    # The areas are the slices index - sample_buffer:index + sample_buffer,
+    # a negative start counts from the end of the trace like in a slice.
+    starts = indices - sample_buffer
+    starts = np.where(starts < 0, np.maximum(starts + npts, 0), starts)
+    candidates = intervals.subtract(
+        intervals.from_mask(~time_windows),
+        intervals.from_bounds(starts,
+                              np.minimum(indices + sample_buffer, npts)))
     if plot:
+        time_windows = ~intervals.to_mask(candidates, npts)
         plt.subplot2grid(grid, (20, 0), rowspan=1)
         _plot_mask(time_windows, old_time_windows,
                    name="TIME SHIFT JUMPS ELIMINATION")
-
-    # Clip both to avoid large numbers by division.
-    stacked = np.vstack([
-        np.ma.clip(synth_env, synth_env.max() * min_envelope_similarity * 0.5,
-                   synth_env.max()),
-        np.ma.clip(data_env, data_env.max() * min_envelope_similarity * 0.5,
-                   data_env.max())])
-    # Ratio.
-    ratio = stacked.min(axis=0) / stacked.max(axis=0)
-
-    # Elimination Stage 6: Make sure the amplitudes of both don't vary too
-    # much.
-    if plot:
-        old_time_windows = time_windows.copy()
-    time_windows.mask[ratio < min_envelope_similarity] = True
-    if plot:
-        plt.subplot2grid(grid, (25, 0), rowspan=1)
-        _plot_mask(time_windows, old_time_windows,
-                   name="ENVELOPE AMPLITUDE SIMILARITY ELIMINATION")
+    if stats is not None:
+        stats.stage("time_shift_jumps", candidates)
 
     if plot:
         plt.subplot2grid(grid, (21, 0), rowspan=4)
@@ -724,29 +721,30 @@ def select_windows(data_trace, synthetic_trace, event_latitude,
         old_time_windows = time_windows.copy()
     min_length = \
         min(minimum_period / dt * min_length_period, maximum_period / dt)
-    for i in flatnotmasked_contiguous(time_windows):
-        # Step 7: Throw away all windows with a length of less then
-        # min_length_period the dominant periodele
-        if (i.stop - i.start) < min_length:
-            time_windows.mask[i.start: i.stop] = True
+    # Step 7: Throw away all windows with a length of less then
+    # min_length_period the dominant periodele
+    candidates = intervals.min_length(candidates, min_length)
     if plot:
+        time_windows = ~intervals.to_mask(candidates, npts)
         plt.subplot2grid(grid, (26, 0), rowspan=1)
         _plot_mask(time_windows, old_time_windows,
                    name="MINIMUM WINDOW LENGTH ELIMINATION 1")
+    if stats is not None:
+        stats.stage("min_length_1", candidates)
 
     # -------------------------------------------------------------------------
     # Peak and trough marching algorithm
     # -------------------------------------------------------------------------
     final_windows = []
-    for i in flatnotmasked_contiguous(time_windows):
+    for i_start, i_stop in zip(*candidates):
         # Cut respective windows.
-        window_npts = i.stop - i.start
-        synthetic_window = synth[i.start: i.stop]
-        data_window = data[i.start: i.stop]
+        window_npts = i_stop - i_start
 
         # Find extrema in the data and the synthetics.
-        data_p, data_t = find_local_extrema(data_window)
-        synth_p, synth_t = find_local_extrema(synthetic_window)
+        data_p, data_t = _window_extrema(data, i_start, i_stop, extrema,
+                                         "data")
+        synth_p, synth_t = _window_extrema(synth, i_start, i_stop, extrema,
+                                           "synth")
 
         window_mask = np.ones(window_npts, dtype="bool")
 
@@ -778,102 +776,421 @@ def select_windows(data_trace, synthetic_trace, event_latitude,
                 end = -1
             window_mask[start: end] = False
 
-        window_mask = np.ma.masked_array(window_mask,
-                                         mask=window_mask)
-
-        if window_mask.mask.all():
-            continue
-
-        for j in flatnotmasked_contiguous(window_mask):
-            final_windows.append((i.start + j.start, i.start + j.stop))
+        for j_start, j_stop in zip(*intervals.from_mask(~window_mask)):
+            final_windows.append((i_start + j_start, i_start + j_stop))
 
+    candidates = intervals.from_bounds(
+        [start for start, _ in final_windows],
+        [stop for _, stop in final_windows])
     if plot:
         old_time_windows = time_windows.copy()
-    time_windows.mask[:] = True
-    for start, stop in final_windows:
-        time_windows.mask[start:stop] = False
-    if plot:
+        time_windows = ~intervals.to_mask(candidates, npts)
         plt.subplot2grid(grid, (27, 0), rowspan=1)
         _plot_mask(time_windows, old_time_windows,
                    name="PEAK AND TROUGH MARCHING ELIMINATION")
+    if stats is not None:
+        stats.stage("peak_trough_marching", candidates)
 
     # Loop through all the time windows, remove windows not satisfying the
     # minimum number of peaks and troughs per window. Acts mainly as a
     # safety guard.
-    old_time_windows = time_windows.copy()
-    for i in flatnotmasked_contiguous(old_time_windows):
-        synthetic_window = synth[i.start: i.stop]
-        data_window = data[i.start: i.stop]
-        data_p, data_t = find_local_extrema(data_window)
-        synth_p, synth_t = find_local_extrema(synthetic_window)
+    keep = np.ones(len(candidates[0]), dtype=bool)
+    for k, (i_start, i_stop) in enumerate(zip(*candidates)):
+        data_p, data_t = _window_extrema(data, i_start, i_stop, extrema,
+                                         "data")
+        synth_p, synth_t = _window_extrema(synth, i_start, i_stop, extrema,
+                                           "synth")
         if np.min([len(synth_p), len(synth_t), len(data_p), len(data_t)]) < \
                 min_peaks_troughs:
-            time_windows.mask[i.start: i.stop] = True
+            keep[k] = False
+    candidates = candidates[0][keep], candidates[1][keep]
     if plot:
+        old_time_windows = time_windows.copy()
+        time_windows = ~intervals.to_mask(candidates, npts)
         plt.subplot2grid(grid, (28, 0), rowspan=1)
         _plot_mask(time_windows, old_time_windows,
                    name="PEAK/TROUGH COUNT ELIMINATION")
+    if stats is not None:
+        stats.stage("peak_trough_count", candidates)
 
     # Second minimum window length elimination stage.
     if plot:
         old_time_windows = time_windows.copy()
     min_length = \
         min(minimum_period / dt * min_length_period, maximum_period / dt)
-    for i in flatnotmasked_contiguous(time_windows):
-        # Step 7: Throw away all windows with a length of less then
-        # min_length_period the dominant period.
-        if (i.stop - i.start) < min_length:
-            time_windows.mask[i.start: i.stop] = True
+    # Step 7: Throw away all windows with a length of less then
+    # min_length_period the dominant period.
+    candidates = intervals.min_length(candidates, min_length)
     if plot:
+        time_windows = ~intervals.to_mask(candidates, npts)
         plt.subplot2grid(grid, (29, 0), rowspan=1)
         _plot_mask(time_windows, old_time_windows,
                    name="MINIMUM WINDOW LENGTH ELIMINATION 2")
+    if stats is not None:
+        stats.stage("min_length_2", candidates)
 
     # Final step, eliminating windows with little energy.
     final_windows = []
-    for j in flatnotmasked_contiguous(time_windows):
+    for j_start, j_stop in zip(*candidates):
         # Again assert a certain minimal length.
-        if (j.stop - j.start) < min_length:
+        if (j_stop - j_start) < min_length:
             continue
 
         # Compare the energy in the data window and the synthetic window.
-        data_energy = (data[j.start: j.stop] ** 2).sum()
-        synth_energy = (synth[j.start: j.stop] ** 2).sum()
+        data_energy = (data[j_start: j_stop] ** 2).sum()
+        synth_energy = (synth[j_start: j_stop] ** 2).sum()
         energies = sorted([data_energy, synth_energy])
         if energies[1] > max_energy_ratio * energies[0]:
             if verbose:
                 _log_window_selection(
-                    data_trace.id,
+                    tr_id,
                     "Deselecting window due to energy ratio between "
                     "data and synthetics.")
             continue
 
         # Check that amplitudes in the data are above the noise
-        if noise_absolute / data[j.start: j.stop].ptp() > \
+        if noise_absolute / data[j_start: j_stop].ptp() > \
                 max_noise_window:
             if verbose:
                 _log_window_selection(
-                    data_trace.id,
+                    tr_id,
                     "Deselecting window due having no amplitude above the "
                     "signal to noise ratio.")
-        final_windows.append((j.start, j.stop))
+        final_windows.append((int(j_start), int(j_stop)))
 
     if plot:
         old_time_windows = time_windows.copy()
-    time_windows.mask[:] = True
-    for start, stop in final_windows:
-        time_windows.mask[start:stop] = False
-
-    if plot:
+        time_windows = np.ones(npts, dtype=bool)
+        for start, stop in final_windows:
+            time_windows[start:stop] = False
         plt.subplot2grid(grid, (30, 0), rowspan=1)
         _plot_mask(time_windows, old_time_windows,
                    name="LITTLE ENERGY ELIMINATION")
+    if stats is not None:
+        stats.stage("little_energy", intervals.from_bounds(
+            [start for start, _ in final_windows],
+            [stop for _, stop in final_windows]))
 
     if verbose:
         _log_window_selection(
-            data_trace.id,
+            tr_id,
             "Done, Selected %i window(s)" % len(final_windows))
 
+    return final_windows
+
+
+def select_windows(data_trace, synthetic_trace, event_latitude,
+                   event_longitude, event_depth_in_km,
+                   station_latitude, station_longitude, minimum_period,
+                   maximum_period,
+                   min_cc=0.10, max_noise=0.10, max_noise_window=0.4,
+                   min_velocity=2.4, threshold_shift=0.30,
+                   threshold_correlation=0.75, min_length_period=1.5,
+                   min_peaks_troughs=2, max_energy_ratio=10.0,
+                   min_envelope_similarity=0.2,
+                   verbose=False, plot=False, first_arrival_table=None,
+                   dist_in_deg=None, dist_in_km=None, stats=None,
+                   cc_step_period=0.0):
+    """
+    Window selection algorithm for picking windows suitable for misfit
+    calculation based on phase differences.
+
+    Returns a list of windows which might be empty due to various reasons.
+
+    This function is really long and a lot of things. For a more detailed
+    description, please see the LASIF paper.
+
+    :param data_trace: The data trace.
+    :type data_trace: :class:`~obspy.core.trace.Trace`
+    :param synthetic_trace: The synthetic trace.
+    :type synthetic_trace: :class:`~obspy.core.trace.Trace`
+    :param event_latitude: The event latitude.
+    :type event_latitude: float
+    :param event_longitude: The event longitude.
+    :type event_longitude: float
+    :param event_depth_in_km: The event depth in km.
+    :type event_depth_in_km: float
+    :param station_latitude: The station latitude.
+    :type station_latitude: float
+    :param station_longitude: The station longitude.
+    :type station_longitude: float
+    :param minimum_period: The minimum period of the data in seconds.
+    :type minimum_period: float
+    :param maximum_period: The maximum period of the data in seconds.
+    :type maximum_period: float
+    :param min_cc: Minimum normalised correlation coefficient of the
+        complete traces.
+    :type min_cc: float
+    :param max_noise: Maximum relative noise level for the whole trace.
+        Measured from maximum amplitudes before and after the first arrival.
+    :type max_noise: float
+    :param max_noise_window: Maximum relative noise level for individual
+        windows.
+    :type max_noise_window: float
+    :param min_velocity: All arrivals later than those corresponding to the
+        threshold velocity [km/s] will be excluded.
+    :type min_velocity: float
+    :param threshold_shift: Maximum allowable time shift within a window,
+        as a fraction of the minimum period.
+    :type threshold_shift: float
+    :param threshold_correlation: Minimum normalised correlation coeeficient
+        within a window.
+    :type threshold_correlation: float
+    :param min_length_period: Minimum length of the time windows relative to
+        the minimum period.
+    :type min_length_period: float
+    :param min_peaks_troughs: Minimum number of extrema in an individual
+        time window (excluding the edges).
+    :type min_peaks_troughs: float
+    :param max_energy_ratio: Maximum energy ratio between data and
+        synthetics within a time window. Don't make this too small!
+    :type max_energy_ratio: float
+    :param min_envelope_similarity: The minimum similarity of the envelopes of
+        both data and synthetics. This essentially assures that the
+        amplitudes of data and synthetics can not diverge too much within a
+        window. It is a bit like the inverse of the ratio of both envelopes
+        so a value of 0.2 makes sure neither amplitude can be more then 5
+        times larger than the other.
+    :type min_envelope_similarity: float
+    :param verbose: No output by default.
+    :type verbose: bool
+    :param plot: Create a plot of the algortihm while it does its work.
+    :type plot: bool
+    :param first_arrival_table: If given, the first arrival is interpolated
+        from this table instead of being computed with TauPy.
+    :type first_arrival_table:
+        :class:`~oval_office_2.mini_lasif.traveltime_table.FirstArrivalTable`
+    :param dist_in_deg: The epicentral distance in degree, if already
+        computed for all stations of the event, see
+        :func:`~oval_office_2.mini_lasif.geodesy.event_station_distances`.
+    :type dist_in_deg: float
+    :param dist_in_km: The epicentral distance in km, see dist_in_deg.
+    :type dist_in_km: float
+    :param stats: If given, the wall time and the remaining samples and
+        windows of every stage are recorded in it.
+    :type stats:
+        :class:`~oval_office_2.mini_lasif.selection_stats.SelectionStats`
+    :param cc_step_period: If larger than zero, the sliding cross
+        correlations are only computed for windows spaced by this fraction
+        of the minimum period and interpolated in between, see
+        approximate_sliding_cross_correlation(). Faster, but the windows
+        differ slightly from the exact ones.
+    :type cc_step_period: float
+    """
+    # Shortcuts to frequently accessed variables.
+    data_starttime = data_trace.stats.starttime
+    data_delta = data_trace.stats.delta
+    dt = data_trace.stats.delta
+    npts = data_trace.stats.npts
+    synth = synthetic_trace.data
+    data = data_trace.data
+    times = data_trace.times()
+    if stats is not None:
+        stats.begin(data_trace.id, npts)
+
+    # -------------------------------------------------------------------------
+    # Geographical calculations and the time of the first arrival.
+    # -------------------------------------------------------------------------
+    if dist_in_deg is None:
+        dist_in_deg = geodetics.locations2degrees(
+            station_latitude, station_longitude, event_latitude,
+            event_longitude)
+    if dist_in_km is None:
+        dist_in_km = geodetics.calcVincentyInverse(
+            station_latitude, station_longitude, event_latitude,
+            event_longitude)[0] / 1000.0
+
+    # Assumes the first sample is the centroid time of the event.
+    first_tt_arrival = _first_arrival(event_depth_in_km, dist_in_deg,
+                                      first_arrival_table)
+
+    # -------------------------------------------------------------------------
+    # Window settings
+    # -------------------------------------------------------------------------
+    taper = _window_taper(minimum_period, dt)
+
+    # =========================================================================
+    # check if whole seismograms are sufficiently correlated and estimate
+    # noise level
+    # =========================================================================
+
+    # Overall Correlation coefficient.
+    norm = np.sqrt(np.sum(data ** 2)) * np.sqrt(np.sum(synth ** 2))
+    cc = np.sum(data * synth) / norm
+    if verbose:
+        _log_window_selection(data_trace.id,
+                              "Correlation Coefficient: %.4f" % cc)
+
+    # Estimate noise level from waveforms prior to the first arrival.
+    idx_start, idx_end = _noise_indices(first_tt_arrival, minimum_period, dt)
+    abs_data = np.abs(data)
+    noise_absolute = abs_data[int(idx_start):int(idx_end)].max()
+    noise_relative = noise_absolute / abs_data.max()
+
+    if verbose:
+        _log_window_selection(data_trace.id,
+                              "Absolute Noise Level: %e" % noise_absolute)
+        _log_window_selection(data_trace.id,
+                              "Relative Noise Level: %e" % noise_relative)
+
+    # Basic global rejection criteria.
+    accept_traces = True
+    if (cc < min_cc) and (noise_relative > max_noise / 3.0):
+        msg = "Correlation %.4f is below threshold of %.4f" % (cc, min_cc)
+        if verbose:
+            _log_window_selection(data_trace.id, msg)
+        accept_traces = msg
+        criterion = "correlation"
+
+    if noise_relative > max_noise:
+        msg = "Noise level %.3f is above threshold of %.3f" % (
+            noise_relative, max_noise)
+        if verbose:
+            _log_window_selection(
+                data_trace.id, msg)
+        accept_traces = msg
+        criterion = "noise"
+
+    # Calculate the envelope of both data and synthetics. This is to make sure
+    # that the amplitude of both is not too different over time and is
+    # used as another selector. Only calculated if the trace is generally
+    # accepted as it is fairly slow.
+    if accept_traces is True:
+        data_env = envelope(data)
+        synth_env = envelope(synth)
+    if stats is not None:
+        if accept_traces is True:
+            stats.stage("global", (np.array([0]), np.array([npts])))
+        else:
+            stats.stage("global", intervals.empty())
+            stats.reject(criterion)
+
+    # -------------------------------------------------------------------------
+    # Initial Plot setup.
+    # -------------------------------------------------------------------------
+    # All the plot calls are interleaved. I realize this is really ugly but
+    # the alternative would be to either have two functions (one with plots,
+    # one without) or split the plotting function in various subfunctions,
+    # neither of which are acceptable in my opinion. The impact on
+    # performance is minimal if plotting is turned off: all imports are lazy
+    # and a couple of conditionals are cheap.
+    if plot:
+        import matplotlib.pylab as plt  # NOQA
+        import matplotlib.patheffects as PathEffects  # NOQA
+
+        if accept_traces is True:
+            plt.figure(figsize=(18, 12))
+            plt.subplots_adjust(left=0.05, bottom=0.05, right=0.98, top=0.95,
+                                wspace=None, hspace=0.0)
+            grid = (31, 1)
+
+            # Axes showing the data.
+            data_plot = plt.subplot2grid(grid, (0, 0), rowspan=8)
+        else:
+            # Only show one axes it the traces are not accepted.
+            plt.figure(figsize=(18, 3))
+
+        # Plot envelopes if needed.
+        if accept_traces is True:
+            plt.plot(times, data_env, color="black", alpha=0.5, lw=0.4,
+                     label="data envelope")
+            plt.plot(synthetic_trace.times(), synth_env, color="#e41a1c",
+                     alpha=0.4, lw=0.5, label="synthetics envelope")
+
+        plt.plot(times, data, color="black", label="data", lw=1.5)
+        plt.plot(synthetic_trace.times(), synth, color="#e41a1c",
+                 label="synthetics",  lw=1.5)
+
+        # Symmetric around y axis.
+        middle = data.mean()
+        d_max, d_min = data.max(), data.min()
+        r = max(d_max - middle, middle - d_min) * 1.1
+        ylim = (middle - r, middle + r)
+        xlim = (times[0], times[-1])
+        plt.ylim(*ylim)
+        plt.xlim(*xlim)
+
+        offset = (xlim[1] - xlim[0]) * 0.005
+        plt.vlines(first_tt_arrival, ylim[0], ylim[1], colors="#ff7f00", lw=2)
+        plt.text(first_tt_arrival + offset,
+                 ylim[1] - (ylim[1] - ylim[0]) * 0.02,
+                 "first arrival", verticalalignment="top",
+                 horizontalalignment="left", color="#ee6e00",
+                 path_effects=[
+                     PathEffects.withStroke(linewidth=3, foreground="white")])
+
+        plt.vlines(first_tt_arrival - minimum_period / 2.0, ylim[0], ylim[1],
+                   colors="#ff7f00", lw=2)
+        plt.text(first_tt_arrival - minimum_period / 2.0 - offset,
+                 ylim[0] + (ylim[1] - ylim[0]) * 0.02,
+                 "first arrival - min period / 2", verticalalignment="bottom",
+                 horizontalalignment="right", color="#ee6e00",
+                 path_effects=[
+                     PathEffects.withStroke(linewidth=3, foreground="white")])
+
+        for velocity in [6, 5, 4, 3, min_velocity]:
+            tt = dist_in_km / velocity
+            plt.vlines(tt, ylim[0], ylim[1], colors="gray", lw=2)
+            if velocity == min_velocity:
+                hal = "right"
+                o_s = -1.0 * offset
+            else:
+                hal = "left"
+                o_s = offset
+            plt.text(tt + o_s, ylim[0] + (ylim[1] - ylim[0]) * 0.02,
+                     str(velocity) + " km/s", verticalalignment="bottom",
+                     horizontalalignment=hal, color="0.15")
+        plt.vlines(dist_in_km / min_velocity + minimum_period / 2.0,
+                   ylim[0], ylim[1], colors="gray", lw=2)
+        plt.text(dist_in_km / min_velocity + minimum_period / 2.0 - offset,
+                 ylim[1] - (ylim[1] - ylim[0]) * 0.02,
+                 "min surface velocity + min period / 2",
+                 verticalalignment="top",
+                 horizontalalignment="right", color="0.15", path_effects=[
+                     PathEffects.withStroke(linewidth=3, foreground="white")])
+
+        plt.hlines(noise_absolute, xlim[0], xlim[1], linestyle="--",
+                   color="gray")
+        plt.hlines(-noise_absolute, xlim[0], xlim[1], linestyle="--",
+                   color="gray")
+        plt.text(offset, noise_absolute + (ylim[1] - ylim[0]) * 0.01,
+                 "noise level", verticalalignment="bottom",
+                 horizontalalignment="left", color="0.15",
+                 path_effects=[
+                     PathEffects.withStroke(linewidth=3, foreground="white")])
+        plt.legend(loc="lower right", fancybox=True, framealpha=0.5,
+                   fontsize="small")
+        plt.gca().xaxis.set_ticklabels([])
+
+        # Plot the basic global information.
+        ax = plt.gca()
+        txt = (
+            "Total CC Coeff: %.4f\nAbsolute Noise: %e\nRelative Noise: %.3f"
+            % (cc, noise_absolute, noise_relative))
+        ax.text(0.01, 0.95, txt, transform=ax.transAxes,
+                fontdict=dict(fontsize="small", ha='left', va='top'),
+                bbox=dict(boxstyle="round", fc="w", alpha=0.8))
+        plt.suptitle("Channel %s" % data_trace.id, fontsize="larger")
+
+    # Show plot and return if not accepted.
+        if accept_traces is not True:
+            txt = "Rejected: %s" % (accept_traces)
+            ax.text(0.99, 0.95, txt, transform=ax.transAxes,
+                    fontdict=dict(fontsize="small", ha='right', va='top'),
+                    bbox=dict(boxstyle="round", fc="red", alpha=1.0))
+            plt.show()
+    if accept_traces is not True:
+        return []
+
+    final_windows = _select_index_windows(
+        data, synth, dt, first_tt_arrival, dist_in_km, noise_absolute,
+        data_env, synth_env, taper, minimum_period, maximum_period,
+        max_noise_window, min_velocity, threshold_shift,
+        threshold_correlation, min_length_period, min_peaks_troughs,
+        max_energy_ratio, min_envelope_similarity, data_trace.id,
+        verbose=verbose, plot=plot, stats=stats,
+        cc_step=_cc_step(cc_step_period, minimum_period, dt))
+
     # Final step is to convert the index value windows to actual times.
     windows = []
     for start, stop in final_windows:
@@ -896,6 +1213,303 @@ def select_windows(data_trace, synthetic_trace, event_latitude,
     return windows
 
 
+def select_windows_stream(data, synthetics, starttime, delta, event_latitude,
+                          event_longitude, event_depth_in_km,
+                          station_latitudes, station_longitudes,
+                          minimum_period, maximum_period,
+                          min_cc=0.10, max_noise=0.10, max_noise_window=0.4,
+                          min_velocity=2.4, threshold_shift=0.30,
+                          threshold_correlation=0.75, min_length_period=1.5,
+                          min_peaks_troughs=2, max_energy_ratio=10.0,
+                          min_envelope_similarity=0.2, verbose=False,
+                          first_arrival_table=None, ids=None, stats=None,
+                          cc_step_period=0.0):
+    """
+    Window selection for all traces of an event at once, with the same
+    results as select_windows() for every single trace.
+
+    The traces have to be aligned: same start time, sampling rate and
+    number of samples. The distances, first arrivals, global rejection
+    criteria and envelopes are computed for all traces with a few array
+    operations, only the elimination stages run per accepted trace.
+
+    Returns a list with the list of windows of every trace.
+
+    :param data: The data, an array of shape (n_traces, npts).
+    :type data: :class:`numpy.ndarray`
+    :param synthetics: The synthetics, same shape as data.
+    :type synthetics: :class:`numpy.ndarray`
+    :param starttime: The start time of all traces.
+    :type starttime: :class:`~obspy.core.utcdatetime.UTCDateTime`
+    :param delta: The sampling interval of all traces in seconds.
+    :type delta: float
+    :param station_latitudes: The latitudes of the stations of all traces.
+    :type station_latitudes: :class:`numpy.ndarray`
+    :param station_longitudes: The longitudes of the stations of all traces.
+    :type station_longitudes: :class:`numpy.ndarray`
+    :param ids: The ids of the traces, used for the verbose output and the
+        statistics.
+    :type ids: list of str
+    :param stats: Like for select_windows(). The time of the "global" stage,
+        which is computed for all traces at once, is shared equally by the
+        traces.
+    :type stats:
+        :class:`~oval_office_2.mini_lasif.selection_stats.SelectionStats`
+
+    All other parameters are the ones of select_windows().
+    """
+    data = np.asarray(data)
+    synth = np.asarray(synthetics)
+    if data.ndim != 2 or data.shape != synth.shape:
+        raise ValueError("Data and synthetics must be arrays of the same "
+                         "shape (n_traces, npts).")
+    n_traces, npts = data.shape
+    dt = delta
+    start_time = time.time()
+    if ids is None:
+        ids = [str(i) for i in xrange(n_traces)]
+
+    # -------------------------------------------------------------------------
+    # Geographical calculations and the time of the first arrival.
+    # -------------------------------------------------------------------------
+    dists_in_deg, dists_in_km = event_station_distances(
+        event_latitude, event_longitude, station_latitudes,
+        station_longitudes)
+    depths_in_km = np.ones(n_traces) * event_depth_in_km
+    if first_arrival_table is not None:
+        in_table = first_arrival_table.contains(depths_in_km, dists_in_deg)
+    else:
+        in_table = np.zeros(n_traces, dtype=np.bool)
+    first_tt_arrivals = np.empty(n_traces)
+    if in_table.any():
+        first_tt_arrivals[in_table] = first_arrival_table(
+            depths_in_km[in_table], dists_in_deg[in_table])
+    # Traces outside of the table fall back to TauPy.
+    for i in np.where(~in_table)[0]:
+        first_tt_arrivals[i] = _first_arrival(event_depth_in_km,
+                                              dists_in_deg[i])
+
+    taper = _window_taper(minimum_period, dt)
+
+    # =========================================================================
+    # check if whole seismograms are sufficiently correlated and estimate
+    # noise level
+    # =========================================================================
+    norm = np.sqrt(np.sum(data ** 2, axis=1)) * \
+        np.sqrt(np.sum(synth ** 2, axis=1))
+    cc = np.sum(data * synth, axis=1) / norm
+
+    # Noise level prior to the first arrival, all noise windows are gathered
+    # into one array padded with zeros.
+    idx_start, idx_end = _noise_indices(first_tt_arrivals, minimum_period, dt)
+    if np.any(idx_start >= npts):
+        raise ValueError("The noise window of a trace starts after its "
+                         "last sample.")
+    noise_samples = idx_start[:, np.newaxis] + \
+        np.arange((idx_end - idx_start).max())
+    noise_windows = np.abs(data[np.arange(n_traces)[:, np.newaxis],
+                                np.minimum(noise_samples, npts - 1)])
+    noise_absolute = np.where(
+        noise_samples < np.minimum(idx_end, npts)[:, np.newaxis],
+        noise_windows, 0).max(axis=1)
+    noise_relative = noise_absolute / np.abs(data).max(axis=1)
+
+    # Basic global rejection criteria.
+    rejected_cc = (cc < min_cc) & (noise_relative > max_noise / 3.0)
+    rejected_noise = noise_relative > max_noise
+    if verbose:
+        for i in xrange(n_traces):
+            _log_window_selection(ids[i], "Correlation Coefficient: %.4f" %
+                                  cc[i])
+            _log_window_selection(ids[i], "Absolute Noise Level: %e" %
+                                  noise_absolute[i])
+            _log_window_selection(ids[i], "Relative Noise Level: %e" %
+                                  noise_relative[i])
+            if rejected_cc[i]:
+                _log_window_selection(
+                    ids[i], "Correlation %.4f is below threshold of %.4f" % (
+                        cc[i], min_cc))
+            if rejected_noise[i]:
+                _log_window_selection(
+                    ids[i], "Noise level %.3f is above threshold of %.3f" % (
+                        noise_relative[i], max_noise))
+    accepted = np.flatnonzero(~(rejected_cc | rejected_noise))
+    if stats is not None:
+        global_seconds = (time.time() - start_time) / n_traces
+        for i in np.flatnonzero(rejected_cc | rejected_noise):
+            stats.begin(ids[i], npts)
+            stats.stage("global", intervals.empty(), seconds=global_seconds)
+            stats.reject("noise" if rejected_noise[i] else "correlation")
+
+    # The envelopes of the accepted traces are computed in chunks of traces
+    # to bound the memory.
+    windows = [[] for _ in xrange(n_traces)]
+    chunk_size = max(1, MAX_SLIDING_CHUNK_ELEMENTS // npts)
+    for first in xrange(0, len(accepted), chunk_size):
+        chunk = accepted[first:first + chunk_size]
+        chunk_time = time.time()
+        data_env = envelope(data[chunk])
+        synth_env = envelope(synth[chunk])
+        if stats is not None:
+            envelope_seconds = (time.time() - chunk_time) / len(chunk)
+        for k, i in enumerate(chunk):
+            if stats is not None:
+                stats.begin(ids[i], npts)
+                stats.stage("global", (np.array([0]), np.array([npts])),
+                            seconds=global_seconds + envelope_seconds)
+            final_windows = _select_index_windows(
+                data[i], synth[i], dt, first_tt_arrivals[i], dists_in_km[i],
+                noise_absolute[i], data_env[k], synth_env[k], taper,
+                minimum_period, maximum_period, max_noise_window,
+                min_velocity, threshold_shift, threshold_correlation,
+                min_length_period, min_peaks_troughs, max_energy_ratio,
+                min_envelope_similarity, ids[i], verbose=verbose,
+                stats=stats, cc_step=_cc_step(cc_step_period, minimum_period,
+                                              dt))
+            windows[i] = [(starttime + start * delta, starttime + stop * delta)
+                          for start, stop in final_windows]
+
+    return windows
+
+
+def _selection_parameters(parameters):
+    """
+    Returns SELECTION_PARAMETERS updated with the given ones.
+    """
+    unknown = set(parameters) - set(SELECTION_PARAMETERS)
+    if unknown:
+        raise ValueError("Unknown window selection parameters: %s" %
+                         ", ".join(sorted(unknown)))
+    values = dict(SELECTION_PARAMETERS)
+    values.update(parameters)
+    return values
+
+
+def select_windows_sweep(data_trace, synthetic_trace, event_latitude,
+                         event_longitude, event_depth_in_km,
+                         station_latitude, station_longitude, minimum_period,
+                         maximum_period, parameter_sets,
+                         first_arrival_table=None, dist_in_deg=None,
+                         dist_in_km=None, cc_step_period=0.0):
+    """
+    Window selection of a trace for many sets of thresholds, with the same
+    results as select_windows() for each of them.
+
+    The intermediates that do not depend on the thresholds are computed only
+    once: the global correlation and noise level, the envelopes, the sliding
+    cross correlations of all windows within reach of any of the sets and
+    the extrema of the candidate windows. Every set then only runs the
+    cheap elimination stages.
+
+    Returns a list with the list of windows of every parameter set.
+
+    :param parameter_sets: Dictionaries with the thresholds of
+        select_windows(), e.g. {"threshold_shift": 0.2}. Missing ones take
+        the defaults of select_windows(), see SELECTION_PARAMETERS.
+    :type parameter_sets: list of dict
+
+    All other parameters are the ones of select_windows(). With a
+    cc_step_period, the correlated windows are spaced from the first window
+    any set can reach, so the windows may differ slightly from the ones of
+    select_windows() with the same cc_step_period.
+    """
+    parameter_sets = [_selection_parameters(parameters)
+                      for parameters in parameter_sets]
+    data_starttime = data_trace.stats.starttime
+    dt = data_trace.stats.delta
+    npts = data_trace.stats.npts
+    synth = synthetic_trace.data
+    data = data_trace.data
+
+    if dist_in_deg is None:
+        dist_in_deg = geodetics.locations2degrees(
+            station_latitude, station_longitude, event_latitude,
+            event_longitude)
+    if dist_in_km is None:
+        dist_in_km = geodetics.calcVincentyInverse(
+            station_latitude, station_longitude, event_latitude,
+            event_longitude)[0] / 1000.0
+    first_tt_arrival = _first_arrival(event_depth_in_km, dist_in_deg,
+                                      first_arrival_table)
+    taper = _window_taper(minimum_period, dt)
+
+    # Global correlation coefficient and noise level.
+    norm = np.sqrt(np.sum(data ** 2)) * np.sqrt(np.sum(synth ** 2))
+    cc = np.sum(data * synth) / norm
+    idx_start, idx_end = _noise_indices(first_tt_arrival, minimum_period, dt)
+    abs_data = np.abs(data)
+    noise_absolute = abs_data[int(idx_start):int(idx_end)].max()
+    noise_relative = noise_absolute / abs_data.max()
+
+    sliding = None
+    extrema = {}
+    results = []
+    for parameters in parameter_sets:
+        if ((cc < parameters["min_cc"]) and
+                (noise_relative > parameters["max_noise"] / 3.0)) or \
+                noise_relative > parameters["max_noise"]:
+            results.append([])
+            continue
+
+        # The expensive intermediates, once the first set accepts the trace.
+        if sliding is None:
+            data_env = envelope(data)
+            synth_env = envelope(synth)
+            min_idx, max_idx = _traveltime_bounds(
+                first_tt_arrival, dist_in_km,
+                min(p["min_velocity"] for p in parameter_sets),
+                minimum_period, dt)
+            half_length = len(taper) // 2
+            midpoints = np.arange(
+                max(min_idx + 1, half_length),
+                min(max_idx, npts - len(taper) + half_length + 1))
+            sliding = (np.zeros(npts), np.zeros(npts, dtype=np.int64),
+                       np.zeros(npts))
+            if len(midpoints):
+                for full, values in zip(
+                        sliding, approximate_sliding_cross_correlation(
+                            data, synth, taper, midpoints,
+                            _cc_step(cc_step_period, minimum_period, dt))):
+                    full[midpoints] = values
+
+        final_windows = _select_index_windows(
+            data, synth, dt, first_tt_arrival, dist_in_km, noise_absolute,
+            data_env, synth_env, taper, minimum_period, maximum_period,
+            parameters["max_noise_window"], parameters["min_velocity"],
+            parameters["threshold_shift"], parameters["threshold_correlation"],
+            parameters["min_length_period"], parameters["min_peaks_troughs"],
+            parameters["max_energy_ratio"],
+            parameters["min_envelope_similarity"], data_trace.id,
+            sliding=sliding, extrema=extrema)
+        results.append([(data_starttime + start * dt,
+                         data_starttime + stop * dt)
+                        for start, stop in final_windows])
+
+    return results
+
+
+def window_agreement(reference, windows):
+    """
+    Compares the windows of a trace with reference windows, e.g. the ones
+    picked with and without cc_step_period.
+
+    Returns a tuple with the windowed time of the reference, of windows and
+    of both, in seconds.
+
+    :param reference: The reference windows, a list of (start, stop)
+        tuples as returned by select_windows().
+    :param windows: The windows to compare, same format.
+
+    >>> window_agreement([(0.0, 10.0), (20.0, 30.0)], [(5.0, 25.0)])
+    (20.0, 20.0, 10.0)
+    """
+    common = sum(max(0.0, min(stop, other_stop) - max(start, other_start))
+                 for start, stop in reference
+                 for other_start, other_stop in windows)
+    return (sum(stop - start for start, stop in reference),
+            sum(stop - start for start, stop in windows), common)
+
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
@@ -161,6 +161,32 @@ def create_adjoint_sources(config, nodes, ntasks, time, ntasks_per_node, cpus_pe
     _run_task(task)
 
 
+@cli.command()
+@click.option("--nodes", default=1, type=int, help="Total number of nodes.")
+@click.option("--ntasks", default=1, type=int, help="Total number of cores.")
+@click.option("--time", required=True, type=str, help="Wall time.")
+@click.option("--ntasks-per-node", default=1, help="Cores per node.")
+@click.option("--cpus-per-task", default=8, help="Threads per core.")
+@click.option("--account", default="ch1", help="Account name.")
+@click.option("--job-name", default="compute_misfits", help="Name of slurm job.")
+@click.option("--output", default="compute_misfits.stdout", help="Capture stdout.")
+@click.option("--error", default="compute_misfits.stderr", help="Capture stderr.")
+@click.option("--event", multiple=True, help="Only compute the misfits of this event. Can be repeated.")
+@click.option("--step-length", is_flag=True, help="Only compute the misfits of the step length test events.")
+@pass_config
+def compute_misfits(config, nodes, ntasks, time, ntasks_per_node, cpus_per_task,
+                    account, job_name, output, error, event, step_length):
+    """Computes the misfits of preprocessed and synthetic data without the adjoint sources."""
+
+    _, _, _, sbatch_dict = inspect.getargvalues(inspect.currentframe())
+    sbatch_dict.pop("config")
+    sbatch_dict["execute"] = 'srun compute_misfits.py'
+
+    system = _connect_to_system(config)
+    task = tasks.task_map['ComputeMisfits'](system, config, sbatch_dict, event, step_length)
+    _run_task(task)
+
+
 @cli.command()
 @click.option("--nodes", default=1, type=int, help="Total number of nodes.")
 @click.option("--ntasks", default=1, type=int, help="Total number of cores.")
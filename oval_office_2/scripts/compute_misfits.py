@@ -0,0 +1,47 @@
+#!/users/afanasm/anaconda/bin/python
+# -*- coding:utf-8 -*-
+
+import cPickle
+import multiprocessing
+from functools import partial
+from itertools import repeat
+
+from oval_office_2.mini_lasif import time_frequency
+from oval_office_2.scripts.create_adjoint_sources import windows_for_event, print_cache_report
+
+
+def main():
+    """Computes the misfits of all events in lasif_data.p without the adjoint
+    sources, e.g. to compare the trial models of a step length test. Writes
+    misfit.p in the same format as create_adjoint_sources.py."""
+
+    with open('lasif_data.p', 'rb') as fh:
+        project_info = cPickle.load(fh)
+
+    iteration_info = project_info[1]
+    data_type = project_info[2]['input_data_type']
+    adjoint_options = dict(project_info[2].get('adjoint_source_options', {}))
+    adjoint_options['misfit_only'] = True
+    misfit_type = project_info[2].get('misfit_type')
+    tf_cache = project_info[2].get('tf_cache')
+    min_period = 1 / iteration_info['lowpass']
+    max_period = 1 / iteration_info['highpass']
+
+    # Set before the workers are forked, so every worker has the budget.
+    if project_info[2].get('plan_cache_max_bytes'):
+        time_frequency.set_plan_cache_max_bytes(project_info[2]['plan_cache_max_bytes'])
+
+    pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
+    all_misfits = pool.map(partial(windows_for_event, misfit_type=misfit_type, tf_cache=tf_cache,
+                                   **adjoint_options), zip(project_info[0].keys(),
+                                              repeat(min_period), repeat(max_period), repeat(data_type)))
+
+    misfits = [(x[0], x[2]) for x in all_misfits]
+    with open('misfit.p', 'wb') as fh:
+        cPickle.dump(misfits, fh)
+
+    if tf_cache:
+        print_cache_report(tf_cache['directory'])
+
+if __name__ == "__main__":
+    main()
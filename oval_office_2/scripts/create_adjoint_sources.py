@@ -4,14 +4,16 @@
 import cPickle
 import multiprocessing
 import os
+from functools import partial
 from itertools import repeat
 
 import numpy as np
 import obspy
 
-from oval_office_2.mini_lasif import LASIFAdjointSourceCalculationError
-from oval_office_2.mini_lasif.ad_src_tf_phase_misfit import adsrc_tf_phase_misfit
-from oval_office_2.mini_lasif.ad_src_cc_time_shift import adsrc_cc_time_shift
+from oval_office_2.mini_lasif import time_frequency
+from oval_office_2.mini_lasif.tf_cache import TFCache, content_hash, read_cache_log
+from oval_office_2.mini_lasif.ad_src_windows import adsrc_windows
+from oval_office_2.mini_lasif.misfits import DEFAULT_MISFIT_TYPES, get_misfit_function
 
 
 def scale(dat, syn):
@@ -20,10 +22,21 @@ def scale(dat, syn):
     dat.data *= scale_fac
 
 
-def windows_for_event((event, min_period, max_period, data_type)):
+def windows_for_event((event, min_period, max_period, data_type),
+                      window_local=False, misfit_type=None, tf_cache=None, **adjoint_options):
 
     print "Generating adjoint source for {}".format(event)
 
+    # The counters are per process, every worker handles many events. The
+    # plan cache itself is kept, only its counters are reported per event.
+    time_frequency.clear_threshold_info()
+    plan_cache_start = time_frequency.plan_cache_info()
+
+    # Without an explicit misfit, noise correlations use the cc time shift and
+    # earthquakes the time frequency phase misfit.
+    misfit_type = misfit_type or DEFAULT_MISFIT_TYPES[data_type]
+    adjoint_source_function = get_misfit_function(misfit_type)
+
     try:
         with open(os.path.join(event, 'windows.p'), 'rb') as fh:
             event_windows = cPickle.load(fh)
@@ -33,8 +46,15 @@ def windows_for_event((event, min_period, max_period, data_type)):
         print "Unable to read window/data/syn for {}".format(event)
         return (event, {}, {})
 
+    # The time frequency quantities of the data are kept on disk across iterations.
+    cache = None
+    if tf_cache:
+        cache = TFCache(tf_cache['directory'], tf_cache['max_size'])
+
     station_dict = {}
     misfit_dict = {}
+    misfit_cost = 0.0
+    n_windows = 0
     for station, station_windows in event_windows.iteritems():
 
         network, station, component = station.split('.')
@@ -43,56 +63,63 @@ def windows_for_event((event, min_period, max_period, data_type)):
         station_synthetics = synthetics.select(network=network, station=station,
                                                channel='MX{}'.format(component))[0]
 
-        # Scale data to synthetics.
+        # Scale data to synthetics. The cache is keyed on the unscaled data.
+        data_cache = None
+        if cache:
+            data_key = (station_data.id, content_hash(station_data.data), station_data.stats.delta)
         scale(station_data, station_synthetics)
-
-        # Initialize adjoint source.
-        misfit_val = 0.0
+        if cache:
+            data_cache = cache.signal(data_key, station_data.stats.scaling_factor)
+
+        # Sample ranges of the windows.
+        starttime = station_data.stats.starttime
+        delta = station_data.stats.delta
+        window_samples = [(int(round((start - starttime) / delta)),
+                           int(round((end - starttime) / delta + 1)))
+                          for start, end in station_windows]
+        time = np.linspace(0, station_data.stats.npts * station_data.stats.delta, station_data.stats.npts)
+
+        result = adsrc_windows(
+            adjoint_source_function, time, station_data.data, station_synthetics.data,
+            window_samples, min_period, max_period, window_local=window_local,
+            data_cache=data_cache, **adjoint_options)
+        for message in result['messages']:
+            print message
+        misfit_cost += result['cost']
+        n_windows += len(window_samples)
+
+        misfit_val = sum(misfit for misfit in result['misfit_values'] if misfit is not None)
         adjoint_source_array = np.zeros_like(station_data.data)
-        for window in station_windows:
-
-            try:
-                start, end = window
-                samples_from_start = int(round((start - station_data.stats.starttime) / station_data.stats.delta))
-                samples_from_end = int(round((end - station_data.stats.starttime) / station_data.stats.delta + 1))
-                window_slice = slice(samples_from_start, samples_from_end)
-
-                window_data = station_data.slice(
-                    *window, nearest_sample=True).taper(max_percentage=0.10, type='cosine')
-                window_synthetic = station_synthetics.slice(
-                    *window, nearest_sample=True).taper(max_percentage=0.10, type='cosine')
-                time = np.linspace(0, station_data.stats.npts * station_data.stats.delta, station_data.stats.npts)
-
-                window_data.trim(station_data.stats.starttime, station_data.stats.endtime,
-                                 pad=True, fill_value=0.0)
-                window_synthetic.trim(station_data.stats.starttime, station_data.stats.endtime,
-                                 pad=True, fill_value=0.0)
-            # Sometimes, when windows are at the very end of the trace, this function
-            # will fail as the window falls off the end of the trace. This is because
-            # the total running time for SPCEFEM changes whether save_Forward=true, or
-            # save_forward=false.
-            except Exception as e:
-                print e
-                print event, station, window
-                continue
-
-            try:
-                if data_type == 'noise':
-                    adj_dict = adsrc_cc_time_shift(
-                        time, window_data.data, window_synthetic.data, min_period, max_period)
-                else:
-                    adj_dict = adsrc_tf_phase_misfit(
-                        time, window_data.data, window_synthetic.data, min_period, max_period)
-                adjoint_source_array += adj_dict['adjoint_source']
-                misfit_val += adj_dict['misfit_value']
-            except LASIFAdjointSourceCalculationError as e:
-                print e
+        if result['adjoint_source'] is not None:
+            adjoint_source_array += result['adjoint_source']
 
         misfit_dict['{}.{}.{}'.format(network, station, component)] = misfit_val
         station_dict['{}.{}.{}'.format(network, station, component)] = adjoint_source_array
 
+    print "Misfit {} for {}: {} windows, {:.2f} ms per window".format(
+        misfit_type, event, n_windows, 1000.0 * misfit_cost / max(n_windows, 1))
+    plan_cache = time_frequency.plan_cache_info()
+    print "Transform plan cache for {}: {} hits, {} misses".format(
+        event, plan_cache['hits'] - plan_cache_start['hits'],
+        plan_cache['misses'] - plan_cache_start['misses'])
+    if adjoint_options.get('threshold'):
+        print "Energy threshold for {}: skipped {skipped} of {rows} tau rows".format(
+            event, **time_frequency.threshold_info())
+    if cache:
+        print "TF cache for {}: {hits} hits, {misses} misses, hit rate {hit_rate:.2f}".format(
+            event, **cache.info())
+        cache.log_info(tf_cache['iteration'], os.path.basename(os.path.normpath(event)))
+
     return (event, station_dict, misfit_dict)
 
+
+def print_cache_report(directory):
+    """Prints the hit rate of the TF cache of every iteration so far."""
+    for iteration, entry in sorted(read_cache_log(directory).iteritems()):
+        print "TF cache, iteration {}: {hits} hits, {misses} misses, hit rate {hit_rate:.2f}".format(
+            iteration, **entry)
+
+
 def main():
 
     with open('lasif_data.p', 'rb') as fh:
@@ -100,11 +127,19 @@ def main():
 
     iteration_info = project_info[1]
     data_type = project_info[2]['input_data_type']
+    adjoint_options = project_info[2].get('adjoint_source_options', {})
+    misfit_type = project_info[2].get('misfit_type')
+    tf_cache = project_info[2].get('tf_cache')
     min_period = 1 / iteration_info['lowpass']
     max_period = 1 / iteration_info['highpass']
 
+    # Set before the workers are forked, so every worker has the budget.
+    if project_info[2].get('plan_cache_max_bytes'):
+        time_frequency.set_plan_cache_max_bytes(project_info[2]['plan_cache_max_bytes'])
+
     pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
-    all_sources = pool.map(windows_for_event, zip(project_info[0].keys(),
+    all_sources = pool.map(partial(windows_for_event, misfit_type=misfit_type, tf_cache=tf_cache,
+                                   **adjoint_options), zip(project_info[0].keys(),
                                               repeat(min_period), repeat(max_period), repeat(data_type)))
 
     adjoint_sources = [(x[0], x[1]) for x in all_sources]
@@ -114,6 +149,9 @@ def main():
     with open('misfit.p', 'wb') as fh:
         cPickle.dump(misfits, fh)
 
+    if tf_cache:
+        print_cache_report(tf_cache['directory'])
+
 if __name__ == "__main__":
     main()
 
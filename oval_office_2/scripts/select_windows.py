@@ -10,64 +10,45 @@ Project specific function picking windows.
 """
 import cPickle
 import io
+import json
+import os
+import sys
 from itertools import repeat
 
 from ipyparallel import Client
 
 
-def iterate((event, event_info, iteration_info, data_type)):
+def iterate((event, event_info, iteration_info, data_type), first_arrival_table=None, collect_stats=False,
+            parameter_sets=None, cc_step_period=0.0):
     import os
     import obspy
     import cPickle
-    from oval_office_2.mini_lasif.window_selection import select_windows
+    import numpy as np
+    from oval_office_2.mini_lasif.window_selection import select_windows, select_windows_stream, select_windows_sweep
+    from oval_office_2.mini_lasif.traveltime_table import load_first_arrival_table
+    from oval_office_2.mini_lasif.geodesy import event_station_distances
+    from oval_office_2.mini_lasif.selection_stats import SelectionStats, write_event_stats
 
     print 'RUNNING {}'.format(event)
 
+    # First arrivals are interpolated from the project's table if there is one.
+    if first_arrival_table:
+        first_arrival_table = load_first_arrival_table(first_arrival_table)
+
+    # Per stage statistics of the window selection, written next to windows.p.
+    stats = SelectionStats() if collect_stats else None
+
     def scale(dat, syn):
 
         scale_fac = syn.data.ptp() / dat.data.ptp()
         dat.stats.scaling_factor = scale_fac
         dat.data *= scale_fac
 
-    def window_picking_function(data_trace, synthetic_trace, event_latitude,
-                                event_longitude, event_depth_in_km,
-                                station_latitude, station_longitude,
-                                minimum_period, maximum_period, data_type,
-                                **kwargs):  # NOQA
+    def window_picking_parameters(data_type):
         """
-        Function that will be called every time a window is picked. This is part
-        of the project so it can change depending on the project.
-
-        Please keep in mind that you will have to manually update this file to a
-        new version if LASIF is ever updated.
-
-        You can do whatever you want in this function as long as the function
-        signature is honored and the correct data types are returned. You could
-        for example only tweak the window picking parameters but you could also
-        implement your own window picking algorithm or call some other tool that
-        picks windows.
-
-        This function has to return a list of tuples of start and end times,
-        each tuple denoting a selected window.
+        The user adjustable window picking parameters, shared by
+        window_picking_function() and stream_window_picking_function().
 
-        :param data_trace: Trace containing the fully preprocessed data.
-        :type data_trace: :class:`~obspy.core.trace.Trace`
-        :param synthetic_trace: Trace containing the fully preprocessed synthetics.
-        :type synthetic_trace: :class:`~obspy.core.trace.Trace`
-        :param event_latitude: The event latitude.
-        :type event_latitude: float
-        :param event_longitude: The event longitude.
-        :type event_longitude: float
-        :param event_depth_in_km: The event depth in km.
-        :type event_depth_in_km: float
-        :param station_latitude: The station latitude.
-        :type station_latitude: float
-        :param station_longitude: The station longitude.
-        :type station_longitude: float
-        :param minimum_period: The minimum period of data and synthetics.
-        :type minimum_period: float
-        :param maximum_period: The maximum period of data and synthetics.
-        :type maximum_period: float
         :param data_type: earthquake or noise data
         :type data_type: str
         """
@@ -113,6 +94,60 @@ def iterate((event, event_info, iteration_info, data_type)):
         # can be more then 5 times larger than the other.
         min_envelope_similarity = 0.2
 
+        return dict(min_cc=min_cc,
+                    max_noise=max_noise,
+                    max_noise_window=max_noise_window,
+                    min_velocity=min_velocity,
+                    threshold_shift=threshold_shift,
+                    threshold_correlation=threshold_correlation,
+                    min_length_period=min_length_period,
+                    min_peaks_troughs=min_peaks_troughs,
+                    max_energy_ratio=max_energy_ratio,
+                    min_envelope_similarity=min_envelope_similarity)
+
+    def window_picking_function(data_trace, synthetic_trace, event_latitude,
+                                event_longitude, event_depth_in_km,
+                                station_latitude, station_longitude,
+                                minimum_period, maximum_period, data_type,
+                                **kwargs):  # NOQA
+        """
+        Function that will be called every time a window is picked. This is part
+        of the project so it can change depending on the project.
+
+        Please keep in mind that you will have to manually update this file to a
+        new version if LASIF is ever updated.
+
+        You can do whatever you want in this function as long as the function
+        signature is honored and the correct data types are returned. You could
+        for example only tweak the window picking parameters but you could also
+        implement your own window picking algorithm or call some other tool that
+        picks windows.
+
+        This function has to return a list of tuples of start and end times,
+        each tuple denoting a selected window.
+
+        :param data_trace: Trace containing the fully preprocessed data.
+        :type data_trace: :class:`~obspy.core.trace.Trace`
+        :param synthetic_trace: Trace containing the fully preprocessed synthetics.
+        :type synthetic_trace: :class:`~obspy.core.trace.Trace`
+        :param event_latitude: The event latitude.
+        :type event_latitude: float
+        :param event_longitude: The event longitude.
+        :type event_longitude: float
+        :param event_depth_in_km: The event depth in km.
+        :type event_depth_in_km: float
+        :param station_latitude: The station latitude.
+        :type station_latitude: float
+        :param station_longitude: The station longitude.
+        :type station_longitude: float
+        :param minimum_period: The minimum period of data and synthetics.
+        :type minimum_period: float
+        :param maximum_period: The maximum period of data and synthetics.
+        :type maximum_period: float
+        :param data_type: earthquake or noise data
+        :type data_type: str
+        """
+        kwargs.update(window_picking_parameters(data_type))
         windows = select_windows(
             data_trace=data_trace,
             synthetic_trace=synthetic_trace,
@@ -123,21 +158,36 @@ def iterate((event, event_info, iteration_info, data_type)):
             station_longitude=station_longitude,
             minimum_period=minimum_period,
             maximum_period=maximum_period,
-            # User adjustable parameters.
-            min_cc=min_cc,
-            max_noise=max_noise,
-            max_noise_window=max_noise_window,
-            min_velocity=min_velocity,
-            threshold_shift=threshold_shift,
-            threshold_correlation=threshold_correlation,
-            min_length_period=min_length_period,
-            min_peaks_troughs=min_peaks_troughs,
-            max_energy_ratio=max_energy_ratio,
-            min_envelope_similarity=min_envelope_similarity,
             **kwargs)
 
         return windows
 
+    def stream_window_picking_function(data, synthetics, starttime, delta,
+                                       event_latitude, event_longitude,
+                                       event_depth_in_km, station_latitudes,
+                                       station_longitudes, minimum_period,
+                                       maximum_period, data_type, **kwargs):  # NOQA
+        """
+        Like window_picking_function() for all aligned traces of an event at
+        once. data and synthetics are arrays of shape (n_traces, npts), the
+        station coordinates arrays with one value per trace. Has to return a
+        list with the windows of every trace.
+        """
+        kwargs.update(window_picking_parameters(data_type))
+        return select_windows_stream(
+            data=data,
+            synthetics=synthetics,
+            starttime=starttime,
+            delta=delta,
+            event_latitude=event_latitude,
+            event_longitude=event_longitude,
+            event_depth_in_km=event_depth_in_km,
+            station_latitudes=station_latitudes,
+            station_longitudes=station_longitudes,
+            minimum_period=minimum_period,
+            maximum_period=maximum_period,
+            **kwargs)
+
     specific = event_info[event]
 
     # data
@@ -158,9 +208,11 @@ def iterate((event, event_info, iteration_info, data_type)):
         print "Couldn't read for {}".format(event)
         return event, {}
     print "PROCESSING {}".format(event)
-    for i, dat_trace in enumerate(data_stream):
 
-        print "PROCESSING {}".format(dat_trace)
+    # Pair the traces and read the station coordinates first, so the
+    # distances of all stations of the event are computed in one go.
+    traces = []
+    for i, dat_trace in enumerate(data_stream):
 
         # read data
         starttime = dat_trace.stats.starttime
@@ -184,21 +236,100 @@ def iterate((event, event_info, iteration_info, data_type)):
             print('SKIPPING {}.{}.{}'.format(network, station, channel))
             continue
 
-        # pick windows
-        windows = None
+        traces.append((dat_trace, syn_trace, station_dict))
+
+    # Sweep mode: the windows of every parameter set, applied on top of the
+    # window picking parameters. No windows.p is written.
+    if parameter_sets is not None:
+        dists_in_deg, dists_in_km = event_station_distances(
+            specific['latitude'], specific['longitude'],
+            [station_dict['latitude'] for _, _, station_dict in traces],
+            [station_dict['longitude'] for _, _, station_dict in traces])
+        sweep_windows = {}
+        for k, (dat_trace, syn_trace, station_dict) in enumerate(traces):
+            try:
+                sweep_windows['{}.{}.{}'.format(dat_trace.stats.network, dat_trace.stats.station,
+                                                dat_trace.stats.channel[2])] = select_windows_sweep(
+                    dat_trace,
+                    syn_trace,
+                    specific['latitude'],
+                    specific['longitude'],
+                    specific['depth_in_km'],
+                    station_dict['latitude'],
+                    station_dict['longitude'],
+                    1 / iteration_info['lowpass'],
+                    1 / iteration_info['highpass'],
+                    [dict(window_picking_parameters(data_type), **parameters) for parameters in parameter_sets],
+                    first_arrival_table=first_arrival_table,
+                    dist_in_deg=float(dists_in_deg[k]),
+                    dist_in_km=float(dists_in_km[k]),
+                    cc_step_period=cc_step_period)
+            except Exception as e:
+                print "SWEEP FAILED FOR {}: {!r}".format(dat_trace.id, e)
+        return event, sweep_windows
+
+    # Aligned traces are picked all at once.
+    stream_windows = None
+    if traces and len(set((dat_trace.stats.starttime.timestamp, dat_trace.stats.delta,
+                           dat_trace.stats.npts, syn_trace.stats.npts)
+                          for dat_trace, syn_trace, _ in traces)) == 1:
         try:
-            windows = window_picking_function(dat_trace,
-                                              syn_trace,
-                                              specific['latitude'],
-                                              specific['longitude'],
-                                              specific['depth_in_km'],
-                                              station_dict['latitude'],
-                                              station_dict['longitude'],
-                                              1 / iteration_info['lowpass'],
-                                              1 / iteration_info['highpass'],
-                                              data_type)
+            stream_windows = stream_window_picking_function(
+                np.array([dat_trace.data for dat_trace, _, _ in traces]),
+                np.array([syn_trace.data for _, syn_trace, _ in traces]),
+                traces[0][0].stats.starttime,
+                traces[0][0].stats.delta,
+                specific['latitude'],
+                specific['longitude'],
+                specific['depth_in_km'],
+                [station_dict['latitude'] for _, _, station_dict in traces],
+                [station_dict['longitude'] for _, _, station_dict in traces],
+                1 / iteration_info['lowpass'],
+                1 / iteration_info['highpass'],
+                data_type,
+                first_arrival_table=first_arrival_table,
+                ids=[dat_trace.id for dat_trace, _, _ in traces],
+                stats=stats,
+                cc_step_period=cc_step_period)
         except Exception as e:
-            print "WINDOWS FAILED."
+            print "STREAM WINDOWS FAILED ({!r}), PICKING TRACE BY TRACE.".format(e)
+            if stats is not None:
+                stats = SelectionStats()
+
+    if stream_windows is None:
+        dists_in_deg, dists_in_km = event_station_distances(
+            specific['latitude'], specific['longitude'],
+            [station_dict['latitude'] for _, _, station_dict in traces],
+            [station_dict['longitude'] for _, _, station_dict in traces])
+
+    for k, (dat_trace, syn_trace, station_dict) in enumerate(traces):
+
+        print "PROCESSING {}".format(dat_trace)
+        network, station, channel = dat_trace.stats.network, dat_trace.stats.station, dat_trace.stats.channel[2]
+
+        # pick windows
+        windows = None
+        if stream_windows is not None:
+            windows = stream_windows[k]
+        else:
+            try:
+                windows = window_picking_function(dat_trace,
+                                                  syn_trace,
+                                                  specific['latitude'],
+                                                  specific['longitude'],
+                                                  specific['depth_in_km'],
+                                                  station_dict['latitude'],
+                                                  station_dict['longitude'],
+                                                  1 / iteration_info['lowpass'],
+                                                  1 / iteration_info['highpass'],
+                                                  data_type,
+                                                  first_arrival_table=first_arrival_table,
+                                                  dist_in_deg=float(dists_in_deg[k]),
+                                                  dist_in_km=float(dists_in_km[k]),
+                                                  stats=stats,
+                                                  cc_step_period=cc_step_period)
+            except Exception as e:
+                print "WINDOWS FAILED."
 
         if not windows:
             continue
@@ -207,11 +338,34 @@ def iterate((event, event_info, iteration_info, data_type)):
 
     with open(os.path.join(event, 'windows.p'), 'wb') as fh:
         cPickle.dump(all_windows, fh)
+    if stats is not None:
+        write_event_stats(event, stats)
 
     return event, all_windows
 
 
+def print_sweep_report(parameter_sets, results, filename='window_parameter_sweep.txt'):
+    """Prints and writes the number of windows, the total windowed time and
+    the number of traces with windows of every parameter set of a sweep."""
+    lines = ['{:>4} {:>8} {:>14} {:>7}  parameters'.format('set', 'windows', 'windowed [s]', 'traces')]
+    for k, parameters in enumerate(parameter_sets):
+        per_trace = [trace_windows[k] for _, sweep_windows in results
+                     for trace_windows in sweep_windows.itervalues()]
+        lines.append('{:>4} {:>8} {:>14.1f} {:>7}  {}'.format(
+            k, sum(len(windows) for windows in per_trace),
+            sum(stop - start for windows in per_trace for start, stop in windows),
+            sum(1 for windows in per_trace if windows),
+            json.dumps(parameters, sort_keys=True)))
+    with open(filename, 'w') as fh:
+        fh.write('\n'.join(lines) + '\n')
+    print '\n'.join(lines)
+
+
 def main():
+    """Picks the windows of all events. With the name of a JSON file with a
+    list of parameter sets as argument, e.g. [{"threshold_shift": 0.2},
+    {"threshold_shift": 0.4}], sweeps these instead and only reports the
+    windows of every set, see print_sweep_report()."""
 
     with io.open('./lasif_data.p', 'rb') as fh:
         info = cPickle.load(fh)
@@ -219,14 +373,39 @@ def main():
     event_info = info[0]
     iteration_info = info[1]
     data_type = info[2]['input_data_type']
+    first_arrival_table = info[2].get('first_arrival_table')
+    collect_stats = info[2].get('window_selection_stats', False)
+    cc_step_period = info[2].get('window_cc_step_period', 0.0)
     events = event_info.keys()
 
+    parameter_sets = None
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'r') as fh:
+            parameter_sets = json.load(fh)
+
     # ipyparallel map
     client = Client()
     view = client[:]
-    events_with_windows = view.map(iterate, zip(events, repeat(event_info), repeat(iteration_info), repeat(data_type)))
+
+    # The first arrival table is computed once per project, on all engines.
+    if first_arrival_table and not os.path.exists(first_arrival_table):
+        from oval_office_2.mini_lasif.traveltime_table import build_first_arrival_table
+        print "Building first arrival table {}".format(first_arrival_table)
+        build_first_arrival_table(first_arrival_table, map_function=view.map_sync)
+
+    events_with_windows = view.map(iterate, zip(events, repeat(event_info), repeat(iteration_info), repeat(data_type)),
+                                   [first_arrival_table] * len(events), [collect_stats] * len(events),
+                                   [parameter_sets] * len(events), [cc_step_period] * len(events))
     results = events_with_windows.get()
 
+    if parameter_sets is not None:
+        print_sweep_report(parameter_sets, results)
+        return
+
+    if collect_stats:
+        from oval_office_2.mini_lasif.selection_stats import write_iteration_stats
+        print write_iteration_stats(events)
+
 
 #    my_windows = dict(results)
 #
@@ -0,0 +1,64 @@
+#!/users/afanasm/anaconda/bin/python
+# -*- coding:utf-8 -*-
+
+import cPickle
+
+import numpy as np
+
+from oval_office_2.scripts.create_adjoint_sources import windows_for_event
+
+
+def compare_precisions((event, min_period, max_period, data_type),
+                       **adjoint_options):
+    """
+    Computes the adjoint sources of an event in single and double precision
+    and returns a dictionary with the relative misfit and adjoint source
+    error of the single precision result for every station.
+    """
+    adjoint_options.pop('precision', None)
+    args = (event, min_period, max_period, data_type)
+    _, adj_double, misfit_double = windows_for_event(args, **adjoint_options)
+    _, adj_single, misfit_single = windows_for_event(
+        args, precision='single', **adjoint_options)
+
+    errors = {}
+    for station, reference in adj_double.iteritems():
+        reference_misfit = misfit_double[station]
+        misfit_error = abs(misfit_single[station] - reference_misfit)
+        adjoint_error = np.abs(adj_single[station] - reference).max()
+        errors[station] = {
+            'misfit_error': misfit_error / max(abs(reference_misfit),
+                                               np.finfo(float).tiny),
+            'adjoint_error': adjoint_error / max(np.abs(reference).max(),
+                                                 np.finfo(float).tiny)}
+    return errors
+
+
+def main():
+
+    with open('lasif_data.p', 'rb') as fh:
+        project_info = cPickle.load(fh)
+
+    iteration_info = project_info[1]
+    data_type = project_info[2]['input_data_type']
+    adjoint_options = project_info[2].get('adjoint_source_options', {})
+    min_period = 1 / iteration_info['lowpass']
+    max_period = 1 / iteration_info['highpass']
+
+    max_misfit_error, max_adjoint_error = 0.0, 0.0
+    for event in project_info[0].keys():
+        errors = compare_precisions(
+            (event, min_period, max_period, data_type), **adjoint_options)
+        for station, error in sorted(errors.iteritems()):
+            print "{} {}: misfit {:.2e}, adjoint source {:.2e}".format(
+                event, station, error['misfit_error'],
+                error['adjoint_error'])
+            max_misfit_error = max(max_misfit_error, error['misfit_error'])
+            max_adjoint_error = max(max_adjoint_error, error['adjoint_error'])
+
+    print "Maximum relative misfit error: {:.2e}".format(max_misfit_error)
+    print "Maximum relative adjoint source error: {:.2e}".format(
+        max_adjoint_error)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+#!/users/afanasm/anaconda/bin/python
+# -*- coding:utf-8 -*-
+
+import cPickle
+import sys
+
+from oval_office_2.mini_lasif.traveltime_table import load_first_arrival_table, validate_first_arrival_table
+
+
+def main():
+    """Reports the maximum interpolation error of the first arrival table of
+    the project against TauPy. Run in the window selection directory, the
+    optional argument is the number of random test points."""
+
+    with open('lasif_data.p', 'rb') as fh:
+        project_info = cPickle.load(fh)
+
+    n_points = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    table = load_first_arrival_table(project_info[2]['first_arrival_table'])
+    error = validate_first_arrival_table(table, n_points=n_points)
+
+    print "Mean absolute error: {:.3f} s".format(error['mean_error'])
+    print "Maximum absolute error: {:.3f} s at {:.1f} km depth and {:.2f} degree".format(
+        error['max_error'], error['depth_in_km'], error['distance_in_degree'])
+
+if __name__ == "__main__":
+    main()
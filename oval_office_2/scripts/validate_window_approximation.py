@@ -0,0 +1,70 @@
+#!/users/afanasm/anaconda/bin/python
+# -*- coding:utf-8 -*-
+
+import cPickle
+import os
+import random
+import sys
+import time
+
+from oval_office_2.mini_lasif.window_selection import window_agreement
+from oval_office_2.scripts.select_windows import iterate
+
+
+def main():
+    """Compares the windows picked with approximate sliding cross
+    correlations with the exact ones on a random sample of events. Run in the
+    window selection directory, the optional arguments are the spacing of the
+    correlations as a fraction of the minimum period (default: the
+    window_cc_step_period of the project, else 0.05) and the number of
+    events (default 5)."""
+
+    with open('lasif_data.p', 'rb') as fh:
+        project_info = cPickle.load(fh)
+
+    event_info = project_info[0]
+    iteration_info = project_info[1]
+    data_type = project_info[2]['input_data_type']
+    first_arrival_table = project_info[2].get('first_arrival_table')
+    if first_arrival_table and not os.path.exists(first_arrival_table):
+        first_arrival_table = None
+    cc_step_period = float(sys.argv[1]) if len(sys.argv) > 1 else \
+        project_info[2].get('window_cc_step_period') or 0.05
+    n_events = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    events = [event for event in sorted(event_info) if os.path.exists(os.path.join(event, 'preprocessed_data.mseed'))]
+    events = random.Random(0).sample(events, min(n_events, len(events)))
+
+    # The sweep mode of iterate with a single, empty, parameter set picks
+    # the windows without writing windows.p.
+    totals = {'exact': 0.0, 'approximate': 0.0, 'common': 0.0, 'n_exact': 0, 'n_approximate': 0,
+              'time_exact': 0.0, 'time_approximate': 0.0}
+    for event in events:
+        start = time.time()
+        _, exact = iterate((event, event_info, iteration_info, data_type), first_arrival_table,
+                           parameter_sets=[{}])
+        totals['time_exact'] += time.time() - start
+        start = time.time()
+        _, approximate = iterate((event, event_info, iteration_info, data_type), first_arrival_table,
+                                 parameter_sets=[{}], cc_step_period=cc_step_period)
+        totals['time_approximate'] += time.time() - start
+
+        for channel in set(exact) | set(approximate):
+            reference = exact.get(channel, [[]])[0]
+            windows = approximate.get(channel, [[]])[0]
+            exact_time, approximate_time, common_time = window_agreement(reference, windows)
+            totals['exact'] += exact_time
+            totals['approximate'] += approximate_time
+            totals['common'] += common_time
+            totals['n_exact'] += len(reference)
+            totals['n_approximate'] += len(windows)
+
+    print "Events: {}, cc_step_period: {}".format(len(events), cc_step_period)
+    print "Windows: {n_exact} exact, {n_approximate} approximate".format(**totals)
+    print "Windowed time: {exact:.1f} s exact, {approximate:.1f} s approximate, {common:.1f} s in both".format(
+        **totals)
+    print "Exact windowed time recovered: {:.1%}, approximate windowed time also picked exactly: {:.1%}".format(
+        totals['common'] / max(totals['exact'], 1e-12), totals['common'] / max(totals['approximate'], 1e-12))
+    print "Time: {time_exact:.1f} s exact, {time_approximate:.1f} s approximate".format(**totals)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+import os
+
+from oval_office_2 import utilities
+from .CreateAdjointSources import createAdjointSources
+
+
+class ComputeMisfits(createAdjointSources):
+    """Runs the compute_misfits script, which only evaluates the misfits of
+    preprocessed and synthetic data in the selected windows and writes
+    misfit.p. Skips the adjoint sources, e.g. for step length tests.
+
+    The misfits are stored in LASIF as misfit_step_length.p or
+    misfit_only.p, so they never replace the misfit.p of
+    create_adjoint_sources, from which the step length events are chosen.
+    """
+
+    script_name = 'compute_misfits'
+    queue_name = 'Compute Misfits'
+
+    def __init__(self, remote_machine, config, sbatch_dict, specific_events=None,
+                 step_length=False):
+        super(ComputeMisfits, self).__init__(remote_machine, config, sbatch_dict)
+
+        if step_length:
+            specific_events = utilities.get_step_length_events(
+                self.remote_machine, self.config, 25)
+        if specific_events:
+            for e in specific_events:
+                if e not in self.event_info.keys():
+                    raise RuntimeError(
+                        "Specific event {} not in project".format(e))
+            self.all_events = sorted(specific_events)
+        self.lasif_misfit_file = 'misfit_step_length.p' if step_length else 'misfit_only.p'
+
+    @property
+    def work_dir(self):
+        """Remote directory within which the script is run."""
+        return self.config.misfit_dir
+
+    def check_post_run(self):
+        dst_dir = os.path.join(self.config.lasif_project_path, 'ADJOINT_SOURCES_AND_WINDOWS/ADJOINT_SOURCES', self.config.base_iteration)
+        origin = os.path.join(self.work_dir, 'misfit.p')
+        self.remote_machine.makedir(dst_dir)
+        self.remote_machine.execute_command('rsync {} {}'.format(
+            origin, os.path.join(dst_dir, self.lasif_misfit_file)))
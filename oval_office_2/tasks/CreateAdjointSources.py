@@ -13,6 +13,9 @@ class createAdjointSources(task.Task):
      synthetic data with the help of a window selection pickle file.
     ."""
 
+    script_name = 'create_adjoint_sources'
+    queue_name = 'Create Adjoint Sources'
+
     def __init__(self, remote_machine, config, sbatch_dict):
         super(createAdjointSources, self).__init__(remote_machine, config)
         self.event_info, self.iteration_info = utilities.get_lasif_information(
@@ -22,6 +25,11 @@ class createAdjointSources(task.Task):
         self.all_events = sorted(self.event_info.keys())
         self.sbatch_dict = sbatch_dict
 
+    @property
+    def work_dir(self):
+        """Remote directory within which the script is run."""
+        return self.config.adjoint_dir
+
     def check_pre_staging(self):
         # preproc data check
         no_data = []
@@ -62,17 +70,32 @@ class createAdjointSources(task.Task):
 
 
     def stage_data(self):
-        self.remote_machine.makedir(self.config.adjoint_dir)
+        self.remote_machine.makedir(self.work_dir)
         hpass = 1 / self.iteration_info['highpass']
         lpass = 1 / self.iteration_info['lowpass']
 
 
         with open('./lasif_data.p', 'rb') as fh:
             f = cPickle.load(fh)
+        f[0] = {event: f[0][event] for event in self.all_events}
         if self.config.input_data_type == 'noise':
                 f.append({'input_data_type': 'noise'})
         elif self.config.input_data_type == 'earthquake':
                 f.append({'input_data_type': 'earthquake'})
+        f[-1]['adjoint_source_options'] = self.config.adjoint_source_options or {}
+        # The misfit may be chosen per iteration.
+        misfit_type = self.config.misfit_type
+        if isinstance(misfit_type, dict):
+            misfit_type = misfit_type.get(self.config.base_iteration)
+        f[-1]['misfit_type'] = misfit_type
+        f[-1]['plan_cache_max_bytes'] = None
+        if self.config.plan_cache_max_mb:
+            f[-1]['plan_cache_max_bytes'] = int(self.config.plan_cache_max_mb * 1024 ** 2)
+        f[-1]['tf_cache'] = None
+        if self.config.tf_cache_max_gb:
+            f[-1]['tf_cache'] = {'directory': self.config.tf_cache_dir,
+                                 'max_size': int(self.config.tf_cache_max_gb * 1024 ** 3),
+                                 'iteration': self.config.base_iteration}
         with open('./lasif_data.p', 'wb') as fh:
                 cPickle.dump(f,fh)
 
@@ -81,7 +104,7 @@ class createAdjointSources(task.Task):
             for event in events:
                 try:
                     raw_dir = os.path.join(self.config.lasif_project_path, 'DATA', event, 'preprocessed_{:.1f}_{:.1f}'.format(lpass, hpass), 'preprocessed_data.mseed')
-                    event_dir = os.path.join(self.config.adjoint_dir, event)
+                    event_dir = os.path.join(self.work_dir, event)
                     self.remote_machine.makedir(event_dir)
                     self.remote_machine.execute_command('rsync {} {}'.format(raw_dir, event_dir))
                 except:
@@ -91,7 +114,7 @@ class createAdjointSources(task.Task):
             for event in events:
                 try:
                     raw_dir = os.path.join(self.config.lasif_project_path, 'SYNTHETICS', event, self.config.base_iteration, 'synthetics.mseed')
-                    event_dir = os.path.join(self.config.adjoint_dir, event)
+                    event_dir = os.path.join(self.work_dir, event)
                     self.remote_machine.execute_command('rsync {} {}'.format(raw_dir, event_dir))
                 except:
                     print "\nCould not sync synthetics.mseed for: " + event
@@ -100,22 +123,22 @@ class createAdjointSources(task.Task):
             for event in events:
                 try:
                     raw_dir = os.path.join(self.config.lasif_project_path, 'ADJOINT_SOURCES_AND_WINDOWS/WINDOWS', self.config.first_iteration ,event, 'windows.p')
-                    event_dir = os.path.join(self.config.adjoint_dir, event)
+                    event_dir = os.path.join(self.work_dir, event)
                     self.remote_machine.execute_command('rsync {} {}'.format(raw_dir, event_dir))
                 except:
                     print "\nCould not sync window.p for: " + event
 
 
         self.remote_machine.put_file('lasif_data.p',
-                                     os.path.join(self.config.adjoint_dir, 'lasif_data.p'))
+                                     os.path.join(self.work_dir, 'lasif_data.p'))
 
-        remote_script = os.path.join(self.config.adjoint_dir, "create_adjoint_sources.py")
-        with io.open(utilities.get_script_file('create_adjoint_sources'), 'r') as fh:
+        remote_script = os.path.join(self.work_dir, "{}.py".format(self.script_name))
+        with io.open(utilities.get_script_file(self.script_name), 'r') as fh:
             script_string = fh.readlines()
         script_string.insert(0, '#!{}\n'.format(self.config.python_exec))
         self.remote_machine.write_file(remote_script, ''.join(script_string))
 
-        remote_sbatch = os.path.join(self.config.adjoint_dir, 'create_adjoint_sources.sbatch')
+        remote_sbatch = os.path.join(self.work_dir, '{}.sbatch'.format(self.script_name))
         with io.open(utilities.get_template_file('sbatch'), 'r') as fh:
             sbatch_string = fh.read().format(**self.sbatch_dict)
         self.remote_machine.write_file(remote_sbatch, sbatch_string)
@@ -125,10 +148,10 @@ class createAdjointSources(task.Task):
 
     def run(self):
 
-        exec_command = 'chmod +x create_adjoint_sources.py; sbatch create_adjoint_sources.sbatch'
-        queue = JobQueue(self.remote_machine, name="Create Adjoint Sources")
+        exec_command = 'chmod +x {0}.py; sbatch {0}.sbatch'.format(self.script_name)
+        queue = JobQueue(self.remote_machine, name=self.queue_name)
         _, so, _ = self.remote_machine.execute_command(
-            exec_command, workdir=self.config.adjoint_dir)
+            exec_command, workdir=self.work_dir)
         queue.add_job(utilities.get_job_number_from_stdout(so))
         queue.flash_report(10)
 
@@ -3,7 +3,6 @@ import os
 
 import boltons.fileutils
 import click
-import cPickle
 from . import task
 from .. import utilities
 from ..job_queue import JobQueue
@@ -42,25 +41,9 @@ class RunSolver(task.Task):
     def stage_data(self):
         print self.sim_type
         if self.sim_type == 'forward_step_length':
-            # Get misfit file
-            misfit_file_path = os.path.join(self.config.lasif_project_path,
-                                            "ADJOINT_SOURCES_AND_WINDOWS/ADJOINT_SOURCES",
-                                            self.config.first_iteration, 'misfit.p')
-            self.remote_machine.get_file(misfit_file_path, "./misfit.p")
-
-            with open("./misfit.p", 'rb') as fh:
-                misfit_iter1 = cPickle.load(fh)
-
-            # Create format with total misfit per event
-            dict_iter1 = {}
-            for misfit in misfit_iter1[:]:
-                event = misfit[0]
-                station_misfits = misfit[1]
-                dict_iter1[misfit[0]] = sum(station_misfits.values())
-
-            # Sort and select 25 with highest misfits
-            events_sorted_by_misfit = sorted(dict_iter1.items(), key=lambda x:x[1], reverse=True)
-            self.all_events = [x[0] for x in events_sorted_by_misfit[:25]]
+            # Select 25 events with highest misfits
+            self.all_events = utilities.get_step_length_events(
+                self.remote_machine, self.config, 25)
 
         if self.config.simulation_type == 'regional':
             with io.open(utilities.get_template_file("Par_file_regional"), "r") as fh:
@@ -30,6 +30,9 @@ class SelectWindows(task.Task):
                 f.append({'input_data_type': 'noise'})
         elif self.config.input_data_type == 'earthquake':
                 f.append({'input_data_type': 'earthquake'})
+        f[-1]['first_arrival_table'] = self.config.first_arrival_table
+        f[-1]['window_selection_stats'] = bool(self.config.window_selection_stats)
+        f[-1]['window_cc_step_period'] = self.config.window_cc_step_period or 0.0
         with open('./lasif_data.p', 'wb') as fh:
                 cPickle.dump(f,fh)
 
@@ -10,7 +10,15 @@ for module in os.listdir(os.path.dirname(__file__)):
 
 # Make dictionary of all tasks.
 from .task import Task
-task_map = {i.__name__ : i for i in Task.__subclasses__()}
+
+
+def _all_subclasses(cls):
+    for subclass in cls.__subclasses__():
+        yield subclass
+        for i in _all_subclasses(subclass):
+            yield i
+
+task_map = {i.__name__ : i for i in _all_subclasses(Task)}
 
 # Make list of all stages
 stages = ['check_pre_staging', 'stage_data', 'check_post_staging', 'run', 'check_post_run']
\ No newline at end of file
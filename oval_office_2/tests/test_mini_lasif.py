@@ -0,0 +1,930 @@
+import numpy as np
+import pytest
+
+from oval_office_2.mini_lasif import time_frequency, utils
+
+
+def _dispersed_signal(npts=400):
+    t, u = utils.get_dispersed_wavetrain(t_max=npts - 1)
+    return t, u
+
+
+def _wavelet(t, center=600.0, width=200.0, period=40.0):
+    return np.exp(-((t - center) / width) ** 2) * \
+        np.sin(2 * np.pi * t / period)
+
+
+def _selection_signal(npts=2000):
+    """
+    Time axis sampled at 1 s, wavelet and random state of the window
+    selection tests.
+    """
+    t = np.arange(float(npts))
+    return t, _wavelet(t), np.random.RandomState(0)
+
+
+def _first_arrival_table(distances=(0.0, 180.0)):
+    """
+    First arrival table of the window selection tests, 300 s everywhere.
+    """
+    from oval_office_2.mini_lasif.traveltime_table import FirstArrivalTable
+    return FirstArrivalTable([0.0, 100.0], distances,
+                             np.ones((2, 2)) * 300.0)
+
+
+def test_time_frequency_transform_matches_loop():
+    t, s = _dispersed_signal()
+    dt_new, width = 4.0, 20.0
+
+    TAU, NU, tfs = time_frequency.time_frequency_transform(
+        t, s, dt_new, width, chunk_size=7)
+
+    # Straightforward per-tau reference implementation.
+    tau = TAU[0]
+    nu = NU[:, 0]
+    si = np.interp(tau, t, s)
+    ref = np.zeros_like(tfs)
+    for k in xrange(len(tau)):
+        f = utils.gaussian_window(tau - tau[k], width) * si
+        ref[k, :] = np.fft.fft(f) / np.sqrt(2.0 * np.pi) * dt_new
+        ref[k, :] *= np.exp(-2.0 * np.pi * 1j * tau[0] * nu)
+
+    np.testing.assert_allclose(tfs, ref, rtol=1e-10, atol=1e-12)
+
+
+def test_fft_cross_correlation_layout():
+    rng = np.random.RandomState(0)
+    f = rng.randn(3, 51)
+    g = rng.randn(3, 51)
+
+    cc = utils.fft_cross_correlation(f, g)
+    for i in xrange(3):
+        ref = utils.cross_correlation(f[i], g[i])
+        np.testing.assert_allclose(cc[i], ref, atol=1e-10)
+
+
+def test_time_frequency_cc_difference_matches_loop():
+    t, s1 = _dispersed_signal(300)
+    s2 = np.roll(s1, 5)
+    dt_new, width = 4.0, 20.0
+
+    TAU, NU, tfs = time_frequency.time_frequency_cc_difference(
+        t, s1, s2, dt_new, width, chunk_size=11)
+
+    ti = utils.matlab_range(t[0], t[-1], dt_new)
+    si1 = np.interp(ti, t, s1)
+    si2 = np.interp(ti, t, s2)
+    tau = TAU[0]
+    nu = NU[:, 0]
+    ref = np.zeros_like(tfs)
+    for k in xrange(len(tau)):
+        w = utils.gaussian_window(ti - tau[k], width)
+        cc = utils.cross_correlation(w * si2, w * si1)
+        ref[k, :] = np.fft.fft(cc) / np.sqrt(2.0 * np.pi) * dt_new
+        ref[k, :] *= np.exp(-2.0 * np.pi * 1j * tau[0] * nu)
+
+    np.testing.assert_allclose(tfs, ref, rtol=1e-8, atol=1e-10)
+
+
+def test_itfa_matches_loop():
+    t, s = _dispersed_signal(250)
+    TAU, NU, tfs = time_frequency.time_frequency_transform(t, s, 4.0, 20.0)
+    tau = TAU[0]
+    nu = NU[:, 0]
+    dt = tau[1] - tau[0]
+    N = len(tau)
+
+    # Reference: the original per row/per sample loops.
+    tmp = tfs * np.exp(2.0 * np.pi * 1j * nu * tau[0])
+    I = np.array([2.0 * np.pi * np.fft.ifft(tmp[k]) / dt for k in xrange(N)])
+    ref = np.array([np.sum(utils.gaussian_window(tau[k] - tau, 20.0) *
+                           I[:, k]) * dt for k in xrange(N)])
+    ref /= np.sqrt(2.0 * np.pi)
+
+    original = tfs.copy()
+    sig, _, _ = time_frequency.itfa(TAU, NU, tfs, 20.0)
+    np.testing.assert_array_equal(tfs, original)
+    np.testing.assert_allclose(sig, ref, rtol=1e-10, atol=1e-12)
+
+    sig, _, _ = time_frequency.itfa(TAU, NU, tfs, 20.0, in_place=True)
+    np.testing.assert_allclose(sig, ref, rtol=1e-10, atol=1e-12)
+
+
+def test_transform_plan_cache():
+    t, s = _dispersed_signal(200)
+    time_frequency.clear_plan_cache()
+
+    _, _, tfs_1 = time_frequency.time_frequency_transform(t, s, 4.0, 20.0)
+    info = time_frequency.plan_cache_info()
+    assert info["misses"] == 1
+    assert info["hits"] == 0
+
+    TAU, NU, tfs_2 = time_frequency.time_frequency_transform(
+        t, 2.0 * s, 4.0, 20.0)
+    info = time_frequency.plan_cache_info()
+    assert info["misses"] == 1
+    assert info["hits"] == 1
+    np.testing.assert_allclose(tfs_2, 2.0 * tfs_1)
+
+    # The meshgrids are rebuilt for every call, the shared arrays of the
+    # plan must not be modifiable by the callers.
+    TAU_2, NU_2 = time_frequency.time_frequency_grid(t, 4.0, 20.0)
+    np.testing.assert_array_equal(TAU_2, TAU)
+    np.testing.assert_array_equal(NU_2, NU)
+    plan = time_frequency.PLAN_CACHE.values()[0]
+    assert not plan.tau.flags.writeable
+    assert not plan.windows.flags.writeable
+    assert info["bytes"] == plan.nbytes
+
+    # The least recently used plans are dropped beyond the byte budget.
+    time_frequency.set_plan_cache_max_bytes(plan.nbytes)
+    try:
+        time_frequency.time_frequency_transform(t[:100], s[:100], 4.0, 20.0)
+        time_frequency.time_frequency_transform(t, s, 4.0, 20.0)
+        info = time_frequency.plan_cache_info()
+        assert info["size"] == 1 and info["bytes"] == plan.nbytes
+        assert info["misses"] == 3 and info["hits"] == 2
+    finally:
+        time_frequency.set_plan_cache_max_bytes(
+            time_frequency.PLAN_CACHE_MAX_BYTES)
+        time_frequency.clear_plan_cache()
+
+
+def test_truncated_transforms():
+    t, s1 = _dispersed_signal(400)
+    s2 = np.roll(s1, 5)
+
+    report = time_frequency.truncation_accuracy_report(
+        t, s1, s2, 4.0, 20.0, tolerances=(1E-4, 1E-8))
+    assert report[0]["support"] < report[1]["support"]
+    for name in ("transform_error", "cc_difference_error", "itfa_error"):
+        assert report[0][name] < 1E-3
+        assert report[1][name] < 1E-7
+
+
+def test_band_limited_transforms():
+    t, s1 = _dispersed_signal(300)
+    s2 = np.roll(s1, 5)
+    band = (0.01, 0.06)
+
+    TAU, NU, tfs = time_frequency.time_frequency_transform(t, s1, 4.0, 20.0)
+    TAU_b, NU_b, tfs_b = time_frequency.time_frequency_transform(
+        t, s1, 4.0, 20.0, nu_band=band)
+    columns = (NU[:, 0] >= band[0]) & (NU[:, 0] <= band[1])
+    np.testing.assert_allclose(NU_b[:, 0], NU[columns, 0])
+    np.testing.assert_allclose(tfs_b, tfs[:, columns], atol=1e-10)
+
+    _, NU_cc, cc = time_frequency.time_frequency_cc_difference(
+        t, s1, s2, 4.0, 20.0)
+    _, _, cc_b = time_frequency.time_frequency_cc_difference(
+        t, s1, s2, 4.0, 20.0, nu_band=band)
+    columns_cc = (NU_cc[:, 0] >= band[0]) & (NU_cc[:, 0] <= band[1])
+    np.testing.assert_allclose(cc_b, cc[:, columns_cc], atol=1e-10)
+
+    # The inverse transform treats the frequencies outside the band as zero.
+    zeroed = np.where(columns, tfs, 0.0)
+    ref = time_frequency.itfa(TAU, NU, zeroed, 20.0)[0]
+    sig = time_frequency.itfa(TAU_b, NU_b, tfs_b, 20.0)[0]
+    np.testing.assert_allclose(sig, ref, atol=1e-10)
+
+
+def test_single_precision_transforms():
+    t, s1 = _dispersed_signal(300)
+    s2 = np.roll(s1, 5)
+
+    TAU, NU, tfs = time_frequency.time_frequency_transform(t, s1, 4.0, 20.0)
+    _, _, tfs_32 = time_frequency.time_frequency_transform(
+        t, s1, 4.0, 20.0, precision="single")
+    assert tfs_32.dtype == np.complex64
+    np.testing.assert_allclose(tfs_32, tfs, atol=1e-5 * np.abs(tfs).max())
+
+    _, _, cc = time_frequency.time_frequency_cc_difference(
+        t, s1, s2, 4.0, 20.0)
+    _, _, cc_32 = time_frequency.time_frequency_cc_difference(
+        t, s1, s2, 4.0, 20.0, precision="single")
+    assert cc_32.dtype == np.complex64
+    np.testing.assert_allclose(cc_32, cc, atol=1e-5 * np.abs(cc).max())
+
+    # The inverse transform keeps the precision of its input.
+    sig = time_frequency.itfa(TAU, NU, tfs, 20.0)[0]
+    sig_32 = time_frequency.itfa(TAU, NU, tfs.astype(np.complex64), 20.0)[0]
+    assert sig_32.dtype == np.complex64
+    np.testing.assert_allclose(sig_32, sig, atol=1e-5 * np.abs(sig).max())
+
+    with pytest.raises(ValueError):
+        time_frequency.time_frequency_transform(t, s1, 4.0, 20.0,
+                                                precision="half")
+
+
+def test_energy_threshold():
+    t, s1 = _dispersed_signal(400)
+    s1[:150] = 0.0
+    s1[300:] = 0.0
+    s2 = np.roll(s1, 5)
+    time_frequency.clear_threshold_info()
+
+    _, _, tfs = time_frequency.time_frequency_transform(
+        t, s1, 4.0, 20.0, truncation=1E-8)
+    _, _, tfs_th = time_frequency.time_frequency_transform(
+        t, s1, 4.0, 20.0, truncation=1E-8, threshold=1E-12, chunk_size=5)
+    skipped = np.all(tfs_th == 0.0, axis=1)
+    assert skipped.sum() == time_frequency.threshold_info()["skipped"] > 0
+    np.testing.assert_allclose(tfs_th, tfs, atol=1E-6 * np.abs(tfs).max())
+
+    _, _, cc = time_frequency.time_frequency_cc_difference(
+        t, s1, s2, 4.0, 20.0)
+    _, _, cc_th = time_frequency.time_frequency_cc_difference(
+        t, s1, s2, 4.0, 20.0, threshold=1E-12)
+    np.testing.assert_allclose(cc_th, cc, atol=1E-6 * np.abs(cc).max())
+
+    info = time_frequency.threshold_info()
+    assert info["rows"] == tfs.shape[0] + cc.shape[0]
+    assert info["skipped"] > skipped.sum()
+
+
+def test_window_local_adjoint_source(monkeypatch):
+    from oval_office_2.mini_lasif.ad_src_cc_time_shift import \
+        adsrc_cc_time_shift
+
+    t, u = _dispersed_signal(4000)
+    data = np.roll(u, 3)
+    window = slice(900, 1300)
+    taper = np.hanning(window.stop - window.start)
+    data_segment = data[window] * taper
+    synthetic_segment = u[window] * taper
+    data_padded = np.zeros_like(u)
+    data_padded[window] = data_segment
+    synthetic_padded = np.zeros_like(u)
+    synthetic_padded[window] = synthetic_segment
+
+    ref = adsrc_cc_time_shift(t, data_padded, synthetic_padded, 60.0, 120.0)
+    assert np.abs(ref["adjoint_source"]).max() > 0.0
+
+    # With a margin reaching beyond the trace the segment is the full trace.
+    monkeypatch.setattr(utils, "WINDOW_MARGIN", 1000.0)
+    full = adsrc_cc_time_shift(t, data_segment, synthetic_segment, 60.0,
+                               120.0, offset=window.start)
+    np.testing.assert_allclose(full["adjoint_source"], ref["adjoint_source"])
+    np.testing.assert_allclose(full["misfit_value"], ref["misfit_value"])
+
+    monkeypatch.undo()
+    local = adsrc_cc_time_shift(t, data_segment, synthetic_segment, 60.0,
+                                120.0, offset=window.start)
+    assert len(local["adjoint_source"]) == len(t)
+    np.testing.assert_allclose(local["misfit_value"], ref["misfit_value"],
+                               rtol=1E-2)
+    np.testing.assert_allclose(
+        local["adjoint_source"], ref["adjoint_source"],
+        atol=2E-2 * np.abs(ref["adjoint_source"]).max())
+
+
+def test_cc_difference_on_grid():
+    t, s1 = _dispersed_signal(300)
+    s2 = np.roll(s1, 5)
+    dt_new, width = 4.0, 20.0
+
+    TAU, NU, tfs1 = time_frequency.time_frequency_transform(
+        t, s1, dt_new, width)
+    tfs2 = time_frequency.time_frequency_transform(t, s2, dt_new, width)[2]
+    cc = time_frequency.cc_difference_on_grid(TAU, NU, tfs1, tfs2)
+
+    # Reference: Fourier transform of the correlation of the windowed
+    # signals, evaluated at the frequencies of the grid.
+    ti = utils.matlab_range(t[0], t[-1], dt_new)
+    si1 = np.interp(ti, t, s1)
+    si2 = np.interp(ti, t, s2)
+    N = len(ti)
+    lags = np.concatenate([np.arange(N), np.arange(-N + 1, 0)]) * dt_new
+    nu = NU[:, 0]
+    for k in (0, N // 3, N // 2, N - 1):
+        w = utils.gaussian_window(ti - ti[k], width)
+        c = utils.cross_correlation(w * si2, w * si1)
+        ref = np.dot(np.exp(-2.0 * np.pi * 1j * np.outer(nu, lags)), c)
+        ref *= dt_new / np.sqrt(2.0 * np.pi)
+        np.testing.assert_allclose(cc[k], ref, rtol=1e-8,
+                                   atol=1e-10 * np.abs(ref).max())
+
+
+def test_misfit_only():
+    from oval_office_2.mini_lasif.ad_src_tf_phase_misfit import \
+        adsrc_tf_phase_misfit
+
+    t, u = _dispersed_signal(4000)
+    taper = np.zeros_like(u)
+    taper[900:1300] = np.hanning(400)
+    data = np.roll(u, 3) * taper
+    u = u * taper
+
+    TAU, NU, _ = time_frequency.time_frequency_transform(t, u, 20.0, 120.0)
+    TAU_g, NU_g = time_frequency.time_frequency_grid(t, 20.0, 120.0)
+    np.testing.assert_array_equal(TAU_g, TAU)
+    np.testing.assert_array_equal(NU_g, NU)
+
+    ref = adsrc_tf_phase_misfit(t, data, u, 60.0, 120.0)
+    for direct_cc in (False, True):
+        full = adsrc_tf_phase_misfit(t, data, u, 60.0, 120.0,
+                                     direct_cc=direct_cc)
+        only = adsrc_tf_phase_misfit(t, data, u, 60.0, 120.0,
+                                     direct_cc=direct_cc, misfit_only=True)
+        assert only["adjoint_source"] is None
+        assert only["misfit_value"] == full["misfit_value"]
+    assert only["misfit_value"] == pytest.approx(ref["misfit_value"],
+                                                 rel=1E-3)
+
+
+def test_cc_traveltime():
+    from oval_office_2.mini_lasif.ad_src_cc_traveltime import \
+        adsrc_cc_traveltime, cc_time_shift
+
+    t, u = _dispersed_signal(4000)
+    taper = np.zeros_like(u)
+    taper[900:1300] = np.hanning(400)
+    synthetic = u * taper
+    data = np.interp(t - 2.4, t, u) * taper
+    assert cc_time_shift(data, synthetic, t[1] - t[0]) == \
+        pytest.approx(2.4, abs=0.1)
+
+    ret = adsrc_cc_traveltime(t, data, synthetic, 60.0, 120.0)
+    shift = ret["details"]["time_shift"]
+    assert ret["misfit_value"] == pytest.approx(0.5 * shift ** 2)
+
+    # The reversed adjoint source is the derivative of the misfit with
+    # respect to the synthetic.
+    perturbation = np.roll(synthetic, 1) * 1E-3
+    perturbed = adsrc_cc_traveltime(t, data, synthetic + perturbation, 60.0,
+                                    120.0, misfit_only=True)
+    assert perturbed["adjoint_source"] is None
+    change = perturbed["misfit_value"] - ret["misfit_value"]
+    predicted = np.sum(ret["adjoint_source"][::-1] * perturbation) * \
+        (t[1] - t[0])
+    assert change == pytest.approx(predicted, rel=5E-2)
+
+    local = adsrc_cc_traveltime(t, data[900:1300], synthetic[900:1300],
+                                60.0, 120.0, offset=900)
+    np.testing.assert_allclose(local["adjoint_source"], ret["adjoint_source"])
+    assert local["misfit_value"] == pytest.approx(ret["misfit_value"])
+
+
+def test_stacked_transforms():
+    t, s1 = _dispersed_signal(400)
+    s1[300:] = 0.0
+    s2 = np.roll(s1, 40)
+    stack = np.array([s1, s2])
+
+    for options in ({}, {"threshold": 1E-12, "chunk_size": 5},
+                    {"truncation": 1E-8, "threshold": 1E-12}):
+        TAU, NU, tfs = time_frequency.time_frequency_transform(
+            t, stack, 4.0, 20.0, **options)
+        cc = time_frequency.time_frequency_cc_difference(
+            t, stack, stack[::-1], 4.0, 20.0, **options)[2]
+        for i, s in enumerate(stack):
+            np.testing.assert_array_equal(
+                tfs[i], time_frequency.time_frequency_transform(
+                    t, s, 4.0, 20.0, **options)[2])
+            np.testing.assert_allclose(
+                cc[i], time_frequency.time_frequency_cc_difference(
+                    t, s, stack[1 - i], 4.0, 20.0, **options)[2])
+
+        s = time_frequency.itfa(TAU, NU, tfs, 20.0)[0]
+        np.testing.assert_allclose(
+            s[1], time_frequency.itfa(TAU, NU, tfs[1], 20.0)[0])
+
+
+def test_adsrc_windows():
+    from oval_office_2.mini_lasif.ad_src_tf_phase_misfit import \
+        adsrc_tf_phase_misfit
+    from oval_office_2.mini_lasif.ad_src_windows import adsrc_windows
+
+    t, u = _dispersed_signal(4000)
+    data = np.roll(u, 3)
+    # The second window has a phase jump, the last is outside of the trace.
+    windows = [(600, 1000), (1500, 1800), (1400, 2000), (5000, 5100)]
+
+    ret = adsrc_windows(adsrc_tf_phase_misfit, t, data, u, windows, 60.0,
+                        120.0)
+    misfits = ret["misfit_values"]
+    assert misfits[1] is None and misfits[3] is None
+    assert "Window 3 is outside of the trace." in ret["messages"]
+
+    adjoint_source = np.zeros_like(u)
+    for (first, last), misfit in zip(windows[::2], misfits[::2]):
+        taper = np.zeros_like(u)
+        taper[first:last] = utils.window_taper(last - first, 0.1)
+        ref = adsrc_tf_phase_misfit(t, data * taper, u * taper, 60.0, 120.0)
+        assert misfit == pytest.approx(ref["misfit_value"])
+        adjoint_source += ref["adjoint_source"]
+    np.testing.assert_allclose(ret["adjoint_source"], adjoint_source,
+                               atol=1E-10 * np.abs(adjoint_source).max())
+
+    # A window with a NaN misfit, here without data, only loses itself.
+    gap = data.copy()
+    gap[3000:3400] = 0.0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        nan_ret = adsrc_windows(adsrc_tf_phase_misfit, t, gap, u,
+                                windows[:3] + [(3000, 3400)], 60.0, 120.0)
+    assert nan_ret["misfit_values"][1] is None
+    assert nan_ret["misfit_values"][3] is None
+    np.testing.assert_allclose(nan_ret["misfit_values"][::2], misfits[::2])
+    np.testing.assert_allclose(nan_ret["adjoint_source"], adjoint_source,
+                               atol=1E-10 * np.abs(adjoint_source).max())
+
+    # Window local stacks share the length of the longest segment.
+    local = adsrc_windows(adsrc_tf_phase_misfit, t, data, u, windows, 60.0,
+                          120.0, window_local=True, misfit_only=True)
+    assert local["adjoint_source"] is None
+    np.testing.assert_allclose(local["misfit_values"][::2], misfits[::2],
+                               rtol=2E-2)
+
+
+def test_tf_cache(tmpdir, monkeypatch):
+    import os
+    from oval_office_2.mini_lasif.ad_src_tf_phase_misfit import \
+        adsrc_tf_phase_misfit
+    from oval_office_2.mini_lasif.ad_src_windows import adsrc_windows
+    from oval_office_2.mini_lasif.tf_cache import TFCache, read_cache_log
+
+    t, u = _dispersed_signal(4000)
+    data = np.roll(u, 3)
+    windows = [(600, 1000), (1400, 2000)]
+    cache = TFCache(str(tmpdir), 10 ** 9)
+
+    for options in [{}, {"direct_cc": True, "threshold": 1E-12}]:
+        # The entries are stored for the unscaled data, so a hit is valid
+        # for any scaling.
+        for scale in [1.0, 2.0]:
+            ref = adsrc_windows(adsrc_tf_phase_misfit, t, scale * data, u,
+                                windows, 60.0, 120.0, **options)
+            ret = adsrc_windows(adsrc_tf_phase_misfit, t, scale * data, u,
+                                windows, 60.0, 120.0,
+                                data_cache=cache.signal(("data",), scale),
+                                **options)
+            np.testing.assert_allclose(ret["misfit_values"],
+                                       ref["misfit_values"], rtol=1E-12)
+            np.testing.assert_allclose(
+                ret["adjoint_source"], ref["adjoint_source"],
+                atol=1E-12 * np.abs(ref["adjoint_source"]).max())
+    assert cache.info()["hits"] == cache.info()["misses"] == 2
+
+    cache.log_info("ITERATION_1", "event")
+    assert read_cache_log(str(tmpdir))["ITERATION_1"]["hit_rate"] == 0.5
+
+    # The least recently used entry is evicted first.
+    small = TFCache(str(tmpdir.mkdir("small")), 4000)
+    small.put(("a",), {"x": np.zeros(300)})
+    os.utime(small._path(("a",)), (0, 0))
+    small.put(("b",), {"x": np.zeros(300)})
+    assert small.get(("a",)) is None and small.get(("b",)) is not None
+    assert small.evictions == 1
+
+    # The directory is only listed again when the total size exceeds
+    # max_size, and the temporary files of crashed writers are removed.
+    stale = tmpdir.join("small", "crashed.tmp")
+    stale.write("x")
+    os.utime(str(stale), (0, 0))
+    tmpdir.join("small", "writing.tmp").write("x")
+    small = TFCache(str(tmpdir.join("small")), 4000)
+    assert small.size == os.path.getsize(small._path(("b",)))
+    assert not stale.check() and tmpdir.join("small", "writing.tmp").check()
+    listdir = os.listdir
+    listings = []
+    monkeypatch.setattr(os, "listdir",
+                        lambda path: listings.append(path) or listdir(path))
+    small.put(("b",), {"x": np.zeros(300)})
+    assert not listings
+    small.put(("c",), {"x": np.zeros(300)})
+    assert len(listings) == 1 and small.evictions == 1
+    assert small.size == os.path.getsize(small._path(("c",)))
+
+
+def test_misfit_registry():
+    from oval_office_2.mini_lasif.misfits import get_misfit_function
+
+    t, u = _dispersed_signal(4000)
+    taper = np.zeros_like(u)
+    taper[900:1300] = np.hanning(400)
+    synthetic = u * taper
+    data = 1.3 * np.interp(t - 2.4, t, u) * taper
+    perturbation = np.roll(synthetic, 1) * 1E-4
+
+    for misfit_type in ["l2", "envelope"]:
+        adsrc = get_misfit_function(misfit_type)
+        ret = adsrc(t, data, synthetic, 60.0, 120.0)
+
+        # The reversed adjoint source is the derivative of the misfit with
+        # respect to the synthetic.
+        perturbed = adsrc(t, data, synthetic + perturbation, 60.0, 120.0,
+                          misfit_only=True)
+        change = perturbed["misfit_value"] - ret["misfit_value"]
+        predicted = np.sum(ret["adjoint_source"][::-1] * perturbation) * \
+            (t[1] - t[0])
+        assert change == pytest.approx(predicted, rel=1E-2)
+
+        stack = adsrc(t, np.array([data, 0.0 * data]),
+                      np.array([synthetic, synthetic]), 60.0, 120.0)
+        assert stack["misfit_value"][0] == pytest.approx(ret["misfit_value"])
+        np.testing.assert_allclose(stack["adjoint_source"][0],
+                                   ret["adjoint_source"])
+
+        local = adsrc(t, data[900:1300], synthetic[900:1300], 60.0, 120.0,
+                      offset=900)
+        assert local["misfit_value"] == pytest.approx(ret["misfit_value"],
+                                                      rel=1E-4)
+
+    assert get_misfit_function(data_type="noise") is \
+        get_misfit_function("cc_time_shift")
+    with pytest.raises(ValueError):
+        get_misfit_function("l3")
+
+
+def test_sliding_cross_correlation():
+    from oval_office_2.mini_lasif.window_selection import \
+        sliding_cross_correlation
+
+    rng = np.random.RandomState(0)
+    synth = rng.randn(600)
+    data = np.roll(synth, 4) + 0.1 * rng.randn(600)
+    # No energy in the synthetics and no data, where every lag is a maximum.
+    synth[300:400] = 0.0
+    data[450:550] = 0.0
+    taper = np.hanning(41)
+    midpoints = np.arange(20, 580)
+
+    synth_ptp, time_shift, max_cc = sliding_cross_correlation(
+        data, synth, taper, midpoints, chunk_size=64)
+    for i, midpoint in enumerate(midpoints):
+        data_window = data[midpoint - 20:midpoint + 21] * taper
+        synthetic_window = synth[midpoint - 20:midpoint + 21] * taper
+        assert synth_ptp[i] == synthetic_window.ptp()
+        if synthetic_window.ptp() < synth.ptp() * 0.001:
+            assert np.isnan(max_cc[i])
+            continue
+        cc = np.correlate(data_window, synthetic_window, mode="full")
+        assert time_shift[i] == cc.argmax() - 40
+        np.testing.assert_allclose(
+            max_cc[i], cc.max() / np.sqrt((synthetic_window ** 2).sum() *
+                                          (data_window ** 2).sum()),
+            rtol=1E-14)
+
+
+def test_find_local_extrema():
+    from oval_office_2.mini_lasif.window_selection import find_local_extrema
+
+    # Plateaus are represented by their first index, the first and last
+    # samples are added to alternate peaks and troughs.
+    peaks, troughs = find_local_extrema(
+        np.array([0, 1, 1, 0, -1, -1, 0, 2, 2], dtype=float))
+    np.testing.assert_array_equal(peaks, [1, 8])
+    np.testing.assert_array_equal(troughs, [0, 4])
+    assert peaks.dtype == troughs.dtype == np.int32
+
+    # Left of a plateau at the start the last slope of the data counts.
+    peaks, troughs = find_local_extrema(np.array([1, 1, 0, 2, 3, 3.0]))
+    np.testing.assert_array_equal(peaks, [0, 5])
+    np.testing.assert_array_equal(troughs, [2])
+
+    # With only one kind of extremum the edges are the other kind.
+    import warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        peaks, troughs = find_local_extrema(np.array([0, 1, 0.0]))
+        np.testing.assert_array_equal(peaks, [1])
+        np.testing.assert_array_equal(troughs, [0, 2])
+        peaks, troughs = find_local_extrema(np.array([1, 0, 0.5, 1]))
+        np.testing.assert_array_equal(peaks, [0, 3])
+        np.testing.assert_array_equal(troughs, [1])
+
+    peaks, troughs = find_local_extrema(np.array([0, 1, 2, 3.0]))
+    assert not len(peaks) and not len(troughs)
+    peaks, troughs = find_local_extrema(np.array([2, 1, 1, 2, 3.0]))
+    np.testing.assert_array_equal(peaks, [0, 4])
+    np.testing.assert_array_equal(troughs, [1])
+
+
+def test_first_arrival_table(tmpdir):
+    from oval_office_2.mini_lasif import traveltime_table
+
+    filename = str(tmpdir.join("first_arrivals.npz"))
+    depths, distances = [0.0, 50.0, 100.0], [30.0, 30.5, 31.0]
+    table = traveltime_table.build_first_arrival_table(
+        filename, depths=depths, distances=distances)
+    loaded = traveltime_table.load_first_arrival_table(filename)
+    assert traveltime_table.load_first_arrival_table(filename) is loaded
+    np.testing.assert_array_equal(loaded.times, table.times)
+
+    # Exact on the grid, bilinear in between.
+    assert loaded(50.0, 30.5) == \
+        traveltime_table.first_arrival(50.0, 30.5)
+    np.testing.assert_allclose(
+        loaded(np.array([25.0, 100.0]), np.array([30.0, 30.75])),
+        [0.5 * (table.times[0, 0] + table.times[1, 0]),
+         0.5 * (table.times[2, 1] + table.times[2, 2])])
+    with pytest.raises(ValueError):
+        loaded(150.0, 30.0)
+
+    error = traveltime_table.validate_first_arrival_table(loaded, n_points=5)
+    assert 0.0 < error["max_error"] < 1.0
+
+
+def test_event_station_distances():
+    from obspy.core.util import geodetics
+    from oval_office_2.mini_lasif.geodesy import event_station_distances
+
+    rng = np.random.RandomState(0)
+    latitudes = rng.uniform(-89, 89, 50)
+    longitudes = rng.uniform(-180, 180, 50)
+    dist_in_deg, dist_in_km = event_station_distances(
+        12.3, -45.6, latitudes, longitudes)
+    for i in range(50):
+        assert dist_in_deg[i] == pytest.approx(geodetics.locations2degrees(
+            latitudes[i], longitudes[i], 12.3, -45.6), rel=1e-12)
+        assert dist_in_km[i] == pytest.approx(geodetics.calcVincentyInverse(
+            latitudes[i], longitudes[i], 12.3, -45.6)[0] / 1000.0, rel=1e-12)
+
+    # Coincident points are zero, non converging antipodes NaN.
+    dist_in_deg, dist_in_km = event_station_distances(
+        0.0, 0.0, [0.0, 0.0], [0.0, 179.7])
+    np.testing.assert_array_equal(dist_in_deg, [0.0, 179.7])
+    assert dist_in_km[0] == 0.0 and np.isnan(dist_in_km[1])
+
+
+def test_envelope():
+    import obspy.signal.filter
+    from oval_office_2.mini_lasif.window_selection import envelope
+
+    rng = np.random.RandomState(0)
+    for npts in (400, 401):
+        traces = rng.randn(3, npts)
+        batched = envelope(traces)
+        for trace, env in zip(traces, batched):
+            np.testing.assert_allclose(env, obspy.signal.filter.envelope(
+                trace), rtol=1e-12, atol=1e-12)
+            np.testing.assert_array_equal(env, envelope(trace))
+
+
+def test_intervals():
+    from oval_office_2.mini_lasif import intervals
+
+    rng = np.random.RandomState(0)
+    for _ in range(20):
+        a = rng.rand(200) < 0.6
+        b = rng.rand(200) < 0.3
+        set_a, set_b = intervals.from_mask(a), intervals.from_mask(b)
+        np.testing.assert_array_equal(intervals.to_mask(set_a, 200), a)
+        np.testing.assert_array_equal(
+            intervals.to_mask(intervals.intersect(set_a, set_b), 200), a & b)
+        np.testing.assert_array_equal(
+            intervals.to_mask(intervals.subtract(set_a, set_b), 200), a & ~b)
+        np.testing.assert_array_equal(
+            intervals.to_mask(intervals.union(set_a, set_b), 200), a | b)
+        assert np.all(intervals.lengths(
+            intervals.min_length(set_a, 3)) >= 3)
+
+    starts, stops = intervals.from_bounds([5, 0, 2, 9, 8], [8, 3, 4, 9, 10])
+    np.testing.assert_array_equal(starts, [0, 5])
+    np.testing.assert_array_equal(stops, [4, 10])
+
+
+def test_first_arrival_outside_table():
+    import obspy
+    from oval_office_2.mini_lasif.traveltime_table import first_arrival
+    from oval_office_2.mini_lasif.window_selection import _first_arrival, \
+        select_windows_stream
+
+    table = _first_arrival_table(distances=[0.0, 5.0])
+    np.testing.assert_array_equal(
+        table.contains([50.0, 150.0, 50.0], [3.0, 3.0, 10.0]),
+        [True, False, False])
+    assert _first_arrival(50.0, 3.0, table) == 300.0
+    assert _first_arrival(150.0, 3.0, table) == first_arrival(150.0, 3.0)
+    assert _first_arrival(50.0, 10.0, table) == _first_arrival(50.0, 10.0)
+
+    t, wavelet, rng = _selection_signal()
+    data = np.array([wavelet + 0.01 * rng.randn(len(t))] * 2)
+    synthetics = np.array([np.roll(wavelet, 2)] * 2)
+    kwargs = dict(starttime=obspy.UTCDateTime(2000, 1, 1), delta=1.0,
+                  event_latitude=0.0, event_longitude=0.0,
+                  station_latitudes=[0.0, 0.0],
+                  station_longitudes=[3.0, 10.0], minimum_period=40.0,
+                  maximum_period=100.0)
+
+    # Only the first trace is within the table, the second one and all
+    # traces of an event below the table use TauPy.
+    windows = select_windows_stream(data, synthetics, event_depth_in_km=50.0,
+                                    first_arrival_table=table, **kwargs)
+    reference = select_windows_stream(data, synthetics,
+                                      event_depth_in_km=50.0, **kwargs)
+    assert windows[1] == reference[1]
+    assert select_windows_stream(
+        data, synthetics, event_depth_in_km=150.0, first_arrival_table=table,
+        **kwargs) == select_windows_stream(
+        data, synthetics, event_depth_in_km=150.0, **kwargs)
+
+
+def test_select_windows_stream_matches_select_windows():
+    import obspy
+    from oval_office_2.mini_lasif.window_selection import select_windows, \
+        select_windows_stream
+
+    # Traces at several distances with different time shifts, amplitudes,
+    # a second phase and noise, one of them rejected for its noise.
+    t, wavelet, rng = _selection_signal()
+    starttime = obspy.UTCDateTime(2000, 1, 1)
+    station_longitudes = [8.0, 10.0, 15.0, 25.0, 30.0]
+    data, synthetics = [], []
+    for shift, amplitude in [(2, 1.0), (-3, 1.2), (5, 0.8), (0, 1.0)]:
+        phase = 0.5 * _wavelet(t, 1100.0, 100.0, 55.0)
+        data.append(wavelet + phase + 0.02 * rng.randn(len(t)))
+        synthetics.append(amplitude * np.roll(wavelet + phase, shift))
+    data.append(rng.randn(len(t)))
+    synthetics.append(wavelet)
+    data, synthetics = np.array(data), np.array(synthetics)
+
+    for table in [_first_arrival_table(), None]:
+        windows = select_windows_stream(
+            data, synthetics, starttime, 1.0, 0.0, 0.0, 10.0,
+            [0.0] * len(data), station_longitudes, 40.0, 100.0,
+            first_arrival_table=table)
+        assert any(windows) and not windows[-1]
+        for i, longitude in enumerate(station_longitudes):
+            assert windows[i] == select_windows(
+                obspy.Trace(data[i], header={"starttime": starttime}),
+                obspy.Trace(synthetics[i], header={"starttime": starttime}),
+                0.0, 0.0, 10.0, 0.0, longitude, 40.0, 100.0,
+                first_arrival_table=table)
+
+
+def test_selection_stats(tmpdir):
+    import obspy
+    from oval_office_2.mini_lasif import selection_stats
+    from oval_office_2.mini_lasif.window_selection import \
+        select_windows_stream
+
+    t, wavelet, rng = _selection_signal()
+    npts = len(t)
+    data = np.array([wavelet + 0.01 * rng.randn(npts),
+                     rng.randn(npts)])
+    synthetics = np.array([np.roll(wavelet, 2), wavelet])
+    kwargs = dict(starttime=obspy.UTCDateTime(2000, 1, 1), delta=1.0,
+                  event_latitude=0.0, event_longitude=0.0,
+                  event_depth_in_km=10.0, station_latitudes=[0.0, 0.0],
+                  station_longitudes=[10.0, 10.0], minimum_period=40.0,
+                  maximum_period=100.0,
+                  first_arrival_table=_first_arrival_table(),
+                  ids=["XX.A..BHZ", "XX.B..BHZ"])
+
+    stats = selection_stats.SelectionStats()
+    windows = select_windows_stream(data, synthetics, stats=stats, **kwargs)
+    assert windows == select_windows_stream(data, synthetics, **kwargs)
+    assert windows[0] and not windows[1]
+
+    records = dict((trace["id"], trace) for trace in stats.traces)
+    assert records["XX.B..BHZ"]["rejected"] == "noise"
+    accepted = records["XX.A..BHZ"]
+    assert accepted["rejected"] is None
+    assert [stage[0] for stage in accepted["stages"]] == \
+        list(selection_stats.STAGES)
+    remaining = [stage[2] for stage in accepted["stages"]]
+    assert remaining == sorted(remaining, reverse=True)
+    assert accepted["stages"][-1][3] == len(windows[0])
+
+    summary = selection_stats.summarize(stats.traces)
+    assert summary["traces"] == 2
+    assert summary["rejected"] == {"noise": 1}
+    assert sum(entry["samples_removed"] for entry in
+               summary["stages"].values()) == 2 * npts - remaining[-1]
+
+    selection_stats.write_event_stats(str(tmpdir), stats)
+    filename = str(tmpdir.join(selection_stats.ITERATION_STATS_FILE))
+    text = selection_stats.write_iteration_stats(
+        [str(tmpdir), str(tmpdir.join("missing"))], filename)
+    assert text.startswith("2 traces, rejected: noise 1")
+    assert "XX.A..BHZ" in open(filename).read()
+
+
+def test_select_windows_sweep(tmpdir):
+    import inspect
+    import obspy
+    from oval_office_2.mini_lasif import window_selection
+    from oval_office_2.scripts.select_windows import print_sweep_report
+
+    names, _, _, defaults = inspect.getargspec(window_selection.select_windows)
+    signature = dict(zip(names[-len(defaults):], defaults))
+    for name, value in window_selection.SELECTION_PARAMETERS.items():
+        assert signature[name] == value
+
+    t, wavelet, rng = _selection_signal()
+    wavelet = wavelet + 0.5 * _wavelet(t, 1100.0, 100.0, 55.0)
+    data = obspy.Trace(wavelet + 0.01 * rng.randn(len(t)),
+                       header={"station": "A", "channel": "BHZ"})
+    synthetic = obspy.Trace(np.roll(wavelet, 3) * 1.1)
+    table = _first_arrival_table()
+    args = (data, synthetic, 0.0, 0.0, 10.0, 0.0, 10.0, 40.0, 100.0)
+    parameter_sets = [{}, {"min_velocity": 2.0, "min_length_period": 1.0},
+                      {"threshold_shift": 0.05},
+                      {"min_envelope_similarity": 0.8}, {"max_noise": 0.0}]
+
+    sweep = window_selection.select_windows_sweep(
+        *args, parameter_sets=parameter_sets, first_arrival_table=table)
+    assert len(sweep) == len(parameter_sets)
+    for parameters, windows in zip(parameter_sets, sweep):
+        assert windows == window_selection.select_windows(
+            *args, first_arrival_table=table, **parameters)
+    assert sweep[0] and sweep[1] != sweep[0]
+    assert not sweep[2] and not sweep[4]
+
+    with pytest.raises(ValueError):
+        window_selection.select_windows_sweep(
+            *args, parameter_sets=[{"threshold": 1.0}])
+
+    filename = str(tmpdir.join("sweep.txt"))
+    print_sweep_report(parameter_sets, [("event", {"A.Z": sweep})], filename)
+    lines = open(filename).read().splitlines()
+    assert len(lines) == len(parameter_sets) + 1
+    assert lines[1].split()[1] == str(len(sweep[0]))
+
+
+def test_select_windows_restricted_correlation(monkeypatch):
+    import obspy
+    plt = pytest.importorskip("matplotlib.pylab")
+    from oval_office_2.mini_lasif import selection_stats, window_selection
+
+    # The second phase is too weak in the synthetics and eliminated by the
+    # envelope similarity. Its time shift jumps two samples before the
+    # remaining samples, so the sliding correlations of a few eliminated
+    # samples are still needed for the time shift jumps. A strong late
+    # phase after the traveltime window sets the clipping of the envelopes.
+    t, _, rng = _selection_signal()
+    first = _wavelet(t, 700.0, 100.0, 40.0)
+    second = _wavelet(t, 850.0, 80.0, 50.0)
+    late = _wavelet(t, 1800.0, 80.0, 60.0)
+    noise = 0.01 * rng.randn(len(t))
+    kwargs = dict(first_arrival_table=_first_arrival_table(),
+                  threshold_correlation=0.0,
+                  threshold_shift=1.0, min_envelope_similarity=0.07)
+
+    # Plotting shows the envelope similarity and the sliding correlations of
+    # all samples, so it computes them without the restrictions.
+    plt.switch_backend("Agg")
+    monkeypatch.setattr(plt, "show", lambda: None)
+    for late_amplitude in (0.0, 2.5):
+        data = obspy.Trace(first + second + late_amplitude * late + noise,
+                           header={"station": "A", "channel": "BHZ"})
+        synthetic = obspy.Trace(np.roll(first, -4) +
+                                0.3 * np.roll(second, 18) +
+                                late_amplitude * late)
+        args = (data, synthetic, 0.0, 0.0, 10.0, 0.0, 30.0, 40.0, 100.0)
+
+        stats = selection_stats.SelectionStats()
+        windows = window_selection.select_windows(*args, stats=stats,
+                                                  **kwargs)
+        assert windows
+        unrestricted = selection_stats.SelectionStats()
+        try:
+            assert windows == window_selection.select_windows(
+                *args, stats=unrestricted, plot=True, **kwargs)
+        finally:
+            plt.close("all")
+        assert [stage[2:] for stage in stats.traces[0]["stages"]] == \
+            [stage[2:] for stage in unrestricted.traces[0]["stages"]]
+
+
+def test_approximate_sliding_cross_correlation():
+    import obspy
+    from oval_office_2.mini_lasif import window_selection
+
+    t, wavelet, rng = _selection_signal()
+    data = np.sin(2 * np.pi * t / 40.0) + 0.1 * rng.randn(len(t))
+    synth = np.sin(2 * np.pi * (t - 3.0) / 40.0)
+    taper = np.hanning(81)
+    midpoints = np.arange(100, 1001)
+
+    exact = window_selection.sliding_cross_correlation(
+        data, synth, taper, midpoints)
+    for values, approximation in zip(exact, window_selection.
+                                     approximate_sliding_cross_correlation(
+                                         data, synth, taper, midpoints, 1)):
+        np.testing.assert_array_equal(values, approximation)
+
+    # Exact at every step-th and the last midpoint, interpolated in between.
+    approximate = window_selection.approximate_sliding_cross_correlation(
+        data, synth, taper, midpoints, 7)
+    for values, approximation in zip(exact, approximate):
+        np.testing.assert_array_equal(values[::7], approximation[::7])
+        assert values[-1] == approximation[-1]
+    np.testing.assert_allclose(approximate[2], exact[2], atol=0.05)
+    assert np.all(np.abs(approximate[1] - exact[1]) <= 1)
+
+    args = (obspy.Trace(wavelet + 0.01 * rng.randn(len(t))),
+            obspy.Trace(np.roll(wavelet, 3) * 1.1),
+            0.0, 0.0, 10.0, 0.0, 10.0, 40.0, 100.0)
+    table = _first_arrival_table()
+    reference = window_selection.select_windows(
+        *args, first_arrival_table=table)
+    windows = window_selection.select_windows(
+        *args, first_arrival_table=table, cc_step_period=0.1)
+    exact_time, approximate_time, common_time = \
+        window_selection.window_agreement(reference, windows)
+    assert exact_time > 0
+    assert common_time > 0.9 * max(exact_time, approximate_time)
+    assert window_selection.window_agreement(
+        [(0.0, 10.0), (20.0, 30.0)], [(5.0, 25.0)]) == (20.0, 20.0, 10.0)
@@ -120,3 +120,19 @@ def test_adjoint_sources(lasif_info):
     diff = -1 * srcs[1]['IC.HIA.Z'][::-1] - ref
     print('MAX:', np.amax(diff))
     print('MIN:', np.amin(diff))
+
+
+def test_adjoint_source_precision(lasif_info):
+    from oval_office_2.scripts import validate_adjoint_precision
+    work_path = os.path.join(PATH, 'data', 'adjoint_source')
+    os.chdir(work_path)
+
+    min_period = 1 / lasif_info[1]['lowpass']
+    max_period = 1 / lasif_info[1]['highpass']
+    errors = validate_adjoint_precision.compare_precisions(
+        (TEST_EVENT, min_period, max_period, 'earthquake'))
+
+    assert sorted(errors.keys()) == ['IC.HIA.Z', 'II.AAK.Z']
+    for error in errors.values():
+        assert error['misfit_error'] < 1e-5
+        assert error['adjoint_error'] < 1e-4
@@ -64,6 +64,36 @@ def get_lasif_information(system, remote_lasif_dir, iteration):
     # os.remove(local_data)
     return data
 
+def get_step_length_events(system, config, n_events=25):
+    """Returns the events with the highest total misfit of the first
+    iteration, which are used for step length tests.
+
+    :param system: System object describing the remote cluster.
+    :param config: Config class holding project specific information.
+    :param n_events: Number of events to select.
+    :type n_events: int
+    """
+
+    # Get misfit file
+    misfit_file_path = os.path.join(config.lasif_project_path,
+                                    "ADJOINT_SOURCES_AND_WINDOWS/ADJOINT_SOURCES",
+                                    config.first_iteration, 'misfit.p')
+    system.get_file(misfit_file_path, "./misfit.p")
+
+    with open("./misfit.p", 'rb') as fh:
+        misfit_iter1 = cPickle.load(fh)
+
+    # Create format with total misfit per event
+    dict_iter1 = {}
+    for misfit in misfit_iter1[:]:
+        station_misfits = misfit[1]
+        dict_iter1[misfit[0]] = sum(station_misfits.values())
+
+    # Sort and select the events with highest misfits
+    events_sorted_by_misfit = sorted(dict_iter1.items(), key=lambda x:x[1], reverse=True)
+    return [x[0] for x in events_sorted_by_misfit[:n_events]]
+
+
 def set_params_forward_save(sf_dict, model):
     """Returns a dictionary with the proper parameters set for a forward run
     with the last frame saved.